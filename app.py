@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, abort, jsonify
-from datetime import datetime, date, time
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, abort, jsonify, g, has_app_context, has_request_context
+from datetime import datetime, date, time, timedelta
 from zoneinfo import ZoneInfo
 from pywebpush import webpush, WebPushException
 import json
-from markupsafe import escape
+from markupsafe import escape, Markup
 import sqlite3, os, qrcode
 from io import BytesIO
 import socket
+import socketserver
 import re
+import queue
+import threading
+import tempfile
+import hashlib
+import random
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from bisect import bisect_left
+import click
+from werkzeug.http import is_resource_modified
+from time import sleep, perf_counter
 
 app = Flask(__name__)
 app.secret_key = "chave_super_secreta_trocar"
-DB_PATH = "models.db"
+DB_PATH = os.environ.get("DB_PATH", "models.db")
 
 # 🔐 VAPID KEYS (PUSH NOTIFICATION)
 VAPID_PUBLIC_KEY = "BNWB4EBcE40JvPdSR4IgbKrTmJenyjC3wwa8HgClMIJ2os4kkz7pd8v0dYSZKnZPdkq7MF32XVewXsPYW90LHdU"
@@ -24,13 +39,26 @@ def inject_vapid_key():
 
 
 # ---------------- Banco de Dados ----------------
-def init_db():
-    if os.path.exists(DB_PATH):
-        return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def _colunas(c, tabela):
+    c.execute(f"PRAGMA table_info({tabela});")
+    return [col[1] for col in c.fetchall()]
+
+def _add_colunas(c, tabela, colunas):
+    """Adiciona as colunas (nome, definição) que ainda não existem na tabela."""
+    existentes = _colunas(c, tabela)
+    adicionadas = []
+    for nome, definicao in colunas:
+        if nome not in existentes:
+            c.execute(f"ALTER TABLE {tabela} ADD COLUMN {nome} {definicao};")
+            adicionadas.append(nome)
+    return adicionadas
+
+# Cada passo recebe o cursor da transação de migração. Os passos 1..8 reproduzem
+# o antigo init_db() + add_missing_*(): precisam continuar idempotentes porque
+# bancos anteriores ao schema_version já têm parte (ou todo) o esquema aplicado.
+def migracao_models(c):
     c.execute('''
-        CREATE TABLE models (
+        CREATE TABLE IF NOT EXISTS models (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             code TEXT UNIQUE,
             model_name TEXT,
@@ -52,8 +80,18 @@ def init_db():
             updated_at TEXT
         )
     ''')
+    _add_colunas(c, "models", [
+        ("op", "TEXT"),
+        ("setor", "TEXT"),
+        ("fase", "TEXT"),
+        ("phase_type", "TEXT DEFAULT 'TOP_ONLY'"),
+        ("operadora", "TEXT"),
+        ("lote_padrao", "TEXT"),
+    ])
+
+def migracao_history(c):
     c.execute('''
-        CREATE TABLE history (
+        CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             model_id INTEGER,
             changed_at TEXT,
@@ -62,22 +100,44 @@ def init_db():
             FOREIGN KEY(model_id) REFERENCES models(id)
         )
     ''')
-    c.execute('''
-        CREATE TABLE labels (
+
+def migracao_labels(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS labels (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             model_id INTEGER,
             lote TEXT,
             producao_total INTEGER,
             capacidade_magazine INTEGER,
+            remaining INTEGER,
             created_at TEXT,
             linked_label_id INTEGER,
             setor_atual TEXT,
+            fase TEXT,
+            top_done INTEGER DEFAULT 0,
+            bottom_done INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'ATIVO',
             FOREIGN KEY(model_id) REFERENCES models(id),
             FOREIGN KEY(linked_label_id) REFERENCES labels(id)
         )
-    ''')
+    """)
+    adicionadas = _add_colunas(c, "labels", [
+        ("linked_label_id", "INTEGER REFERENCES labels(id)"),
+        ("setor_atual", "TEXT"),
+        ("fase", "TEXT"),
+        ("remaining", "INTEGER"),
+        ("top_done", "INTEGER DEFAULT 0"),
+        ("bottom_done", "INTEGER DEFAULT 0"),
+        ("status", "TEXT DEFAULT 'ATIVO'"),
+        ("updated_at", "TEXT"),
+    ])
+    if "remaining" in adicionadas:
+        # Inicializa remaining com capacidade_magazine para registros antigos
+        c.execute("UPDATE labels SET remaining = capacidade_magazine WHERE remaining IS NULL;")
+
+def migracao_movements(c):
     c.execute('''
-        CREATE TABLE movements (
+        CREATE TABLE IF NOT EXISTS movements (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             model_id INTEGER,
             label_id INTEGER,
@@ -86,256 +146,1016 @@ def init_db():
             quantidade INTEGER,
             from_setor TEXT,
             to_setor TEXT,
+            fase TEXT,
             created_at TEXT,
-            created_by TEXT,
-            FOREIGN KEY(model_id) REFERENCES models(id),
-            FOREIGN KEY(label_id) REFERENCES labels(id)
+            created_by TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
+    _add_colunas(c, "movements", [
+        ("fase", "TEXT"),
+        ("new_label_id", "INTEGER"),
+    ])
 
-def add_missing_column():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(models);")
-    columns = [col[1] for col in c.fetchall()]
+def migracao_ops(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ops (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filial TEXT,
+            numero_op TEXT,
+            produto TEXT,
+            descricao TEXT,
+            armazem TEXT,
+            quantidade INTEGER,
+            produzido INTEGER,
+            setores TEXT,
+            created_at TEXT
+        )
+    ''')
 
-    # Colunas existentes
-    if "op" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN op TEXT;")
-    if "setor" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN setor TEXT;")
+def migracao_ops_saldos(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS ops_saldos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_op INTEGER,
+            setor TEXT,
+            fase TEXT,
+            quantidade INTEGER DEFAULT 0,
+            updated_at TEXT,
+            FOREIGN KEY (id_op) REFERENCES ops(id)
+        )
+    """)
+    _add_colunas(c, "ops_saldos", [
+        ("setor", "TEXT"),
+        ("fase", "TEXT"),
+        ("quantidade", "INTEGER DEFAULT 0"),
+    ])
 
-    if "fase" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN fase TEXT;")
+def migracao_op_alerts(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS op_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_op INTEGER,
+            setor TEXT,
+            fase TEXT,
+            meta INTEGER,
+            ativo INTEGER DEFAULT 1,
+            disparado INTEGER DEFAULT 0,
+            created_at TEXT,
+            FOREIGN KEY (id_op) REFERENCES ops(id)
+        )
+    """)
 
-    if "phase_type" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN phase_type TEXT DEFAULT 'TOP_ONLY';")
+def migracao_push_subscriptions(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS push_subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            endpoint TEXT NOT NULL,
+            p256dh TEXT NOT NULL,
+            auth TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
 
-    if "operadora" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN operadora TEXT;")
-    
-    if "lote_padrao" not in columns:
-        c.execute("ALTER TABLE models ADD COLUMN lote_padrao TEXT;")
+# Índices das consultas críticas (ver CONSULTAS_CRITICAS). As expressões dos
+# índices precisam ser idênticas às usadas nas consultas (UPPER(code) etc.).
+INDICES = [
+    "CREATE INDEX IF NOT EXISTS idx_models_code_upper ON models(UPPER(code))",
+    "CREATE INDEX IF NOT EXISTS idx_models_op_code ON models(op, code)",
+    "CREATE INDEX IF NOT EXISTS idx_models_model_name ON models(model_name)",
+    "CREATE INDEX IF NOT EXISTS idx_labels_model_lote ON labels(model_id, lote)",
+    "CREATE INDEX IF NOT EXISTS idx_labels_ativas ON labels(model_id) WHERE remaining > 0",
+    "CREATE INDEX IF NOT EXISTS idx_labels_linked ON labels(linked_label_id)",
+    "CREATE INDEX IF NOT EXISTS idx_movements_label ON movements(label_id, ponto, acao)",
+    "CREATE INDEX IF NOT EXISTS idx_movements_new_label ON movements(new_label_id, ponto, acao)",
+    "CREATE INDEX IF NOT EXISTS idx_movements_model_producao ON movements(model_id, acao, to_setor, UPPER(TRIM(fase)))",
+    "CREATE INDEX IF NOT EXISTS idx_movements_model_created ON movements(model_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_movements_acao_created ON movements(UPPER(acao), created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_history_model ON history(model_id, changed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_ops_op_produto ON ops(numero_op, produto)",
+    "CREATE INDEX IF NOT EXISTS idx_ops_saldos_op ON ops_saldos(id_op)",
+    "CREATE INDEX IF NOT EXISTS idx_op_alerts_op ON op_alerts(id_op, setor, fase)",
+]
+
+def migracao_indices(c):
+    for ddl in INDICES:
+        c.execute(ddl)
+
+def migracao_producao_agregada(c):
+    _add_colunas(c, "ops", [("model_id", "INTEGER REFERENCES models(id)")])
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ops_model ON ops(model_id)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS producao_agregada (
+            id_op INTEGER NOT NULL,
+            setor TEXT NOT NULL,
+            fase TEXT NOT NULL,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id_op, setor, fase),
+            FOREIGN KEY (id_op) REFERENCES ops(id)
+        ) WITHOUT ROWID
+    """)
+    reconstruir_producao_agregada(c)
 
-    conn.commit()   
-    conn.close()
+def migracao_indices_versao(c):
+    # MAX(updated_at) nas consultas de versão (dashboard, ETag)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_labels_updated ON labels(updated_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_models_updated ON models(updated_at)")
 
-def add_missing_table_labels():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='labels';")
-    if not c.fetchone():
+def migracao_eventos(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS eventos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            ref_id INTEGER,
+            created_at TEXT
+        )
+    """)
+
+def migracao_label_jobs(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS label_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model_id INTEGER,
+            producao_total INTEGER,
+            capacidade_magazine INTEGER,
+            lote_inicial INTEGER,
+            padrao TEXT,
+            total INTEGER,
+            feitos INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'PENDENTE',
+            erro TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (model_id) REFERENCES models(id)
+        )
+    """)
+
+def migracao_push_fila(c):
+    # o subscribe antigo inseria uma linha nova a cada inscrição do mesmo aparelho;
+    # fica só a mais recente (chaves atuais) de cada endpoint
+    c.execute("""
+        DELETE FROM push_subscriptions
+        WHERE id NOT IN (SELECT MAX(id) FROM push_subscriptions GROUP BY endpoint)
+    """)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_push_subscriptions_endpoint ON push_subscriptions(endpoint)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS push_fila (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alerta_id INTEGER,
+            subscription_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDENTE',
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa TEXT NOT NULL,
+            erro TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (alerta_id) REFERENCES op_alerts(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_push_fila_status ON push_fila(status, proxima_tentativa)")
+
+def migracao_root_label(c):
+    # Linhagem: toda etiqueta aponta para a etiqueta original do lote (a raiz
+    # aponta para si mesma) e todo movimento guarda a raiz da etiqueta movida.
+    _add_colunas(c, "labels", [("root_label_id", "INTEGER REFERENCES labels(id)")])
+    _add_colunas(c, "movements", [("root_label_id", "INTEGER")])
+
+    c.execute("CREATE TEMP TABLE _raizes (id INTEGER PRIMARY KEY, root INTEGER)")
+    c.execute("""
+        INSERT INTO _raizes (id, root)
+        WITH RECURSIVE arvore(id, root) AS (
+            SELECT id, id FROM labels WHERE linked_label_id IS NULL
+            UNION ALL
+            SELECT l.id, a.root FROM labels l JOIN arvore a ON l.linked_label_id = a.id
+        )
+        SELECT id, root FROM arvore
+    """)
+    # órfãs (pai apagado) viram raiz de si mesmas
+    c.execute("""
+        UPDATE labels
+        SET root_label_id = COALESCE((SELECT root FROM _raizes WHERE _raizes.id = labels.id), id)
+        WHERE root_label_id IS NULL
+    """)
+    c.execute("DROP TABLE _raizes")
+
+    c.execute("""
+        UPDATE movements
+        SET root_label_id = (
+            SELECT l.root_label_id FROM labels l
+            WHERE l.id = COALESCE(movements.label_id, movements.new_label_id)
+        )
+        WHERE root_label_id IS NULL
+    """)
+
+    # A regra antiga só olhava uma geração, então o histórico pode ter mais de uma
+    # PRODUCAO por raiz/ponto/fase. A primeira fica como referência; as demais
+    # saem do índice único (root_label_id NULL) sem apagar o movimento.
+    c.execute("""
+        UPDATE movements SET root_label_id = NULL
+        WHERE acao = 'PRODUCAO'
+          AND root_label_id IS NOT NULL
+          AND id NOT IN (
+              SELECT MIN(id) FROM movements
+              WHERE acao = 'PRODUCAO' AND root_label_id IS NOT NULL
+              GROUP BY root_label_id, ponto, UPPER(TRIM(fase))
+          )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_labels_root ON labels(root_label_id)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_movements_root
+        ON movements(root_label_id, ponto, acao, UPPER(TRIM(fase)))
+    """)
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_movements_producao
+        ON movements(root_label_id, ponto, UPPER(TRIM(fase)))
+        WHERE acao = 'PRODUCAO'
+    """)
+
+    # etiquetas novas sem pai (geração de lotes) são a própria raiz
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS labels_root_ai
+        AFTER INSERT ON labels
+        WHEN NEW.root_label_id IS NULL
+        BEGIN
+            UPDATE labels SET root_label_id = NEW.id WHERE id = NEW.id;
+        END
+    """)
+
+def migracao_movements_client_at(c):
+    # horário em que o terminal leu o QR (scans enviados em lote podem chegar atrasados)
+    _add_colunas(c, "movements", [("client_at", "TEXT")])
+
+def migracao_producao_hora(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS producao_hora (
+            model_id INTEGER NOT NULL,
+            hora_utc TEXT NOT NULL,
+            setor TEXT NOT NULL,
+            fase TEXT NOT NULL,
+            turno TEXT NOT NULL,
+            hora TEXT NOT NULL,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            ultima TEXT,
+            PRIMARY KEY (model_id, hora_utc, setor, fase, turno),
+            FOREIGN KEY (model_id) REFERENCES models(id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_producao_hora_utc ON producao_hora(hora_utc)")
+    reconstruir_producao_hora(c)
+
+# epoch-ms (UTC) a partir do texto ISO; NULL quando o texto não é uma data
+def _sql_epoch_ms(coluna):
+    return f"CAST(ROUND((julianday({coluna}) - 2440587.5) * 86400000.0) AS INTEGER)"
+
+COLUNAS_EPOCH_MS = [
+    # (tabela, coluna texto, coluna epoch-ms)
+    ("movements", "created_at", "created_ms"),
+    ("labels", "created_at", "created_ms"),
+    ("labels", "updated_at", "updated_ms"),
+    ("models", "created_at", "created_ms"),
+    ("models", "updated_at", "updated_ms"),
+    ("history", "changed_at", "changed_ms"),
+]
+
+def migracao_epoch_ms(c):
+    for tabela, texto, ms in COLUNAS_EPOCH_MS:
+        _add_colunas(c, tabela, [(ms, "INTEGER")])
+        c.execute(f"UPDATE {tabela} SET {ms} = {_sql_epoch_ms(texto)} WHERE {ms} IS NULL AND {texto} IS NOT NULL")
+
+    # os índices por texto dão lugar aos por epoch-ms; idx_movements_acao_created
+    # atendia o /live antigo, que hoje lê producao_hora
+    for nome in ("idx_movements_model_created", "idx_movements_acao_created",
+                 "idx_labels_updated", "idx_models_updated", "idx_history_model"):
+        c.execute(f"DROP INDEX IF EXISTS {nome}")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movements_model_created_ms ON movements(model_id, created_ms)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_labels_model_created_ms ON labels(model_id, created_ms)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_labels_updated_ms ON labels(updated_ms)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_models_updated_ms ON models(updated_ms)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_model_changed_ms ON history(model_id, changed_ms)")
+
+# Busca textual dos models (FTS5 com conteúdo externo: o índice lê o texto da
+# própria tabela models e os triggers mantêm os tokens em dia)
+COLUNAS_FTS_MODELS = ("code", "model_name", "cliente", "op", "po", "lote")
+
+def migracao_models_fts(c):
+    colunas = ", ".join(COLUNAS_FTS_MODELS)
+    novos = ", ".join(f"new.{col}" for col in COLUNAS_FTS_MODELS)
+    antigos = ", ".join(f"old.{col}" for col in COLUNAS_FTS_MODELS)
+
+    c.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS models_fts USING fts5(
+            {colunas},
+            content='models', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS models_fts_ai AFTER INSERT ON models BEGIN
+            INSERT INTO models_fts (rowid, {colunas}) VALUES (new.id, {novos});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS models_fts_ad AFTER DELETE ON models BEGIN
+            INSERT INTO models_fts (models_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS models_fts_au AFTER UPDATE OF {colunas} ON models BEGIN
+            INSERT INTO models_fts (models_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+            INSERT INTO models_fts (rowid, {colunas}) VALUES (new.id, {novos});
+        END
+    """)
+    # relevância: código pesa mais que nome, que pesa mais que cliente/OP/PO/lote
+    c.execute("INSERT INTO models_fts (models_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 3.0, 2.0, 1.0)')")
+    c.execute("INSERT INTO models_fts (models_fts) VALUES ('rebuild')")
+
+# Lote estruturado: "08 / 504" vira lote_seq=8 e lote_padrao="504", para o scan
+# achar a etiqueta por igualdade no índice e faixas de lotes saírem em ordem numérica
+def migracao_lote_estruturado(c):
+    _add_colunas(c, "labels", [("lote_seq", "INTEGER"), ("lote_padrao", "TEXT")])
+
+    # lotes distintos são poucos perto das etiquetas: interpreta cada texto uma
+    # vez em Python (mesma regra das gravações) e aplica num único UPDATE
+    c.execute("CREATE TEMP TABLE _lotes (lote TEXT PRIMARY KEY, seq INTEGER, padrao TEXT)")
+    distintos = [r[0] for r in c.execute("SELECT DISTINCT lote FROM labels WHERE lote IS NOT NULL")]
+    c.executemany(
+        "INSERT INTO _lotes (lote, seq, padrao) VALUES (?, ?, ?)",
+        [(lote, *partes_lote(lote)) for lote in distintos]
+    )
+    c.execute("""
+        UPDATE labels SET
+            lote_seq = (SELECT seq FROM _lotes WHERE _lotes.lote = labels.lote),
+            lote_padrao = (SELECT padrao FROM _lotes WHERE _lotes.lote = labels.lote)
+        WHERE lote IS NOT NULL AND lote_seq IS NULL
+    """)
+    c.execute("DROP TABLE _lotes")
+
+    c.execute("DROP INDEX IF EXISTS idx_labels_model_lote")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_labels_lote ON labels(model_id, lote_padrao, lote_seq)")
+
+# Versão otimista da etiqueta: a baixa do saldo só grava se a versão ainda for a
+# lida (UPDATE ... WHERE version = ?) e a incrementa
+def migracao_labels_version(c):
+    _add_colunas(c, "labels", [("version", "INTEGER NOT NULL DEFAULT 0")])
+
+# id que o terminal gera para cada scan: um reenvio (timeout depois do commit,
+# fila offline) acha o movimento já gravado em vez de cair no bloqueio duplicado
+def migracao_movements_client_scan_id(c):
+    _add_colunas(c, "movements", [("client_scan_id", "TEXT")])
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_movements_client_scan_id
+        ON movements(client_scan_id) WHERE client_scan_id IS NOT NULL
+    """)
+
+# jobs de etiquetas são retomados a partir de `feitos`; o limite de tentativas
+# evita reiniciar para sempre um job que falha sempre no mesmo ponto
+def migracao_label_jobs_tentativas(c):
+    _add_colunas(c, "label_jobs", [("tentativas", "INTEGER NOT NULL DEFAULT 0")])
+
+# Lista ordenada — nunca reordenar nem remover passos; sempre acrescentar no fim.
+MIGRACOES = [
+    (1, "models", migracao_models),
+    (2, "history", migracao_history),
+    (3, "labels", migracao_labels),
+    (4, "movements", migracao_movements),
+    (5, "ops", migracao_ops),
+    (6, "ops_saldos", migracao_ops_saldos),
+    (7, "op_alerts", migracao_op_alerts),
+    (8, "push_subscriptions", migracao_push_subscriptions),
+    (9, "indices", migracao_indices),
+    (10, "producao_agregada", migracao_producao_agregada),
+    (11, "indices_versao", migracao_indices_versao),
+    (12, "eventos", migracao_eventos),
+    (13, "label_jobs", migracao_label_jobs),
+    (14, "push_fila", migracao_push_fila),
+    (15, "root_label", migracao_root_label),
+    (16, "movements_client_at", migracao_movements_client_at),
+    (17, "producao_hora", migracao_producao_hora),
+    (18, "epoch_ms", migracao_epoch_ms),
+    (19, "models_fts", migracao_models_fts),
+    (20, "lote_estruturado", migracao_lote_estruturado),
+    (21, "labels_version", migracao_labels_version),
+    (22, "movements_client_scan_id", migracao_movements_client_scan_id),
+    (23, "label_jobs_tentativas", migracao_label_jobs_tentativas),
+]
+
+def migrar_db(db_path=None):
+    """
+    Aplica as migrações pendentes numa única conexão e numa única transação.
+    Deve rodar uma vez por deploy (hook on_starting do gunicorn, `flask migrate-db`
+    ou `python app.py`), nunca no import — os workers não verificam esquema.
+    Retorna a lista de versões aplicadas.
+    """
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30, isolation_level=None)
+    aplicadas = []
+    try:
+        # journal_mode não pode mudar dentro de transação
+        conn.execute("PRAGMA journal_mode=WAL;")
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
         c.execute("""
-            CREATE TABLE labels (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                model_id INTEGER,
-                lote TEXT,
-                producao_total INTEGER,
-                capacidade_magazine INTEGER,
-                remaining INTEGER,
-                created_at TEXT,
-                linked_label_id INTEGER,
-                setor_atual TEXT,
-                fase TEXT,
-                top_done INTEGER DEFAULT 0,
-                bottom_done INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'ATIVO',
-                FOREIGN KEY(model_id) REFERENCES models(id),
-                FOREIGN KEY(linked_label_id) REFERENCES labels(id)
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                nome TEXT,
+                applied_at TEXT
             )
         """)
-        conn.commit()
+        atual = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+        for versao, nome, passo in MIGRACOES:
+            if versao <= atual:
+                continue
+            passo(c)
+            c.execute(
+                "INSERT INTO schema_version (version, nome, applied_at) VALUES (?, ?, ?)",
+                (versao, nome, now_utc().isoformat())
+            )
+            aplicadas.append(versao)
+
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return aplicadas
+
+@app.cli.command("migrate-db")
+def migrate_db_command():
+    """Aplica as migrações pendentes do banco."""
+    aplicadas = migrar_db()
+    if aplicadas:
+        print(f"Migrações aplicadas: {', '.join(map(str, aplicadas))}")
     else:
-        c.execute("PRAGMA table_info(labels);")
-        columns = [col[1] for col in c.fetchall()]
-        if "linked_label_id" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN linked_label_id INTEGER REFERENCES labels(id);")
-        if "setor_atual" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN setor_atual TEXT;")
-        if "fase" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN fase TEXT;")
-        if "remaining" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN remaining INTEGER;")
-            # Inicializa remaining com capacidade_magazine para registros antigos
-            c.execute("UPDATE labels SET remaining = capacidade_magazine WHERE remaining IS NULL;")
-        if "top_done" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN top_done INTEGER DEFAULT 0;")
-        if "bottom_done" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN bottom_done INTEGER DEFAULT 0;")
-        if "status" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN status TEXT DEFAULT 'ATIVO';")
-        if "updated_at" not in columns:
-            c.execute("ALTER TABLE labels ADD COLUMN updated_at TEXT;")
-        conn.commit()
-    conn.close()
+        print("Banco já está na versão mais recente.")
+
+# ---------------- Métricas (Prometheus) ----------------
+# Contadores e histogramas em memória, por processo. Cada worker grava um
+# retrato do que contou em METRICAS_DIR (um JSON por pid) a cada
+# METRICAS_INTERVALO segundos, e o /metrics soma os retratos de todos os
+# workers. O gunicorn.conf.py aponta METRICAS_DIR para uma pasta do master;
+# fora do gunicorn cada processo usa a própria.
+METRICAS_DIR = os.environ.get("METRICAS_DIR") or os.path.join(
+    tempfile.gettempdir(), f"venttos-metricas-{os.getpid()}"
+)
+METRICAS_INTERVALO = float(os.environ.get("METRICAS_INTERVALO", 5))
+
+BALDES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BALDES_COMANDOS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+# nome -> (tipo, descrição, baldes do histograma)
+METRICAS = {
+    "venttos_http_request_duration_seconds": (
+        "histogram", "Latência das requisições por endpoint, método e status.", BALDES_SEGUNDOS),
+    "venttos_http_sql_statements": (
+        "histogram", "Comandos SQL executados por requisição.", BALDES_COMANDOS),
+    "venttos_http_sql_seconds": (
+        "histogram", "Tempo em SQL por requisição (execução, leitura das linhas e commit).", BALDES_SEGUNDOS),
+    "venttos_sqlite_busy_retries_total": (
+        "counter", "Transações de escrita repetidas (banco ocupado ou etiqueta alterada).", None),
+    "venttos_escrita_grupo_scans": (
+        "histogram", "Scans por transação do escritor (escrita agrupada).", BALDES_COMANDOS),
+    "venttos_escrita_direta_total": (
+        "counter", "Scans gravados direto porque o processo escritor não atendeu.", None),
+    "venttos_sqlite_locked_total": (
+        "counter", "Comandos SQL que falharam com database is locked/busy.", None),
+    "venttos_scans_total": (
+        "counter", "Scans de movimentação por ponto, ação e resultado.", None),
+    "venttos_push_envios_total": (
+        "counter", "Envios de push por resultado.", None),
+    "venttos_sql_lentas_total": (
+        "counter", "Comandos SQL acima de CONSULTA_LENTA_MS (com o log ligado).", None),
+}
 
-def add_missing_table_movements():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='movements';")
-    if not c.fetchone():
-        c.execute('''
-            CREATE TABLE movements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                model_id INTEGER,
-                label_id INTEGER,
-                ponto TEXT,
-                acao TEXT,
-                quantidade INTEGER,
-                from_setor TEXT,
-                to_setor TEXT,
-                fase TEXT, 
-                created_at TEXT,
-                created_by TEXT
-            )
-        ''')
-        conn.commit()
-    conn.close()
+ACOES_SCAN = ("PRODUCAO", "RECEBIMENTO", "CQ", "RETRABALHO", "REJEICAO")
+
+# (nome, ((label, valor), ...)) -> número (counter) ou [baldes..., +Inf, soma, total]
+_metricas = {}
+_metricas_lock = threading.Lock()
+_metricas_estado = {"thread": None}
+
+def contar_metrica(nome, valor=1, **labels):
+    chave = (nome, tuple(labels.items()))
+    with _metricas_lock:
+        _metricas[chave] = _metricas.get(chave, 0) + valor
+
+def observar_metrica(nome, valor, **labels):
+    baldes = METRICAS[nome][2]
+    chave = (nome, tuple(labels.items()))
+    with _metricas_lock:
+        h = _metricas.get(chave)
+        if h is None:
+            h = _metricas[chave] = [0] * (len(baldes) + 3)
+        h[bisect_left(baldes, valor)] += 1
+        h[-2] += valor
+        h[-1] += 1
+
+def contar_scan(ponto, acao, resultado):
+    # ponto/ação vêm do terminal: valores fora da lista não viram séries novas
+    contar_metrica(
+        "venttos_scans_total",
+        ponto=ponto if ponto in POINT_RULES else "outro",
+        acao=acao if acao in ACOES_SCAN else "outra",
+        resultado=resultado
+    )
 
-def add_missing_columns_movements():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(movements);")
-    columns = [col[1] for col in c.fetchall()]
-    if "fase" not in columns:
-        c.execute("ALTER TABLE movements ADD COLUMN fase TEXT;")
-    conn.commit()
-    conn.close()
+def _endpoint_atual():
+    if not has_request_context():
+        return "segundo_plano"
+    return request.endpoint or "sem_rota"
 
-def add_new_label_id_column_movements():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def _somar_sql(segundos, comandos):
+    # só dentro de requests; threads de fundo (push, etiquetas) não têm `g`
+    if has_app_context() and "sql_comandos" in g:
+        g.sql_comandos += comandos
+        g.sql_segundos += segundos
 
-    c.execute("PRAGMA table_info(movements);")
-    columns = [col[1] for col in c.fetchall()]
+def _contar_lock(erro):
+    texto = str(erro)
+    if "locked" in texto or "busy" in texto:
+        contar_metrica("venttos_sqlite_locked_total", endpoint=_endpoint_atual())
 
-    if "new_label_id" not in columns:
-        c.execute("ALTER TABLE movements ADD COLUMN new_label_id INTEGER;")
+class CursorMedido(sqlite3.Cursor):
+    """
+    Cursor que soma comandos e tempo de SQL na requisição atual e, com
+    CONSULTA_LENTA_MS ligado, manda para o log os comandos que passarem do limite.
+    """
+    _lenta = None   # [sql, parâmetros, segundos acumulados, executemany?] do último comando
+
+    def _medir(self, segundos, comandos):
+        _somar_sql(segundos, comandos)
+        if self._lenta is None:
+            return
+        self._lenta[2] += segundos
+        if self._lenta[2] * 1000 >= CONSULTA_LENTA_MS:
+            sql, parametros, total, muitos = self._lenta
+            self._lenta = None
+            registrar_consulta_lenta(self.connection, sql, parametros, total, muitos)
+
+    def _executar(self, metodo, sql, parametros, muitos):
+        if CONSULTA_LENTA_MS:
+            self._lenta = [sql, parametros, 0.0, muitos]
+        inicio = perf_counter()
+        try:
+            return metodo(sql, parametros)
+        except sqlite3.OperationalError as e:
+            _contar_lock(e)
+            raise
+        finally:
+            self._medir(perf_counter() - inicio, 1)
 
-    conn.commit()
-    conn.close()
+    def execute(self, sql, parameters=()):
+        return self._executar(super().execute, sql, parameters, False)
 
-def add_missing_table_ops():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    def executemany(self, sql, seq_of_parameters):
+        return self._executar(super().executemany, sql, seq_of_parameters, True)
 
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ops';")
-    if not c.fetchone():
-        c.execute('''
-            CREATE TABLE ops (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filial TEXT,
-                numero_op TEXT,
-                produto TEXT,
-                descricao TEXT,
-                armazem TEXT,
-                quantidade INTEGER,
-                produzido INTEGER,
-                setores TEXT,
-                created_at TEXT
-            )
-        ''')
-        conn.commit()
+    # um SELECT só termina de rodar enquanto as linhas são lidas
+    def fetchone(self):
+        inicio = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._medir(perf_counter() - inicio, 0)
 
-    conn.close()
+    def fetchmany(self, *args):
+        inicio = perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self._medir(perf_counter() - inicio, 0)
 
-def add_missing_table_ops_saldos():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    def fetchall(self):
+        inicio = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._medir(perf_counter() - inicio, 0)
 
-    # Se a tabela não existe, cria corretamente já com fase
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ops_saldos';")
-    if not c.fetchone():
-        c.execute("""
-            CREATE TABLE ops_saldos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_op INTEGER,
-                setor TEXT,
-                fase TEXT,                        
-                quantidade INTEGER DEFAULT 0,
-                updated_at TEXT,
-                FOREIGN KEY (id_op) REFERENCES ops(id)
-            );
-        """)
-        conn.commit()
-        conn.close()
-        return
+    def __next__(self):
+        inicio = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._medir(perf_counter() - inicio, 0)
 
-    # Se já existe, garantir que todas as colunas necessárias existem
-    c.execute("PRAGMA table_info(ops_saldos);")
-    columns = [col[1] for col in c.fetchall()]
+class ConexaoMedida(sqlite3.Connection):
+    """Conexão do app (connect_db): todo comando passa por CursorMedido."""
 
-    if "setor" not in columns:
-        c.execute("ALTER TABLE ops_saldos ADD COLUMN setor TEXT;")
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
 
-    if "fase" not in columns:
-        c.execute("ALTER TABLE ops_saldos ADD COLUMN fase TEXT;")   
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
-    if "quantidade" not in columns:
-        c.execute("ALTER TABLE ops_saldos ADD COLUMN quantidade INTEGER DEFAULT 0;")
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
 
-    conn.commit()
-    conn.close()
+    def commit(self):
+        inicio = perf_counter()
+        try:
+            return super().commit()
+        except sqlite3.OperationalError as e:
+            _contar_lock(e)
+            raise
+        finally:
+            _somar_sql(perf_counter() - inicio, 1)
+
+def _retrato_metricas():
+    with _metricas_lock:
+        return [
+            [nome, list(labels), valor if isinstance(valor, (int, float)) else list(valor)]
+            for (nome, labels), valor in _metricas.items()
+        ]
+
+def gravar_metricas():
+    """Grava o retrato deste processo em METRICAS_DIR (troca atômica do arquivo)."""
+    os.makedirs(METRICAS_DIR, exist_ok=True)
+    destino = os.path.join(METRICAS_DIR, f"{os.getpid()}.json")
+    tmp = f"{destino}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_retrato_metricas(), f)
+    os.replace(tmp, destino)
+
+def _metricas_loop():
+    while True:
+        sleep(METRICAS_INTERVALO)
+        try:
+            gravar_metricas()
+        except Exception:
+            app.logger.exception("Erro ao gravar métricas")
 
-def add_missing_table_op_alerts():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def iniciar_metricas():
+    if _metricas_estado["thread"] is not None:
+        return
+    with _metricas_lock:
+        if _metricas_estado["thread"] is None:
+            t = threading.Thread(target=_metricas_loop, name="metricas", daemon=True)
+            _metricas_estado["thread"] = t
+            t.start()
+
+def somar_retratos():
+    """Retratos de todos os workers (inclusive os que já saíram), somados."""
+    total = {}
+    for nome_arquivo in os.listdir(METRICAS_DIR):
+        if not nome_arquivo.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICAS_DIR, nome_arquivo), encoding="utf-8") as f:
+                itens = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for nome, labels, valor in itens:
+            if nome not in METRICAS:
+                continue
+            chave = (nome, tuple(tuple(par) for par in labels))
+            atual = total.get(chave)
+            if atual is None:
+                total[chave] = valor
+            elif isinstance(valor, list):
+                total[chave] = [a + b for a, b in zip(atual, valor)]
+            else:
+                total[chave] = atual + valor
+    return total
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS op_alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            id_op INTEGER,
-            setor TEXT,
-            fase TEXT,
-            meta INTEGER,
-            ativo INTEGER DEFAULT 1,
-            disparado INTEGER DEFAULT 0,
-            created_at TEXT,
-            FOREIGN KEY (id_op) REFERENCES ops(id)
+def _labels_prometheus(labels):
+    if not labels:
+        return ""
+    pares = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + pares + "}"
+
+def formatar_metricas(total):
+    """Texto no formato de exposição do Prometheus (0.0.4)."""
+    linhas = []
+    for nome, (tipo, descricao, baldes) in METRICAS.items():
+        series = sorted((labels, valor) for (n, labels), valor in total.items() if n == nome)
+        linhas.append(f"# HELP {nome} {descricao}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        for labels, valor in series:
+            if tipo == "counter":
+                linhas.append(f"{nome}{_labels_prometheus(labels)} {valor}")
+                continue
+            acumulado = 0
+            for limite, qtd in zip(baldes, valor):
+                acumulado += qtd
+                linhas.append(f"{nome}_bucket{_labels_prometheus(labels + (('le', repr(float(limite))),))} {acumulado}")
+            linhas.append(f"{nome}_bucket{_labels_prometheus(labels + (('le', '+Inf'),))} {valor[-1]}")
+            linhas.append(f"{nome}_sum{_labels_prometheus(labels)} {valor[-2]}")
+            linhas.append(f"{nome}_count{_labels_prometheus(labels)} {valor[-1]}")
+    return "\n".join(linhas) + "\n"
+
+@app.before_request
+def _iniciar_medicao():
+    g.metricas_inicio = perf_counter()
+    g.sql_comandos = 0
+    g.sql_segundos = 0.0
+    iniciar_metricas()
+
+@app.after_request
+def _registrar_medicao(response):
+    inicio = g.pop("metricas_inicio", None)
+    if inicio is not None:
+        endpoint = _endpoint_atual()
+        observar_metrica(
+            "venttos_http_request_duration_seconds", perf_counter() - inicio,
+            endpoint=endpoint, metodo=request.method, status=str(response.status_code)
         )
-    """)
+        observar_metrica("venttos_http_sql_statements", g.sql_comandos, endpoint=endpoint)
+        observar_metrica("venttos_http_sql_seconds", g.sql_segundos, endpoint=endpoint)
+    return response
 
-    conn.commit()
-    conn.close()
+@app.get("/metrics")
+def metrics():
+    # o retrato deste worker sai na hora; o dos outros tem até METRICAS_INTERVALO de atraso
+    gravar_metricas()
+    return app.response_class(
+        formatar_metricas(somar_retratos()),
+        mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
 
-def add_missing_table_push_subscriptions():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# ---------------- Consultas lentas ----------------
+# Opcional (CONSULTA_LENTA_MS > 0): todo comando que passar do limite vira uma
+# linha JSON em CONSULTA_LENTA_LOG, com o SQL, a impressão digital dos
+# parâmetros, a duração, a rota e o EXPLAIN QUERY PLAN. O arquivo gira por
+# tamanho; /debug/slow-queries agrupa as entradas por impressão digital.
+# A duração conta a execução e a leitura das linhas até o momento em que o
+# comando passou do limite.
+CONSULTA_LENTA_MS = float(os.environ.get("CONSULTA_LENTA_MS", 0))
+CONSULTA_LENTA_LOG = os.environ.get("CONSULTA_LENTA_LOG", "consultas_lentas.log")
+CONSULTA_LENTA_LOG_BYTES = int(os.environ.get("CONSULTA_LENTA_LOG_BYTES", 5 * 1024 * 1024))
+CONSULTA_LENTA_LOG_ARQUIVOS = int(os.environ.get("CONSULTA_LENTA_LOG_ARQUIVOS", 5))
+CONSULTA_LENTA_PLANOS = 256
+
+# só comandos com plano; BEGIN/COMMIT/SAVEPOINT/PRAGMA entram no log sem EXPLAIN
+_COM_PLANO = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_lentas_logger = logging.getLogger("venttos.consultas_lentas")
+_lentas_logger.propagate = False
+_lentas_planos = OrderedDict()
+_lentas_lock = threading.Lock()
+
+def _configurar_log_lentas():
+    with _lentas_lock:
+        if not _lentas_logger.handlers:
+            handler = RotatingFileHandler(
+                CONSULTA_LENTA_LOG,
+                maxBytes=CONSULTA_LENTA_LOG_BYTES,
+                backupCount=CONSULTA_LENTA_LOG_ARQUIVOS,
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _lentas_logger.addHandler(handler)
+            _lentas_logger.setLevel(logging.INFO)
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS push_subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            endpoint TEXT NOT NULL,
-            p256dh TEXT NOT NULL,
-            auth TEXT NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+def normalizar_sql(sql):
+    return " ".join(str(sql).split())
 
-    conn.commit()
-    conn.close()
+def _tipos_parametros(parametros):
+    if isinstance(parametros, dict):
+        return {k: type(v).__name__ for k, v in parametros.items()}
+    return [type(v).__name__ for v in parametros]
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+def impressao_digital(sql, tipos):
+    """Mesmo comando com valores diferentes -> mesma impressão digital."""
+    return hashlib.sha1(f"{sql}|{json.dumps(tipos, sort_keys=True)}".encode()).hexdigest()[:12]
+
+def _plano(conn, sql, parametros):
+    if not sql.upper().startswith(_COM_PLANO):
+        return None
+    with _lentas_lock:
+        if sql in _lentas_planos:
+            _lentas_planos.move_to_end(sql)
+            return _lentas_planos[sql]
+    try:
+        # Connection.execute da classe base: o EXPLAIN não entra nas métricas
+        linhas = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parametros).fetchall()
+        profundidade = {0: -1}
+        plano = []
+        for no, pai, _, detalhe in linhas:
+            profundidade[no] = profundidade.get(pai, -1) + 1
+            plano.append("  " * profundidade[no] + detalhe)
+    except sqlite3.Error as e:
+        return [f"(EXPLAIN falhou: {e})"]
+    with _lentas_lock:
+        _lentas_planos[sql] = plano
+        if len(_lentas_planos) > CONSULTA_LENTA_PLANOS:
+            _lentas_planos.popitem(last=False)
+    return plano
+
+def registrar_consulta_lenta(conn, sql, parametros, segundos, muitos=False):
+    _configurar_log_lentas()
+    sql = normalizar_sql(sql)
+    if muitos:
+        tipos, valores = ["executemany"], None
+        plano = None
+    else:
+        tipos = _tipos_parametros(parametros)
+        valores = hashlib.sha1(repr(parametros).encode()).hexdigest()[:12]
+        plano = _plano(conn, sql, parametros)
+
+    entrada = {
+        "ts": now_utc().isoformat(),
+        "ms": round(segundos * 1000, 2),
+        "impressao": impressao_digital(sql, tipos),
+        "sql": sql,
+        "parametros": tipos,
+        "valores": valores,
+        "rota": _endpoint_atual(),
+        "caminho": f"{request.method} {request.path}" if has_request_context() else threading.current_thread().name,
+        "pid": os.getpid(),
+        "plano": plano,
+    }
+    _lentas_logger.info(json.dumps(entrada, ensure_ascii=False))
+    contar_metrica("venttos_sql_lentas_total", endpoint=entrada["rota"])
+
+def ler_consultas_lentas():
+    """Entradas de todos os arquivos do log (o atual e os já girados)."""
+    entradas = []
+    for i in range(CONSULTA_LENTA_LOG_ARQUIVOS + 1):
+        caminho = CONSULTA_LENTA_LOG if i == 0 else f"{CONSULTA_LENTA_LOG}.{i}"
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                for linha in f:
+                    try:
+                        entradas.append(json.loads(linha))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return entradas
+
+def agrupar_consultas_lentas(entradas):
+    """Uma linha por impressão digital, da que mais somou tempo para a que menos somou."""
+    grupos = {}
+    for e in entradas:
+        g_ = grupos.get(e["impressao"])
+        if g_ is None:
+            g_ = grupos[e["impressao"]] = {
+                "impressao": e["impressao"], "sql": e["sql"], "parametros": e["parametros"],
+                "vezes": 0, "total_ms": 0.0, "max_ms": 0.0, "ultima": "",
+                "plano": None, "rotas": Counter(), "valores": set(),
+            }
+        g_["vezes"] += 1
+        g_["total_ms"] += e["ms"]
+        g_["max_ms"] = max(g_["max_ms"], e["ms"])
+        g_["rotas"][e["rota"]] += 1
+        if e.get("valores"):
+            g_["valores"].add(e["valores"])
+        if e["ts"] >= g_["ultima"]:
+            g_["ultima"] = e["ts"]
+            g_["plano"] = e.get("plano") or g_["plano"]
+
+    lista = sorted(grupos.values(), key=lambda g_: g_["total_ms"], reverse=True)
+    for g_ in lista:
+        g_["media_ms"] = g_["total_ms"] / g_["vezes"]
+        g_["rotas"] = g_["rotas"].most_common()
+        g_["valores"] = len(g_["valores"])
+    return lista
+
+@app.get("/debug/slow-queries")
+def debug_slow_queries():
+    if not CONSULTA_LENTA_MS:
+        abort(404)
+    limite = min(max(request.args.get("limite", 50, type=int), 1), 500)
+    entradas = ler_consultas_lentas()
+    return render_template(
+        "slow_queries.html",
+        grupos=agrupar_consultas_lentas(entradas)[:limite],
+        total=len(entradas),
+        limite_ms=CONSULTA_LENTA_MS,
+        formatar_data=formatar_data
+    )
+
+# ---------------- Pool de conexões ----------------
+# Um pool por processo (worker). Cada request pega uma conexão em get_db(), que
+# fica presa ao `g` até o teardown_appcontext devolvê-la ao pool. Os PRAGMAs são
+# aplicados uma única vez, quando a conexão é criada.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_CACHED_STATEMENTS = 256
+DB_TIMEOUT_MS = 10_000   # espera padrão pela trava de escrita
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_db_pool_pid = os.getpid()
+db_pool_stats = {"hits": 0, "misses": 0, "descartadas": 0}
+_db_pool_stats_lock = threading.Lock()
+
+def _contar_pool(chave):
+    with _db_pool_stats_lock:
+        db_pool_stats[chave] += 1
+
+def connect_db():
+    """Abre uma conexão nova já configurada (fora do pool)."""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+        factory=ConexaoMedida
+    )
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     return conn
 
-with app.app_context():
-    init_db()
-    add_missing_column()           # para models
-    add_missing_table_labels()     # para labels
-    add_missing_table_movements() 
-    add_missing_columns_movements()
-    add_new_label_id_column_movements() 
-    add_missing_table_ops()  
-    add_missing_table_ops_saldos() 
-    add_missing_table_op_alerts()
-    add_missing_table_push_subscriptions()
+def _reset_pool_apos_fork():
+    # conexões SQLite não podem atravessar um fork (ex.: gunicorn --preload)
+    global _db_pool, _db_pool_pid
+    if _db_pool_pid != os.getpid():
+        _db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        _db_pool_pid = os.getpid()
 
+def acquire_db():
+    _reset_pool_apos_fork()
+    try:
+        conn = _db_pool.get_nowait()
+        _contar_pool("hits")
+    except queue.Empty:
+        conn = connect_db()
+        _contar_pool("misses")
+    return conn
 
+def release_db(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+        _contar_pool("descartadas")
+
+def get_db():
+    """Conexão do request atual (a mesma em todas as chamadas dentro do request)."""
+    if "db" not in g:
+        g.db = acquire_db()
+    return g.db
+
+@app.teardown_appcontext
+def teardown_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        release_db(conn)
+
+# ---------------- Transações de escrita ----------------
+# O scan lê e grava dentro de um BEGIN IMMEDIATE curto: com vários workers, quem
+# pega a trava de escrita primeiro termina, e os outros leem o saldo já baixado.
+# A espera pela trava é curta (ESCRITA_ESPERA_MS, no busy handler do SQLite, que
+# não cede o worker gevent); passando dela, a transação inteira é refeita após um
+# recuo aleatório, até ESCRITA_TENTATIVAS vezes.
+ESCRITA_TENTATIVAS = int(os.environ.get("ESCRITA_TENTATIVAS", 10))
+ESCRITA_ESPERA_MS = int(os.environ.get("ESCRITA_ESPERA_MS", 100))
+ESCRITA_RECUO_MS = int(os.environ.get("ESCRITA_RECUO_MS", 10))
+ESCRITA_RECUO_MAX_MS = int(os.environ.get("ESCRITA_RECUO_MAX_MS", 500))
+
+class EtiquetaAlterada(Exception):
+    """A etiqueta mudou entre a leitura e a baixa do saldo (versão diferente)."""
+
+def banco_ocupado(erro):
+    return isinstance(erro, sqlite3.OperationalError) and (
+        getattr(erro, "sqlite_errorname", "") in ("SQLITE_BUSY", "SQLITE_LOCKED")
+        or "locked" in str(erro) or "busy" in str(erro)
+    )
+
+def transacao_escrita(conn, trabalho):
+    """
+    Roda trabalho(conn) num BEGIN IMMEDIATE e faz commit. Banco ocupado ou
+    EtiquetaAlterada desfazem tudo e repetem a transação (trabalho precisa ler
+    o que usa lá dentro); qualquer outro erro desfaz e sobe para o chamador.
+    """
+    conn.execute(f"PRAGMA busy_timeout = {ESCRITA_ESPERA_MS}")
+    try:
+        for tentativa in range(1, ESCRITA_TENTATIVAS + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                resultado = trabalho(conn)
+                conn.commit()
+                return resultado
+            except (sqlite3.OperationalError, EtiquetaAlterada) as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if isinstance(e, sqlite3.OperationalError) and not banco_ocupado(e):
+                    raise
+                if tentativa == ESCRITA_TENTATIVAS:
+                    raise
+                contar_metrica(
+                    "venttos_sqlite_busy_retries_total",
+                    endpoint=_endpoint_atual(),
+                    motivo="versao" if isinstance(e, EtiquetaAlterada) else "ocupado"
+                )
+                recuo = min(ESCRITA_RECUO_MAX_MS, ESCRITA_RECUO_MS * 2 ** tentativa)
+                sleep(random.uniform(0, recuo) / 1000)
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {DB_TIMEOUT_MS}")
 
 # ---------------- Regras de Ponto / Roteiro ----------------
 # Definir um mapeamento básico dos pontos para setores.
@@ -349,42 +1169,40 @@ POINT_RULES = {
     "Ponto-07": {"setor": "ESTOQUE", "type": "expedicao"},
 }
 
-def normalize_lote_from_qr(lote_sufixo):
-    """Converte o sufixo vindo do QR (ex: '08-504' ou '08-504-xyz') para o formato salvo '08 / 504' (aprox)."""
-    if not lote_sufixo:
+def partes_lote(lote):
+    """Lote salvo ('08 / 504') -> (8, '504'); (None, None) se não seguir o formato."""
+    m = re.fullmatch(r"\s*(\d+)\s*/\s*(.*?)\s*", lote or "")
+    if not m:
+        return None, None
+    return int(m.group(1)), m.group(2)
+
+def lote_do_qr(lote_sufixo):
+    """Sufixo vindo do QR ('08-504' ou '08-504-xyz') -> (8, '504'); (None, None) se inválido."""
+    parts = (lote_sufixo or "").split("-")
+    if len(parts) < 2 or not parts[0].strip().isdigit():
+        return None, None
+    return int(parts[0]), parts[1].strip()
+
+def find_label(conn, model_id, lote_seq, lote_padrao):
+    """Etiqueta do lote (a mais recente, se o lote já foi dividido) ou None."""
+    if lote_seq is None:
         return None
-    parts = lote_sufixo.split("-")
-    if len(parts) == 1:
-        return parts[0].replace('-', ' / ').strip()
-    first = parts[0].strip()
-    second = parts[1].strip() if len(parts) > 1 else ""
-    return f"{first} / {second}"
-
-def find_label(conn, model_id, lote_formatado):
-    """Procura uma label do model_id com lote exatamente igual (tente correspondência direta)."""
-    if not lote_formatado:
-        return None
-    cur = conn.execute("SELECT * FROM labels WHERE model_id=? AND lote=?", (model_id, lote_formatado)).fetchone()
-    if cur:
-        return dict(cur)
-    # tentativa de correspondência mais permissiva (removendo espaços)
-    simple = lote_formatado.replace(" ", "")
-    cur2 = conn.execute("SELECT * FROM labels WHERE model_id=? AND REPLACE(lote,' ','') LIKE ?", (model_id, f"%{simple}%")).fetchone()
-    if cur2:
-        return dict(cur2)
-    return None
-
-def register_movement(conn, model_id, label_id, new_label_id, ponto, acao, quantidade, from_setor, to_setor, fase, created_by="terminal_movimentacao"):
-    now = now_utc().isoformat()
+    row = conn.execute(SQL_LABEL_POR_LOTE, (model_id, lote_padrao, lote_seq)).fetchone()
+    return dict(row) if row else None
 
-    conn.execute("""
+def register_movement(conn, model_id, label_id, new_label_id, ponto, acao, quantidade, from_setor, to_setor, fase, created_by="terminal_movimentacao", root_label_id=None, client_at=None, client_scan_id=None):
+    agora = now_utc()
+    now = agora.isoformat()
+
+    cur = conn.execute("""
         INSERT INTO movements 
-            (model_id, label_id, new_label_id, ponto, acao, quantidade, from_setor, to_setor, fase, created_at, created_by)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (model_id, label_id, new_label_id, root_label_id, ponto, acao, quantidade, from_setor, to_setor, fase, created_at, created_ms, created_by, client_at, client_scan_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
         model_id,
         label_id,
         new_label_id,
+        root_label_id,
         ponto,
         acao,
         quantidade,
@@ -392,9 +1210,481 @@ def register_movement(conn, model_id, label_id, new_label_id, ponto, acao, quant
        to_setor,
         fase,
         now,
-        created_by
+        epoch_ms(agora),
+        created_by,
+        client_at,
+        client_scan_id
     ))
 
+    registrar_evento(conn, "movement", cur.lastrowid)
+
+    if acao == "PRODUCAO":
+        somar_producao_agregada(conn, model_id, to_setor, fase, quantidade)
+        somar_producao_hora(conn, model_id, from_setor, fase, quantidade, now)
+
+# ---------------- Consultas críticas ----------------
+# SQL dos caminhos quentes (scan, dashboard, OPs, live). Ficam aqui para que as
+# rotas e a verificação de planos (`flask check-query-plans`) usem o mesmo texto.
+SQL_MODEL_POR_CODIGO = "SELECT * FROM models WHERE UPPER(code)=?"
+
+SQL_LABEL_POR_LOTE = """
+    SELECT * FROM labels
+    WHERE model_id = ? AND lote_padrao = ? AND lote_seq = ?
+    ORDER BY id DESC
+    LIMIT 1
+"""
+
+# Faixa de lotes originais (sem as divisões) em ordem numérica, para reimpressão
+SQL_LABELS_FAIXA = """
+    SELECT lote FROM labels
+    WHERE model_id = ? AND lote_padrao = ? AND lote_seq BETWEEN ? AND ?
+      AND linked_label_id IS NULL
+    ORDER BY lote_seq
+"""
+
+# Uma etiqueta e todas as suas filhas (qualquer profundidade) compartilham a
+# raiz; para PRODUCAO o índice único ux_movements_producao garante a regra.
+SQL_MOVIMENTO_DUPLICADO = """
+    SELECT 1
+    FROM movements
+    WHERE root_label_id = ?
+      AND ponto = ?
+      AND acao = ?
+      AND UPPER(TRIM(fase)) = ?
+    LIMIT 1
+"""
+
+# Scan já aplicado com este id do terminal (reenvio)
+SQL_MOVIMENTO_POR_SCAN = """
+    SELECT acao, quantidade, new_label_id
+    FROM movements
+    WHERE client_scan_id = ?
+"""
+
+SQL_OP_POR_PRODUTO = "SELECT id FROM ops WHERE numero_op = ? AND produto = ?"
+
+# Despacho de push: há envio vencido? Só leitura — com a fila vazia (o normal)
+# o despacho não pega a trava de escrita (ver _reservar_push)
+SQL_PUSH_VENCIDO = """
+    SELECT 1 FROM push_fila
+    WHERE status IN ('PENDENTE', 'ENVIANDO') AND proxima_tentativa <= ?
+    LIMIT 1
+"""
+
+SQL_PRODUZIDO_SETOR = """
+    SELECT COALESCE(SUM(quantidade),0)
+    FROM producao_agregada
+    WHERE id_op = ?
+    AND setor = ?
+    AND fase = ?
+"""
+
+SQL_ALERTAS_PENDENTES = """
+    SELECT * FROM op_alerts
+    WHERE id_op = ?
+      AND setor = ?
+      AND fase = ?
+      AND ativo = 1
+      AND disparado = 0
+      AND meta <= ?
+"""
+
+# Uma linha por etiqueta ativa (ou uma linha só com o model, se não houver
+# nenhuma). Status e textos TOP/BOTTOM já saem prontos do SQL.
+SQL_DASHBOARD = """
+    SELECT
+        m.*,
+        l.id AS l_id,
+        COALESCE(NULLIF(l.setor_atual, ''), 'SEM SETOR') AS l_setor,
+        UPPER(TRIM(COALESCE(l.fase, ''))) AS l_fase,
+        COALESCE(l.remaining, 0) AS l_saldo,
+        COALESCE(l.producao_total, 0) AS l_total,
+        CASE
+            WHEN UPPER(TRIM(COALESCE(l.fase, ''))) = 'DISPONIVEL' THEN 'DISPONIVEL'
+            WHEN SUBSTR(UPPER(TRIM(COALESCE(l.fase, ''))), 1, 10) = 'AGUARDANDO' THEN 'AGUARDANDO'
+            WHEN UPPER(TRIM(COALESCE(l.fase, ''))) = 'PENDENTE CQ' THEN 'PENDENTE CQ'
+            WHEN UPPER(TRIM(COALESCE(l.fase, ''))) = 'CQ APROVOU' THEN 'CQ APROVOU'
+            WHEN UPPER(TRIM(COALESCE(l.fase, ''))) IN ('EXPEDIDO', 'EXPEDICAO') THEN 'QUALIDADE'
+            ELSE 'AGUARDANDO'
+        END AS l_status,
+        CASE
+            WHEN UPPER(TRIM(COALESCE(m.phase_type, ''))) = 'TOP ONLY'
+            THEN '⬜ (' || COALESCE(l.top_done, 0) || '/' || COALESCE(l.producao_total, 0) || ')'
+            ELSE ' (' || COALESCE(l.top_done, 0) || '/' || COALESCE(l.producao_total, 0) || ')'
+        END AS l_status_top,
+        CASE
+            WHEN UPPER(TRIM(COALESCE(m.phase_type, ''))) = 'TOP ONLY' THEN 'N/A'
+            ELSE ' (' || COALESCE(l.bottom_done, 0) || '/' || COALESCE(l.producao_total, 0) || ')'
+        END AS l_status_bottom
+    FROM models m
+    LEFT JOIN labels l ON l.model_id = m.id AND l.remaining > 0
+    ORDER BY m.model_name, m.id, l.id
+"""
+
+# Marca d'água do que o dashboard mostra: muda a cada movimentação, etiqueta
+# nova/alterada/removida (ativa) e model novo/editado.
+SQL_DASHBOARD_VERSAO = """
+    SELECT
+        (SELECT MAX(id) FROM movements),
+        (SELECT MAX(id) FROM labels),
+        (SELECT MAX(updated_ms) FROM labels),
+        (SELECT COUNT(*) FROM labels WHERE remaining > 0),
+        (SELECT MAX(id) FROM models),
+        (SELECT MAX(updated_ms) FROM models)
+"""
+
+_SQL_OPS_LINHAS = """
+    SELECT
+        o.id AS id,
+        s.id AS saldo_id,
+        o.filial,
+        o.numero_op,
+        o.produto,
+        o.descricao,
+        o.armazem,
+        o.quantidade,
+
+        -- total produzido da OP (soma dos contadores de producao_agregada)
+        COALESCE((
+            SELECT SUM(pt.quantidade)
+            FROM producao_agregada pt
+            WHERE pt.id_op = o.id
+        ), 0) AS produzido_total,
+
+        -- setor + fase (linha)
+        s.setor,
+        s.fase,
+
+        -- produzido real por setor + fase
+        COALESCE(pa.quantidade, 0) AS produzido_setor,
+
+        -- saldo planejado (ops_saldos) — valor inicial que você cadastrou (aqui mantido separadamente)
+        s.quantidade AS saldo_planejado
+
+    FROM ops o
+    LEFT JOIN ops_saldos s ON o.id = s.id_op
+    LEFT JOIN producao_agregada pa
+           ON pa.id_op = o.id
+          AND pa.setor = s.setor
+          AND pa.fase = UPPER(TRIM(s.fase))
+    {filtro}
+    ORDER BY
+        o.id DESC,
+        s.setor,
+        s.fase
+"""
+
+SQL_BUSCAR_OPS = _SQL_OPS_LINHAS.format(filtro="")
+
+# mesmas linhas, só das OPs informadas (lista JSON de ids) — usada pelo delta
+SQL_OPS_LINHAS_DE = _SQL_OPS_LINHAS.format(filtro="WHERE o.id IN (SELECT value FROM json_each(?))")
+
+SQL_LIVE = """
+    SELECT
+        m.code                  AS modelo,
+        m.cliente               AS cliente,
+        m.op                    AS op,
+        SUM(ph.quantidade)      AS produzido,
+        NULLIF(ph.setor, '')    AS setor,
+        MAX(ph.ultima)          AS last_update
+    FROM producao_hora ph
+    JOIN models m ON m.id = ph.model_id
+    WHERE ph.hora_utc BETWEEN ? AND ?
+    GROUP BY m.code, m.cliente, m.op, ph.setor
+    ORDER BY last_update DESC
+"""
+
+SQL_LIVE_CONSULTAR = """
+    SELECT
+        ph.hora,
+        ph.turno,
+        ph.fase,
+        SUM(ph.quantidade) AS quantidade
+    FROM producao_hora ph
+    JOIN models m ON m.id = ph.model_id
+    WHERE m.op = ?
+      AND ph.hora_utc BETWEEN ? AND ?
+    GROUP BY ph.hora_utc, ph.turno, ph.fase
+    ORDER BY ph.hora_utc, ph.turno
+"""
+
+# Registros detalhados do /live/consultar: só os mais recentes (a soma por hora
+# e os totais vêm de producao_hora, não desta lista)
+LIVE_REGISTROS_LIMITE = 500
+
+SQL_LIVE_REGISTROS = """
+    SELECT
+        mv.created_ms,
+        mv.quantidade,
+        mv.from_setor,
+        mv.fase,
+        mv.created_by
+    FROM movements mv
+    JOIN models m ON m.id = mv.model_id
+    WHERE m.op = ?
+      AND mv.created_ms BETWEEN ? AND ?
+      AND UPPER(mv.acao) = 'PRODUCAO'
+    ORDER BY mv.created_ms DESC
+    LIMIT ?
+"""
+
+SQL_HISTORICO_DO_MODEL = "SELECT * FROM history WHERE model_id=? ORDER BY changed_ms DESC LIMIT 10"
+
+SQL_LABELS_DO_MODEL = "SELECT * FROM labels WHERE model_id=? ORDER BY created_ms DESC"
+
+SQL_MOVEMENTS_DO_MODEL = "SELECT * FROM movements WHERE model_id=? ORDER BY created_ms DESC LIMIT 50"
+
+# OPs cujos contadores mudam com os movimentos informados (lista JSON de ids)
+SQL_OPS_DOS_MOVIMENTOS = """
+    SELECT DISTINCT o.id
+    FROM movements mv
+    JOIN ops o ON o.model_id = mv.model_id
+    WHERE mv.id IN (SELECT value FROM json_each(?))
+"""
+
+# Versão da listagem de models (ETag): dois MAX no mesmo SELECT viram
+# varredura; em subconsultas, cada um é uma busca no índice
+SQL_MODELS_VERSAO = "SELECT (SELECT MAX(id) FROM models), (SELECT MAX(updated_ms) FROM models)"
+
+# Listagem de models por cursor (keyset): "antes" é o menor id já exibido, e a
+# página seguinte começa logo abaixo dele, pelo índice da chave primária
+SQL_MODELS_PAGINA = """
+    SELECT * FROM models
+    WHERE id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+# Busca na listagem: mesma ordem e cursor, filtrando pelo índice FTS; os
+# trechos encontrados vêm marcados com \x02...\x03 (ver destacar())
+SQL_MODELS_PAGINA_BUSCA = """
+    SELECT
+        m.*,
+        highlight(models_fts, 0, char(2), char(3)) AS code_destaque,
+        highlight(models_fts, 1, char(2), char(3)) AS model_name_destaque,
+        highlight(models_fts, 2, char(2), char(3)) AS cliente_destaque
+    FROM models_fts
+    JOIN models m ON m.id = models_fts.rowid
+    WHERE models_fts MATCH ?
+      AND models_fts.rowid < ?
+    ORDER BY models_fts.rowid DESC
+    LIMIT ?
+"""
+
+# Type-ahead: melhores resultados primeiro (bm25 com os pesos da migração).
+# Um termo curto pode casar com o catálogo inteiro, então relevância e
+# highlight são calculados só entre os `candidatos` mais recentes, numa única
+# passada do índice; assim o custo não cresce com o catálogo.
+SQL_MODELS_SUGESTOES = """
+    SELECT
+        m.id, m.code, m.model_name, m.cliente, m.op,
+        c.code_destaque, c.model_name_destaque, c.cliente_destaque, c.op_destaque
+    FROM (
+        SELECT
+            rowid AS id,
+            rank,
+            highlight(models_fts, 0, char(2), char(3)) AS code_destaque,
+            highlight(models_fts, 1, char(2), char(3)) AS model_name_destaque,
+            highlight(models_fts, 2, char(2), char(3)) AS cliente_destaque,
+            highlight(models_fts, 3, char(2), char(3)) AS op_destaque
+        FROM models_fts
+        WHERE models_fts MATCH :consulta
+        ORDER BY rowid DESC
+        LIMIT :candidatos
+    ) c
+    JOIN models m ON m.id = c.id
+    ORDER BY c.rank
+    LIMIT :limite
+"""
+
+# (nome, sql, parâmetros de exemplo, aliases que podem ser varridos por inteiro).
+# Só listagens completas (ex.: todas as OPs) podem declarar varredura permitida.
+CONSULTAS_CRITICAS = [
+    ("movimentar: model por código", SQL_MODEL_POR_CODIGO, ("ABC",), ()),
+    ("movimentar: etiqueta por lote", SQL_LABEL_POR_LOTE, (1, "504", 1), ()),
+    ("reimpressão: faixa de lotes", SQL_LABELS_FAIXA, (1, "504", 10, 40), ()),
+    ("movimentar: bloqueio duplicado", SQL_MOVIMENTO_DUPLICADO, (1, "Ponto-02", "PRODUCAO", "TOP"), ()),
+    ("movimentar: reenvio do terminal", SQL_MOVIMENTO_POR_SCAN, ("a1b2",), ()),
+    ("push: fila vencida", SQL_PUSH_VENCIDO, ("2025-01-01T00:00:00",), ()),
+    ("movimentar: OP do modelo", SQL_OP_POR_PRODUTO, ("OP1", "ABC"), ()),
+    ("movimentar: produzido por setor", SQL_PRODUZIDO_SETOR, (1, "SMT", "TOP"), ()),
+    ("verificar_alertas_op", SQL_ALERTAS_PENDENTES, (1, "SMT", "TOP", 10), ()),
+    ("dashboard", SQL_DASHBOARD, (), ()),
+    ("dashboard: versão", SQL_DASHBOARD_VERSAO, (), ()),
+    ("buscar_ops", SQL_BUSCAR_OPS, (), ("o",)),
+    ("live", SQL_LIVE, ("2025-01-01T00:00:00", "2025-01-01T23:59:59"), ()),
+    ("live_consultar", SQL_LIVE_CONSULTAR, ("OP1", "2025-01-01T00:00:00", "2025-01-01T23:59:59"), ()),
+    ("live_consultar: registros", SQL_LIVE_REGISTROS, ("OP1", 1735689600000, 1735775999999, 500), ()),
+    ("history: alterações", SQL_HISTORICO_DO_MODEL, (1,), ()),
+    ("history: etiquetas", SQL_LABELS_DO_MODEL, (1,), ()),
+    ("history: movimentações", SQL_MOVEMENTS_DO_MODEL, (1,), ()),
+    ("index: versão da listagem", SQL_MODELS_VERSAO, (), ()),
+    ("index: página de models", SQL_MODELS_PAGINA, (100, 51), ()),
+    ("index: busca de models", SQL_MODELS_PAGINA_BUSCA, ('"abc"*', 100, 51), ("models_fts",)),
+    ("type-ahead de models", SQL_MODELS_SUGESTOES,
+     {"consulta": '"abc"*', "candidatos": 200, "limite": 8}, ("models_fts", "c")),
+    ("delta: linhas de OPs", SQL_OPS_LINHAS_DE, ("[1, 2]",), ("json_each",)),
+    ("delta: OPs dos movimentos", SQL_OPS_DOS_MOVIMENTOS, ("[1, 2]",), ("json_each",)),
+]
+
+def verificar_planos(conn):
+    """
+    Roda EXPLAIN QUERY PLAN em cada consulta crítica e devolve [(nome, detalhe)]
+    das que caíram em varredura completa (SCAN sem índice).
+    """
+    falhas = []
+    for nome, sql, params, permitidas in CONSULTAS_CRITICAS:
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detalhe = row[3]
+            if not detalhe.startswith("SCAN ") or " USING " in detalhe:
+                continue
+            if detalhe == "SCAN CONSTANT ROW":
+                continue
+            if detalhe.split()[1] in permitidas:
+                continue
+            falhas.append((nome, detalhe))
+    return falhas
+
+@app.cli.command("check-query-plans")
+@click.option("--db", "db_path", default=None,
+              help="Banco a verificar (padrão: banco novo com todas as migrações).")
+def check_query_plans_command(db_path):
+    """Falha se alguma consulta crítica fizer SCAN em vez de usar índice."""
+    with tempfile.TemporaryDirectory() as tmp:
+        if not db_path:
+            db_path = os.path.join(tmp, "planos.db")
+            migrar_db(db_path)
+        conn = sqlite3.connect(db_path)
+        try:
+            falhas = verificar_planos(conn)
+        finally:
+            conn.close()
+
+    for nome, detalhe in falhas:
+        print(f"❌ {nome}: {detalhe}")
+    if falhas:
+        raise SystemExit(1)
+    print(f"✅ {len(CONSULTAS_CRITICAS)} consultas críticas usando índices.")
+
+# ---------------- Feed de mudanças (SSE) ----------------
+# As rotas gravam em `eventos` na mesma transação da mudança. Em cada worker,
+# uma única thread lê os eventos novos e distribui para as conexões abertas em
+# /api/stream — o custo no banco não cresce com o número de telas.
+SSE_INTERVALO = float(os.environ.get("SSE_INTERVALO", 1.0))
+SSE_KEEPALIVE = 15
+EVENTOS_RETIDOS = 10000
+TIPOS_EVENTO = ("movement", "model", "label", "op")
+
+_sse_clientes = set()
+_sse_lock = threading.Lock()
+_sse_estado = {"thread": None, "ultimo_id": 0}
+
+def registrar_evento(conn, tipo, ref_id):
+    cur = conn.execute(
+        "INSERT INTO eventos (tipo, ref_id, created_at) VALUES (?, ?, ?)",
+        (tipo, ref_id, now_utc().isoformat())
+    )
+    # poda ocasional, aproveitando a transação de escrita que já está aberta
+    if cur.lastrowid % 1000 == 0:
+        conn.execute("DELETE FROM eventos WHERE id <= ?", (cur.lastrowid - EVENTOS_RETIDOS,))
+
+def _eventos_desde(conn, ultimo_id, limite=500):
+    return [dict(r) for r in conn.execute(
+        "SELECT id, tipo, ref_id FROM eventos WHERE id > ? ORDER BY id LIMIT ?",
+        (ultimo_id, limite)
+    )]
+
+def _sse_loop():
+    conn = connect_db()
+    try:
+        _sse_estado["ultimo_id"] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM eventos").fetchone()[0]
+        while True:
+            with _sse_lock:
+                if not _sse_clientes:
+                    _sse_estado["thread"] = None
+                    return
+                clientes = list(_sse_clientes)
+
+            novos = _eventos_desde(conn, _sse_estado["ultimo_id"])
+            for ev in novos:
+                for q in clientes:
+                    q.put(ev)
+            if novos:
+                _sse_estado["ultimo_id"] = novos[-1]["id"]
+            else:
+                sleep(SSE_INTERVALO)
+    except Exception:
+        # os clientes recebem None e voltam para o polling
+        app.logger.exception("Erro no feed de eventos")
+        with _sse_lock:
+            _sse_estado["thread"] = None
+            for q in _sse_clientes:
+                q.put(None)
+    finally:
+        conn.close()
+
+def _sse_inscrever(q):
+    with _sse_lock:
+        _sse_clientes.add(q)
+        if _sse_estado["thread"] is None:
+            t = threading.Thread(target=_sse_loop, name="sse-eventos", daemon=True)
+            _sse_estado["thread"] = t
+            t.start()
+
+def _sse_cancelar(q):
+    with _sse_lock:
+        _sse_clientes.discard(q)
+
+def _sse_formatar(ev):
+    dados = json.dumps({"id": ev["ref_id"], "evento": ev["id"]})
+    return f"id: {ev['id']}\nevent: {ev['tipo']}\ndata: {dados}\n\n"
+
+@app.get("/api/stream")
+def api_stream():
+    ultimo = request.headers.get("Last-Event-ID") or request.args.get("desde")
+    try:
+        ultimo = int(ultimo) if ultimo else None
+    except ValueError:
+        ultimo = None
+
+    q = queue.Queue()
+    _sse_inscrever(q)
+
+    def gerar():
+        enviado = 0
+        try:
+            yield "retry: 3000\n\n"
+
+            # reconexão: reenvia o que foi perdido enquanto o cliente estava fora
+            if ultimo is not None:
+                conn = acquire_db()
+                try:
+                    perdidos = _eventos_desde(conn, ultimo)
+                finally:
+                    release_db(conn)
+                for ev in perdidos:
+                    enviado = ev["id"]
+                    yield _sse_formatar(ev)
+
+            while True:
+                try:
+                    ev = q.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if ev is None:
+                    return
+                if ev["id"] <= enviado:
+                    continue
+                enviado = ev["id"]
+                yield _sse_formatar(ev)
+        finally:
+            _sse_cancelar(q)
+
+    resp = app.response_class(gerar(), mimetype="text/event-stream")
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
 @app.context_processor
 def inject_current_year():
     return {
@@ -403,53 +1693,92 @@ def inject_current_year():
 
 # ---------------- Rotas ----------------
 
-@app.route("/")
-def index():
+# ---------------- Listagem de models (paginada) ----------------
+MODELS_PAGINA = int(os.environ.get("MODELS_PAGINA", 50))
+MODELS_PAGINA_MAX = 500
+SEM_CURSOR = 2 ** 63 - 1
+
+def parametros_pagina():
+    """(antes, limite, search) da query string, com limite entre 1 e MODELS_PAGINA_MAX."""
+    antes = request.args.get("antes", type=int) or SEM_CURSOR
+    limite = request.args.get("limite", MODELS_PAGINA, type=int)
+    limite = max(1, min(limite, MODELS_PAGINA_MAX))
     search = request.args.get("search", "").strip()
-    conn = get_db()
-    if search:
-        query = """
-            SELECT * FROM models 
-            WHERE code LIKE ? OR model_name LIKE ? OR cliente LIKE ?
-            ORDER BY id DESC
-        """
-        models = conn.execute(query, (f"%{search}%", f"%{search}%", f"%{search}%")).fetchall()
-    else:
-        models = conn.execute("SELECT * FROM models ORDER BY id DESC").fetchall()
-    conn.close()
+    return antes, limite, search
 
-    def format_updated_at(value):
-        if not value:
-            return ""
-        try:
-            s = str(value).replace("T", " ")
-            s_short = s.split(".")[0].split("+")[0].split("Z")[0].strip()
-            dt_local = parse_utc(value).astimezone(ZoneInfo("America/Manaus"))
-            return dt_local.strftime("%d/%m/%Y às %H:%M:%S")
+def consulta_fts(search):
+    """
+    Texto digitado -> expressão MATCH do FTS5: todas as palavras precisam
+    aparecer, e a última (ainda sendo digitada) vale como prefixo
+    ("abc 50" acha "ABC-123 / lote 01 / 504"). None se não sobrar palavra.
+    """
+    palavras = re.findall(r"\w+", search.lower())
+    if not palavras:
+        return None
+    # prefixo custa caro em palavra comum; as anteriores já estão completas
+    termos = [f'"{p}"' for p in palavras[:-1]] + [f'"{palavras[-1]}"*']
+    return " ".join(termos)
 
-        except:
-            try:
-                dt2 = datetime.fromisoformat(str(value))
-                return dt2.strftime("%d/%m/%Y às %H:%M:%S")
-            except:
-                return str(value)
+def destacar(texto):
+    """Trecho do highlight() do FTS -> HTML escapado com <mark> nos acertos."""
+    if texto is None:
+        return None
+    return Markup(str(escape(texto)).replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
+def buscar_models_pagina(conn, antes, limite, search=""):
+    """
+    Uma página de models (id decrescente, abaixo de `antes`).
+    Retorna (models, proximo): `proximo` é o cursor da página seguinte, ou None na última.
+    Com `search`, filtra pelo índice FTS e acrescenta "destaque" (HTML) por coluna.
+    """
+    consulta = consulta_fts(search) if search else None
+
+    # um a mais só para saber se existe próxima página
+    if consulta:
+        rows = conn.execute(SQL_MODELS_PAGINA_BUSCA, (consulta, antes, limite + 1)).fetchall()
+    else:
+        rows = conn.execute(SQL_MODELS_PAGINA, (antes, limite + 1)).fetchall()
 
-    models = [dict(m) for m in models]
+    models = [dict(r) for r in rows[:limite]]
     for m in models:
-        m["updated_at_formatted"] = format_updated_at(m.get("updated_at"))
+        m["updated_at_formatted"] = formatar_data(m.get("updated_ms") or m.get("updated_at"))
+        if consulta:
+            m["destaque"] = {
+                col: destacar(m.pop(f"{col}_destaque"))
+                for col in ("code", "model_name", "cliente")
+            }
+
+    proximo = models[-1]["id"] if len(rows) > limite else None
+    return models, proximo
+
+@app.route("/")
+def index():
+    antes, limite, search = parametros_pagina()
+    conn = get_db()
+    # lida antes da lista: um evento no meio é só reaplicado pelo delta
+    versao = versao_eventos(conn)
+    models, proximo = buscar_models_pagina(conn, antes, limite, search)
 
-    return render_template("index.html", models=models, search=search)
+    return render_template(
+        "index.html",
+        models=models,
+        search=search,
+        proximo=proximo,
+        limite=limite,
+        versao=versao
+    )
 
 @app.route("/new", methods=["GET", "POST"])
 def new():
     if request.method == "POST":
         f = request.form
         conn = get_db()
+        agora = now_utc()
         try:
-            conn.execute(
+            cur = conn.execute(
                 """INSERT INTO models 
-                    (code, model_name, cliente, linha, setor, fase, phase_type, turno, data, lote, quantidade, revisora, operadora, horario, po, op, status_cq, processo, obs, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (code, model_name, cliente, linha, setor, fase, phase_type, turno, data, lote, quantidade, revisora, operadora, horario, po, op, status_cq, processo, obs, created_at, updated_at, created_ms, updated_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     """,
                 (
                     f.get("code", ""),
@@ -471,19 +1800,20 @@ def new():
                     ",".join(request.form.getlist("status_cq")),
                     ",".join(request.form.getlist("processo")),
                     f.get("obs", ""),
-                    now_utc().isoformat(),
-                    now_utc().isoformat()
-
+                    agora.isoformat(),
+                    agora.isoformat(),
+                    epoch_ms(agora),
+                    epoch_ms(agora)
                 )
             )
+            vincular_ops_do_model(conn, cur.lastrowid)
+            registrar_evento(conn, "model", cur.lastrowid)
             conn.commit()
 
             flash("Modelo cadastrado com sucesso!", "success")
         except sqlite3.Error as e:
             flash(f"Erro ao salvar: {e}", "danger")
 
-        finally:
-            conn.close()
         return redirect(url_for("index"))
     return render_template("form.html", model=None)
 
@@ -493,7 +1823,6 @@ def edit(id):
     try:
         model = conn.execute("SELECT * FROM models WHERE id=?", (id,)).fetchone()
         if not model:
-            conn.close()
             abort(404)
 
         # -----------------------------------------------
@@ -505,12 +1834,13 @@ def edit(id):
             lote_num = f.get("lote_num", "").strip()
             lote_padrao = f.get("lote_padrao", "").strip()
             lote_final = f"{lote_num} / {lote_padrao}"
+            agora = now_utc()
 
             try:
                 conn.execute("""
                     UPDATE models 
                     SET code=?, model_name=?, cliente=?, linha=?, setor=?, fase=?, phase_type=?, turno=?, data=?, 
-                        lote=?, quantidade=?, revisora=?, operadora=?, horario=?, po=?, op=?, status_cq=?, processo=?, obs=?, updated_at=?
+                        lote=?, quantidade=?, revisora=?, operadora=?, horario=?, po=?, op=?, status_cq=?, processo=?, obs=?, updated_at=?, updated_ms=?
                     WHERE id=?
                 """, (
                     f["code"],
@@ -532,7 +1862,8 @@ def edit(id):
                     ",".join(request.form.getlist("status_cq")),
                     ",".join(request.form.getlist("processo")),
                     f["obs"],
-                    now_utc().isoformat(),
+                    agora.isoformat(),
+                    epoch_ms(agora),
                     id
                 ))
             except sqlite3.IntegrityError:
@@ -541,9 +1872,11 @@ def edit(id):
 
             # REGISTRAR HISTÓRICO
             conn.execute(
-                "INSERT INTO history (model_id, changed_at, changed_by, change_text) VALUES (?, ?, ?, ?)",
-                (id, now_utc().isoformat(), "web_user", "Edição de modelo")
+                "INSERT INTO history (model_id, changed_at, changed_ms, changed_by, change_text) VALUES (?, ?, ?, ?, ?)",
+                (id, agora.isoformat(), epoch_ms(agora), "web_user", "Edição de modelo")
             )
+            vincular_ops_do_model(conn, id)
+            registrar_evento(conn, "model", id)
 
             conn.commit()
             flash("Modelo atualizado com sucesso!", "success")
@@ -567,9 +1900,167 @@ def edit(id):
     except Exception as e:
         print("Erro no edit():", e)
         raise e
+
+# ---------------- Geração de etiquetas ----------------
+# Até LABELS_LIMITE_SINCRONO etiquetas a geração é feita no próprio request;
+# acima disso vira um job em segundo plano (label_jobs), gravado em blocos de
+# LABELS_BLOCO para não segurar o lock de escrita do SQLite por segundos.
+# Cada bloco grava as etiquetas e `feitos` no mesmo commit, então um job que
+# parou (erro, ou o worker morreu no meio) é retomado de onde estava: quando a
+# tela consulta o job e quando um worker novo sobe.
+LABELS_LIMITE_SINCRONO = int(os.environ.get("LABELS_LIMITE_SINCRONO", 200))
+LABELS_BLOCO = 250
+LABELS_JOB_TENTATIVAS = int(os.environ.get("LABELS_JOB_TENTATIVAS", 3))
+LABELS_JOB_PARADO = int(os.environ.get("LABELS_JOB_PARADO", 60))   # s sem avançar = worker morreu
+
+_label_jobs_estado = {"verificado_pid": None}
+_label_jobs_lock = threading.Lock()
+
+# Só um processo assume o job: quem conseguir este UPDATE
+SQL_ASSUMIR_LABEL_JOB = """
+    UPDATE label_jobs
+    SET status = 'EXECUTANDO', erro = NULL, tentativas = tentativas + 1, updated_at = ?
+    WHERE id = ?
+      AND tentativas < ?
+      AND (status IN ('PENDENTE', 'ERRO') OR (status = 'EXECUTANDO' AND updated_at < ?))
+"""
+
+def lote_inicial_padrao(model):
+    try:
+        parte_num, parte_padrao = model['lote'].split('/')[:2]
+        return int(parte_num.strip()), parte_padrao.strip()
+    except:
+        return 1, "900"
+
+def planejar_lotes(lote_inicial, padrao, producao_total, capacidade_magazine):
+    """[(lote, quantidade)] — uma etiqueta por magazine, a última com o resto."""
+    total_etiquetas = (producao_total + capacidade_magazine - 1) // capacidade_magazine
+    return [
+        (
+            f"{lote_inicial + i:02d} / {padrao}",
+            min(capacidade_magazine, producao_total - i * capacidade_magazine)
+        )
+        for i in range(max(total_etiquetas, 0))
+    ]
+
+def inserir_labels(conn, model, plano, capacidade_magazine, agora):
+    """Insere as etiquetas do plano num único executemany; devolve o id da última."""
+    conn.executemany("""
+        INSERT INTO labels
+        (model_id, lote, lote_seq, lote_padrao, producao_total, capacidade_magazine, remaining,
+         created_at, created_ms, setor_atual, fase)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (
+            model["id"], lote, *partes_lote(lote), amount, capacidade_magazine, amount,
+            agora.isoformat(), epoch_ms(agora),
+            model["setor"] or "PTH",
+            "AGUARDANDO"
+        )
+        for lote, amount in plano
+    ])
+    return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+def _plano_do_job(job):
+    return planejar_lotes(job["lote_inicial"], job["padrao"], job["producao_total"], job["capacidade_magazine"])
+
+def _label_job_parado(job, parado_desde):
+    if job["status"] == "CONCLUIDO":
+        return False
+    if job["status"] == "EXECUTANDO":
+        return (job["updated_at"] or "") < parado_desde
+    return True
+
+def retomar_label_job(conn, job_id):
+    """
+    Inicia o job (ou o reinicia a partir de `feitos`) se ele estiver PENDENTE, em
+    ERRO ou EXECUTANDO sem avançar há LABELS_JOB_PARADO segundos, enquanto houver
+    tentativas. Sem tentativas, um EXECUTANDO abandonado vira ERRO, para a tela
+    parar de esperar. Devolve a linha atual do job (None se não existir).
+    """
+    job = conn.execute("SELECT * FROM label_jobs WHERE id = ?", (job_id,)).fetchone()
+    agora = now_utc()
+    parado_desde = (agora - timedelta(seconds=LABELS_JOB_PARADO)).isoformat()
+    if not job or not _label_job_parado(job, parado_desde):
+        return job
+
+    cur = conn.execute(
+        SQL_ASSUMIR_LABEL_JOB,
+        (agora.isoformat(), job_id, LABELS_JOB_TENTATIVAS, parado_desde)
+    )
+    assumido = cur.rowcount == 1
+    if not assumido:
+        conn.execute("""
+            UPDATE label_jobs
+            SET status = 'ERRO', erro = 'Job interrompido', updated_at = ?
+            WHERE id = ? AND status = 'EXECUTANDO' AND updated_at < ?
+        """, (agora.isoformat(), job_id, parado_desde))
+    conn.commit()
+
+    if assumido:
+        threading.Thread(target=_executar_label_job, args=(job_id,), daemon=True).start()
+    return conn.execute("SELECT * FROM label_jobs WHERE id = ?", (job_id,)).fetchone()
+
+@app.before_request
+def _retomar_label_jobs():
+    # uma vez por processo: jobs que ficaram pela metade num worker anterior
+    if _label_jobs_estado["verificado_pid"] == os.getpid():
+        return
+    with _label_jobs_lock:
+        if _label_jobs_estado["verificado_pid"] == os.getpid():
+            return
+        _label_jobs_estado["verificado_pid"] = os.getpid()
+    conn = get_db()
+    for row in conn.execute("SELECT id FROM label_jobs WHERE status <> 'CONCLUIDO'").fetchall():
+        retomar_label_job(conn, row["id"])
+
+def _executar_label_job(job_id):
+    """Roda o job já assumido (retomar_label_job), a partir de `feitos`."""
+    conn = connect_db()
+    try:
+        job = conn.execute("SELECT * FROM label_jobs WHERE id = ?", (job_id,)).fetchone()
+        model = conn.execute("SELECT * FROM models WHERE id = ?", (job["model_id"],)).fetchone()
+        plano = _plano_do_job(job)
+        agora = now_utc()
+
+        for inicio in range(job["feitos"], len(plano), LABELS_BLOCO):
+            bloco = plano[inicio:inicio + LABELS_BLOCO]
+            ultimo_label_id = inserir_labels(conn, model, bloco, job["capacidade_magazine"], agora)
+            registrar_evento(conn, "label", ultimo_label_id)
+            conn.execute(
+                "UPDATE label_jobs SET feitos = ?, updated_at = ? WHERE id = ?",
+                (inicio + len(bloco), now_utc().isoformat(), job_id)
+            )
+            conn.commit()
+
+        conn.execute(
+            "UPDATE label_jobs SET status = 'CONCLUIDO', updated_at = ? WHERE id = ?",
+            (now_utc().isoformat(), job_id)
+        )
+        conn.commit()
+
+    except Exception as e:
+        app.logger.exception("Erro no job de etiquetas %s", job_id)
+        conn.rollback()
+        conn.execute(
+            "UPDATE label_jobs SET status = 'ERRO', erro = ?, updated_at = ? WHERE id = ?",
+            (str(e), now_utc().isoformat(), job_id)
+        )
+        conn.commit()
+    else:
+        prerender_qrs([codigo_qr(model["code"], lote) for lote, _ in plano])
     finally:
         conn.close()
 
+@app.get("/api/label_jobs/<int:job_id>")
+def api_label_job(job_id):
+    job = retomar_label_job(get_db(), job_id)
+    if not job:
+        return jsonify({"error": "Job não encontrado"}), 404
+    return jsonify({
+        k: job[k] for k in ("id", "model_id", "status", "total", "feitos", "erro", "tentativas")
+    })
+
 @app.route("/view/<int:id>", methods=["GET", "POST"])
 def view_label(id):
     conn = get_db()
@@ -579,15 +2070,11 @@ def view_label(id):
     ).fetchone()
 
     if not model:
-        conn.close()
         abort(404)
 
-    existing_labels = conn.execute(
-        "SELECT * FROM labels WHERE model_id=? ORDER BY created_at DESC", (id,)
-    ).fetchall()
-
-    etiquetas_por_folha = 3
+    existing_labels = []
     lotes = []
+    job = None
 
     if request.method == "POST":
         try:
@@ -595,47 +2082,63 @@ def view_label(id):
             capacidade_magazine = int(request.form.get("capacidade_magazine") or 50)
             capacidade_magazine = max(capacidade_magazine, 1)
 
-            total_etiquetas = (producao_total + capacidade_magazine - 1) // capacidade_magazine
-
-            try:
-                parte_num, parte_padrao = model['lote'].split('/')[:2]
-                lote_inicial = int(parte_num.strip())
-                padrao = parte_padrao.strip()
-            except:
-                lote_inicial = 1
-                padrao = "900"
-
-            lotes = [f"{lote_inicial + i:02d} / {padrao}" for i in range(total_etiquetas)]
+            lote_inicial, padrao = lote_inicial_padrao(model)
+            plano = planejar_lotes(lote_inicial, padrao, producao_total, capacidade_magazine)
 
-            remaining = producao_total
-
-            for lote in lotes:
-                amount = min(capacidade_magazine, remaining)
-                if amount <= 0:
-                    break
-
-                conn.execute("""
-                    INSERT INTO labels
-                    (model_id, lote, producao_total, capacidade_magazine, remaining,
-                     created_at, setor_atual, fase)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            if len(plano) > LABELS_LIMITE_SINCRONO:
+                cur = conn.execute("""
+                    INSERT INTO label_jobs
+                    (model_id, producao_total, capacidade_magazine, lote_inicial, padrao,
+                     total, feitos, status, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, 0, 'PENDENTE', ?, ?)
                 """, (
-                    id, lote, amount, capacidade_magazine, amount,
-                    now_utc().isoformat(),
-                    model["setor"] or "PTH",
-                    "AGUARDANDO"
+                    id, producao_total, capacidade_magazine, lote_inicial, padrao,
+                    len(plano), now_utc().isoformat(), now_utc().isoformat()
                 ))
+                conn.commit()
+                retomar_label_job(conn, cur.lastrowid)
+                return redirect(url_for("view_label", id=id, job=cur.lastrowid))
 
-                remaining -= amount
+            if plano:
+                ultimo_label_id = inserir_labels(
+                    conn, model, plano, capacidade_magazine, now_utc()
+                )
+                registrar_evento(conn, "label", ultimo_label_id)
 
             conn.commit()
+            lotes = [lote for lote, _ in plano]
+            prerender_qrs([codigo_qr(model["code"], lote) for lote in lotes])
             flash("Etiquetas geradas com sucesso!", "success")
 
         except ValueError:
             flash("⚠️ Valores inválidos.", "danger")
 
-    conn.close()
-    return render_template("label.html", m=model, lotes=lotes, existing_labels=existing_labels)
+    elif request.args.get("job", type=int):
+        job = conn.execute(
+            "SELECT * FROM label_jobs WHERE id = ? AND model_id = ?",
+            (request.args.get("job", type=int), id)
+        ).fetchone()
+        if job:
+            job = retomar_label_job(conn, job["id"])
+        if job and job["status"] == "CONCLUIDO":
+            # só a faixa de lotes criada pelo job, não o histórico inteiro
+            lotes = [lote for lote, _ in _plano_do_job(job)]
+
+    elif request.args.get("de", type=int) is not None:
+        # reimpressão de uma faixa de lotes já gerados (ex.: 10 a 40)
+        de = request.args.get("de", type=int)
+        ate = request.args.get("ate", de, type=int)
+        _, padrao = lote_inicial_padrao(model)
+        lotes = [r["lote"] for r in conn.execute(SQL_LABELS_FAIXA, (id, padrao, de, ate))]
+        if not lotes:
+            flash(f"Nenhuma etiqueta nos lotes {de} a {ate}.", "warning")
+
+    else:
+        existing_labels = conn.execute(
+            "SELECT * FROM labels WHERE model_id=? ORDER BY created_ms DESC LIMIT 200", (id,)
+        ).fetchall()
+
+    return render_template("label.html", m=model, lotes=lotes, existing_labels=existing_labels, job=job)
 
 
 @app.route("/setores/<int:id>")
@@ -668,51 +2171,157 @@ def setor_form(id, setor):
         data["setor"] = setor  
 
         data["code"] = f"{data['code']}_{setor}"
-        data["updated_at"] = now_utc().isoformat()
+        agora = now_utc()
+        data["updated_at"] = agora.isoformat()
+        data["updated_ms"] = epoch_ms(agora)
 
         conn.execute("""
             INSERT INTO models 
             (code, model_name, cliente, linha, setor, fase, phase_type, turno, data, horario, 
-             lote, lote_padrao, po, quantidade, op, revisora, operadora, obs, updated_at)
+             lote, lote_padrao, po, quantidade, op, revisora, operadora, obs, updated_at, updated_ms)
             VALUES 
             (:code, :model_name, :cliente, :linha, :setor, :fase, :phase_type, :turno, :data, :horario,
-             :lote, :lote_padrao, :po, :quantidade, :op, :revisora, :operadora, :obs, :updated_at)
+             :lote, :lote_padrao, :po, :quantidade, :op, :revisora, :operadora, :obs, :updated_at, :updated_ms)
         """, data)
 
-        conn.commit()
-
         novo_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        vincular_ops_do_model(conn, novo_id)
+        registrar_evento(conn, "model", novo_id)
+
+        conn.commit()
 
-        conn.close()
         return redirect(url_for("view_label", id=novo_id))
 
-    conn.close()
     return render_template("form.html", model=model_dict)
 
-@app.route("/qr/<string:code>")
-def qr(code):
-    import socket
-    from io import BytesIO
-    import qrcode
-
+# ---------------- QR Codes ----------------
+# PNGs por (código, URL base): LRU em memória na frente de um cache em disco.
+# A URL base é resolvida uma vez, na subida do processo. No disco, cada leitura
+# renova a data do arquivo, e os PNGs sem uso há QR_DISCO_DIAS são apagados
+# (no máximo uma varredura por hora, na thread dos QRs).
+def _resolver_base_url_qr():
     # 🔹 Detecta o IP local da máquina automaticamente
     hostname = socket.gethostname()
     try:
         local_ip = socket.gethostbyname(hostname)
-    except:
+    except OSError:
         local_ip = "127.0.0.1"
+    return f"http://{local_ip}:5000"
+
+QR_BASE_URL = os.environ.get("QR_BASE_URL") or _resolver_base_url_qr()
+QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", "qr_cache")
+QR_CACHE_MAX = int(os.environ.get("QR_CACHE_MAX", 512))
+QR_MAX_AGE = 86400
+QR_DISCO_DIAS = int(os.environ.get("QR_DISCO_DIAS", 30))
+
+_qr_lru = OrderedDict()
+_qr_estado = {"podado_em": None}
+_qr_lock = threading.Lock()
+_qr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qr")
 
-    # 🔹 Gera a URL completa 
-    qr_url = f"http://{local_ip}:5000/movimentar/{code.strip()}"
+def codigo_qr(code, lote):
+    """Código impresso no QR da etiqueta (mesmo formato de label.html): ABC-08-504."""
+    return f"{code}-{lote.replace(' ', '').replace('/', '-')}"
 
-    img = qrcode.make(qr_url)
+def _qr_chave(code):
+    return hashlib.sha1(f"{QR_BASE_URL}|{code}".encode()).hexdigest()
+
+def _gerar_qr(code):
+    # 🔹 Gera a URL completa
+    img = qrcode.make(f"{QR_BASE_URL}/movimentar/{code}")
     buf = BytesIO()
     img.save(buf, "PNG")
-    buf.seek(0)
-    return send_file(buf, mimetype="image/png")
+    return buf.getvalue()
+
+def _podar_qr_disco():
+    limite = now_utc().timestamp() - QR_DISCO_DIAS * 86400
+    apagados = 0
+    try:
+        entradas = list(os.scandir(QR_CACHE_DIR))
+    except OSError:
+        return
+    for entrada in entradas:
+        try:
+            if entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+                apagados += 1
+        except OSError:
+            continue   # outro worker apagou antes
+    if apagados:
+        app.logger.info("Cache de QR: %s arquivos sem uso há %s dias apagados", apagados, QR_DISCO_DIAS)
+
+def _agendar_poda_qr():
+    agora = now_utc()
+    with _qr_lock:
+        if _qr_estado["podado_em"] and agora - _qr_estado["podado_em"] < timedelta(hours=1):
+            return
+        _qr_estado["podado_em"] = agora
+    _qr_executor.submit(_podar_qr_disco)
+
+def qr_png(code):
+    chave = _qr_chave(code)
+    with _qr_lock:
+        png = _qr_lru.get(chave)
+        if png is not None:
+            _qr_lru.move_to_end(chave)
+            return png
+
+    caminho = os.path.join(QR_CACHE_DIR, f"{chave}.png")
+    try:
+        with open(caminho, "rb") as f:
+            png = f.read()
+    except OSError:
+        png = _gerar_qr(code)
+        try:
+            os.makedirs(QR_CACHE_DIR, exist_ok=True)
+            tmp = f"{caminho}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(png)
+            os.replace(tmp, caminho)
+        except OSError:
+            app.logger.exception("Erro ao gravar QR em disco")
+        _agendar_poda_qr()
+    else:
+        try:
+            os.utime(caminho)   # em uso: fica fora da poda
+        except OSError:
+            pass
+
+    with _qr_lock:
+        _qr_lru[chave] = png
+        _qr_lru.move_to_end(chave)
+        while len(_qr_lru) > QR_CACHE_MAX:
+            _qr_lru.popitem(last=False)
+    return png
+
+def prerender_qrs(codes):
+    """Gera em segundo plano os QRs de uma leva de etiquetas recém-criadas."""
+    def _gerar_todos():
+        for code in codes:
+            try:
+                qr_png(code)
+            except Exception:
+                app.logger.exception("Erro ao pré-gerar QR %s", code)
+    _qr_executor.submit(_gerar_todos)
+
+@app.route("/qr/<string:code>")
+def qr(code):
+    code = code.strip()
+    chave = _qr_chave(code)
+
+    if not is_resource_modified(request.environ, etag=chave):
+        resp = app.response_class(status=304)
+    else:
+        resp = send_file(BytesIO(qr_png(code)), mimetype="image/png")
+
+    resp.set_etag(chave)
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = QR_MAX_AGE
+    return resp
 
 def salvar_op(dados):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
 
     # salva OP
@@ -742,70 +2351,23 @@ def salvar_op(dados):
                 VALUES (?, ?, ?, 0)
             """, (id_op, setor, fase))
 
+    vincular_op_model(conn, id_op)
+    registrar_evento(conn, "op", id_op)
     conn.commit()
-    conn.close()
 
 def buscar_ops():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
-    c.execute("""
-        SELECT 
-            o.id AS id,
-            s.id AS saldo_id,
-            o.filial,
-            o.numero_op,
-            o.produto,
-            o.descricao,
-            o.armazem,
-            o.quantidade,
-
-            -- total produzido da OP (somando movements marcados como PRODUCAO para este model/op)
-            COALESCE((
-                SELECT SUM(m.quantidade)
-                FROM movements m
-                WHERE m.acao = 'PRODUCAO'
-                  AND m.model_id = (
-                      SELECT id FROM models WHERE op = o.numero_op AND code = o.produto LIMIT 1
-                  )
-            ), 0) AS produzido_total,
-
-            -- setor + fase (linha)
-            s.setor,
-            s.fase,
-
-            -- produzido real por setor + fase (somando movements.to_setor + fase)
-            COALESCE((
-                SELECT SUM(m.quantidade)
-                FROM movements m
-                WHERE m.acao = 'PRODUCAO'
-                  AND m.to_setor = s.setor
-                  AND UPPER(TRIM(m.fase)) = UPPER(TRIM(s.fase))
-                  AND m.model_id = (
-                      SELECT id FROM models WHERE op = o.numero_op AND code = o.produto LIMIT 1
-                  )
-            ), 0) AS produzido_setor,
-
-            -- saldo planejado (ops_saldos) — valor inicial que você cadastrou (aqui mantido separadamente)
-            s.quantidade AS saldo_planejado
-
-        FROM ops o
-        LEFT JOIN ops_saldos s ON o.id = s.id_op
-        ORDER BY 
-            o.id DESC,
-            s.setor,
-            s.fase
-    """)
+    c.execute(SQL_BUSCAR_OPS)
 
     res = c.fetchall()
-    conn.close()
     return res
 
 
 @app.route("/ops/delete_saldo/<int:saldo_id>", methods=["GET"])
 def delete_saldo(saldo_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT id_op FROM ops_saldos WHERE id = ?", (saldo_id,))
@@ -818,6 +2380,7 @@ def delete_saldo(saldo_id):
     id_op = row[0]
 
     c.execute("DELETE FROM ops_saldos WHERE id = ?", (saldo_id,))
+    registrar_evento(conn, "saldo_removido", saldo_id)
 
     # verificar se ainda sobrou algum setor/fase para essa OP
     c.execute("SELECT COUNT(*) FROM ops_saldos WHERE id_op = ?", (id_op,))
@@ -825,25 +2388,21 @@ def delete_saldo(saldo_id):
 
     # se não sobrou nenhum -> apagar OP inteira
     if restantes == 0:
+        c.execute("DELETE FROM producao_agregada WHERE id_op = ?", (id_op,))
         c.execute("DELETE FROM ops WHERE id = ?", (id_op,))
 
+    registrar_evento(conn, "op", id_op)
     conn.commit()
-    conn.close()
 
     flash("Linha removida com sucesso!", "success")
     return redirect(url_for("ops"))
 
 @app.route("/ops")
 def ops():
+    versao = versao_eventos(get_db())
     lista_ops = buscar_ops()
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT MAX(id) FROM movements")
-    max_ops_id = c.fetchone()[0] or 0
-    conn.close()
-
-    return render_template("ops.html", ops=lista_ops, max_ops_id=max_ops_id)
+    return render_template("ops.html", ops=lista_ops, versao=versao)
 
 @app.route("/ops/add", methods=["POST"])
 def add_op():
@@ -876,7 +2435,7 @@ def update_op(id):
         "setores": ",".join(request.form.getlist("setores"))
     }
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
         UPDATE ops SET 
@@ -894,12 +2453,164 @@ def update_op(id):
         dados["armazem"], dados["quantidade"], dados["produzido"], dados["setores"],
         id
     ))
+    vincular_op_model(conn, id)
+    registrar_evento(conn, "op", id)
     conn.commit()
-    conn.close()
 
     flash("OP atualizada com sucesso!", "success")
     return redirect(url_for("ops"))
 
+# ---------------- Produção agregada por OP / setor / fase ----------------
+# producao_agregada guarda SUM(movements.quantidade) das PRODUCAO por
+# (OP, to_setor, UPPER(TRIM(fase))). É mantida por register_movement na mesma
+# transação do movimento; `flask rebuild-producao` recalcula tudo do zero.
+def reconstruir_producao_agregada(conn, id_op=None):
+    if id_op is None:
+        # reconstrução completa: revalida também o vínculo OP → model
+        conn.execute("""
+            UPDATE ops SET model_id = (
+                SELECT id FROM models
+                WHERE op = ops.numero_op AND code = ops.produto
+                ORDER BY id LIMIT 1
+            )
+        """)
+        conn.execute("DELETE FROM producao_agregada")
+        filtro, params = "", ()
+    else:
+        conn.execute("DELETE FROM producao_agregada WHERE id_op = ?", (id_op,))
+        filtro, params = "WHERE o.id = ?", (id_op,)
+
+    conn.execute(f"""
+        INSERT INTO producao_agregada (id_op, setor, fase, quantidade)
+        SELECT
+            o.id,
+            COALESCE(mv.to_setor, ''),
+            COALESCE(UPPER(TRIM(mv.fase)), ''),
+            COALESCE(SUM(mv.quantidade), 0)
+        FROM ops o
+        JOIN movements mv ON mv.model_id = o.model_id AND mv.acao = 'PRODUCAO'
+        {filtro}
+        GROUP BY 1, 2, 3
+    """, params)
+
+def somar_producao_agregada(conn, model_id, setor, fase, quantidade):
+    """Soma uma PRODUCAO nos contadores de todas as OPs ligadas ao model."""
+    conn.execute("""
+        INSERT INTO producao_agregada (id_op, setor, fase, quantidade)
+        SELECT id, COALESCE(?, ''), COALESCE(UPPER(TRIM(?)), ''), ?
+        FROM ops
+        WHERE model_id = ?
+        ON CONFLICT (id_op, setor, fase)
+        DO UPDATE SET quantidade = quantidade + excluded.quantidade
+    """, (setor, fase, quantidade, model_id))
+
+def vincular_op_model(conn, id_op):
+    """
+    Resolve o model da OP (models.op = numero_op e models.code = produto).
+    Se o vínculo mudou, recalcula os contadores dessa OP a partir de movements.
+    """
+    row = conn.execute("""
+        SELECT
+            model_id,
+            (SELECT id FROM models
+             WHERE op = ops.numero_op AND code = ops.produto
+             ORDER BY id LIMIT 1)
+        FROM ops
+        WHERE id = ?
+    """, (id_op,)).fetchone()
+    if not row or row[0] == row[1]:
+        return
+
+    conn.execute("UPDATE ops SET model_id = ? WHERE id = ?", (row[1], id_op))
+    reconstruir_producao_agregada(conn, id_op)
+
+def vincular_ops_do_model(conn, model_id):
+    """Revalida as OPs ligadas ao model ou que passaram a apontar para ele (op + code)."""
+    ids = conn.execute("""
+        SELECT o.id
+        FROM ops o
+        JOIN models m ON m.id = ?
+        WHERE o.model_id = m.id
+           OR (o.numero_op = m.op AND o.produto = m.code)
+    """, (model_id,)).fetchall()
+    for row in ids:
+        vincular_op_model(conn, row[0])
+
+# ---------------- Produção por hora (/live) ----------------
+# producao_hora soma as PRODUCAO por hora, model, setor de origem, fase e turno.
+# A chave usa a hora UTC (os filtros de data do /live são em UTC); a hora local
+# de Manaus e o turno vão junto, calculados uma única vez na gravação. A OP vem
+# de models no momento da leitura, como nas consultas antigas sobre movements.
+
+def _hora_producao(created_at):
+    """created_at ISO (UTC) -> (hora_utc, hora_local, turno) do balde horário."""
+    dt = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
+    local = dt.astimezone(FUSO_LOCAL)
+    return (
+        dt.astimezone(ZoneInfo("UTC")).strftime("%Y-%m-%dT%H:00:00"),
+        local.strftime("%Y-%m-%d %H:00"),
+        get_turno(local)
+    )
+
+SQL_SOMAR_PRODUCAO_HORA = """
+    INSERT INTO producao_hora (model_id, hora_utc, setor, fase, turno, hora, quantidade, ultima)
+    VALUES (?, ?, COALESCE(?, ''), COALESCE(?, ''), ?, ?, ?, ?)
+    ON CONFLICT (model_id, hora_utc, setor, fase, turno)
+    DO UPDATE SET
+        quantidade = quantidade + excluded.quantidade,
+        ultima = MAX(COALESCE(ultima, ''), excluded.ultima)
+"""
+
+def somar_producao_hora(conn, model_id, setor, fase, quantidade, created_at):
+    if model_id is None:
+        return
+    hora_utc, hora, turno = _hora_producao(created_at)
+    conn.execute(SQL_SOMAR_PRODUCAO_HORA, (model_id, hora_utc, setor, fase, turno, hora, quantidade, created_at))
+
+def reconstruir_producao_hora(conn):
+    # a conversão de fuso/turno é em Python, então agrega aqui e grava em lote
+    conn.execute("DELETE FROM producao_hora")
+    baldes = {}
+    for mv in conn.execute("""
+        SELECT model_id, from_setor, fase, quantidade, created_at
+        FROM movements
+        WHERE UPPER(acao) = 'PRODUCAO' AND model_id IS NOT NULL AND created_at IS NOT NULL
+    """):
+        model_id, setor, fase, quantidade, created_at = mv
+        try:
+            hora_utc, hora, turno = _hora_producao(created_at)
+        except ValueError:
+            continue
+        chave = (model_id, hora_utc, setor or "", fase or "", turno)
+        atual = baldes.get(chave)
+        if atual is None:
+            baldes[chave] = [hora, quantidade or 0, created_at]
+        else:
+            atual[1] += quantidade or 0
+            atual[2] = max(atual[2], created_at)
+
+    conn.executemany(
+        SQL_SOMAR_PRODUCAO_HORA,
+        [(*chave[:5], hora, qtd, ultima) for chave, (hora, qtd, ultima) in baldes.items()]
+    )
+
+@app.cli.command("rebuild-producao")
+def rebuild_producao_command():
+    """Recalcula producao_agregada e producao_hora a partir de movements."""
+    conn = connect_db()
+    try:
+        with conn:
+            reconstruir_producao_agregada(conn)
+            reconstruir_producao_hora(conn)
+        total = conn.execute("SELECT COUNT(*) FROM producao_agregada").fetchone()[0]
+        total_hora = conn.execute("SELECT COUNT(*) FROM producao_hora").fetchone()[0]
+    finally:
+        conn.close()
+    print(f"producao_agregada reconstruída ({total} linhas).")
+    print(f"producao_hora reconstruída ({total_hora} linhas).")
+
 def atualizar_producao_op(conn, produto, numero_op, setor, fase, quantidade):
     """
     Usa a conexão passada (mesma transação). NÃO altera ops_saldos.
@@ -908,25 +2619,270 @@ def atualizar_producao_op(conn, produto, numero_op, setor, fase, quantidade):
     c = conn.cursor()
 
     # Busca OP pelo produto + OP
-    c.execute("""
-        SELECT id FROM ops 
-        WHERE produto=? AND numero_op=?
-    """, (produto, numero_op))
+    c.execute(SQL_OP_POR_PRODUTO, (numero_op, produto))
 
     op = c.fetchone()
     if not op:
         return False
 
-    id_op = op[0]
+    id_op = op[0]
+
+    # Atualiza total produzido da OP (mantém total OP)
+    c.execute("""
+        UPDATE ops 
+        SET produzido = COALESCE(produzido,0) + ?
+        WHERE id = ?
+    """, (quantidade, id_op))
+
+    return True
+
+def get_fase(ponto, acao):
+    p = (ponto or "").strip()
+    a = (acao or "").strip().upper()
+
+    if p == "Ponto-03":
+        if a == "RECEBIMENTO":
+            return "PENDENTE CQ"
+        if a == "CQ":
+            return "CQ APROVOU"
+        return "DISPONIVEL"
+
+
+    # Ponto-02 (SMT) segue fluxo SMT normal:
+    # RECEBIMENTO -> AGUARDANDO, caso contrário -> DISPONIVEL
+    if p == "Ponto-02":
+        if a == "RECEBIMENTO":
+            return "AGUARDANDO"
+        return "DISPONIVEL"
+
+    # default para outros pontos
+    return "DISPONIVEL"
+
+def localizar_etiqueta(conn, full_code):
+    """
+    QR lido (já passado por extract_real_code) -> (model, label, erro).
+    Em caso de erro, model/label podem ser None e `erro` traz a mensagem.
+    """
+    parts = full_code.split("-")
+    base_code = parts[0].upper()
+    lote_seq, lote_padrao = lote_do_qr("-".join(parts[1:]))
+
+    model_row = conn.execute(SQL_MODEL_POR_CODIGO, (base_code,)).fetchone()
+    if not model_row:
+        return None, None, f"Código '{full_code}' não encontrado."
+    model = dict(model_row)
+
+    label = find_label(conn, model["id"], lote_seq, lote_padrao)
+    if not label:
+        return model, None, "Etiqueta não encontrada para o lote informado."
+
+    return model, label, None
+
+def aplicar_movimento(conn, model, label, ponto, acao, quantidade, top_mark, bottom_mark,
+                      created_by="terminal_movimentacao", client_at=None, client_scan_id=None):
+    """
+    Regras de uma movimentação (a mesma validação para o formulário e para o lote).
+    Não faz commit: roda dentro de transacao_escrita, com `label` lido na mesma
+    transação. Retorna um dict com ok/mensagem; quando ok, também o id da
+    etiqueta nova, a quantidade transferida e quantos alertas dispararam.
+    """
+    def recusa(mensagem):
+        return {"ok": False, "mensagem": mensagem}
+
+    setor_origem = label.get("setor_atual")
+    capacidade = int(label.get("capacidade_magazine") or 0)
+    remaining = int(label.get("remaining") or capacidade)
+    quantidade = int(quantidade or remaining)
+
+    top_mark = int(top_mark or 0)
+    bottom_mark = int(bottom_mark or 0)
+
+    # --- validação de fase existente ---
+    if top_mark == 1 and bottom_mark == 1:
+        bottom_mark = 0
+
+    if top_mark == 0 and bottom_mark == 0:
+        return recusa("Escolha uma fase: TOP ou BOTTOM!")
+
+    # --- validação: tipo de fase ---
+    possible_keys = ["tipo_de_fase", "tipo_fase", "phase_type", "fase_tipo", "type_phase", "tipo"]
+    tipo_de_fase = None
+    for k in possible_keys:
+        if k in model and model.get(k) is not None:
+            tipo_de_fase = str(model.get(k)).strip().upper()
+            break
+
+    if tipo_de_fase:
+        if "TOP ONLY" in tipo_de_fase or tipo_de_fase == "TOPONLY" or tipo_de_fase == "TOP":
+            if bottom_mark == 1 and top_mark == 0:
+                return recusa("Modelo é TOP ONLY — não é permitido registrar BOTTOM.")
+        if "BOTTOM ONLY" in tipo_de_fase or tipo_de_fase == "BOTTOMONLY" or tipo_de_fase == "BOTTOM":
+            if top_mark == 1 and bottom_mark == 0:
+                return recusa("Modelo é BOTTOM ONLY — não é permitido registrar TOP.")
+
+    old_top = int(label.get("top_done") or 0)
+    old_bottom = int(label.get("bottom_done") or 0)
+
+    top_done_new = old_top + quantidade if top_mark == 1 else old_top
+    bottom_done_new = old_bottom + quantidade if bottom_mark == 1 else old_bottom
+
+    # --- Lógica do RECEBIMENTO (SMT) ---
+    # Se for RECEBIMENTO em SMT (Ponto-02 ou Ponto-03) -> zera contadores para a nova etiqueta
+    if acao == "RECEBIMENTO" and ponto in ("Ponto-02", "Ponto-03"):
+        top_done_new = 0
+        bottom_done_new = 0
+
+    fase_nova = get_fase(ponto, acao)
+
+    # --- BLOQUEIO DUPLICADO por fase (toda a linhagem da etiqueta) ---
+    root_label_id = label.get("root_label_id") or label["id"]
+    if top_mark == 1:
+        already_top = conn.execute(
+            SQL_MOVIMENTO_DUPLICADO,
+            (root_label_id, ponto, acao, "TOP")
+        ).fetchone()
+        if already_top:
+            return recusa("TOP já foi registrado para esta etiqueta (ou filha) neste ponto.")
+
+    if bottom_mark == 1:
+        already_bottom = conn.execute(
+            SQL_MOVIMENTO_DUPLICADO,
+            (root_label_id, ponto, acao, "BOTTOM")
+        ).fetchone()
+        if already_bottom:
+            return recusa("BOTTOM já foi registrado para esta etiqueta (ou filha) neste ponto.")
+
+    # --- FLUXO NORMAL (DISPONIVEL) ---
+    transfer = quantidade if quantidade > 0 else remaining
+    if transfer <= 0 or transfer > remaining:
+        return recusa("Quantidade inválida.")
+
+    # Atualiza remaining da etiqueta original, desde que ninguém a tenha mudado
+    # depois da leitura (ver Transações de escrita)
+    novo_remaining = remaining - transfer
+    agora = now_utc()
+    cur = conn.execute("""
+        UPDATE labels SET remaining=?, updated_at=?, updated_ms=?, version=version + 1
+        WHERE id=? AND version=?
+    """, (novo_remaining, agora.isoformat(), epoch_ms(agora), label["id"], label.get("version") or 0))
+    if cur.rowcount != 1:
+        raise EtiquetaAlterada(label["id"])
+
+    destino_map = {
+        "Ponto-01": "PTH",
+        "Ponto-02": "SMT",
+        "Ponto-03": "SMT",
+        "Ponto-04": "IM",
+        "Ponto-05": "PA",
+        "Ponto-06": "IM",
+        "Ponto-07": "ESTOQUE"
+    }
+    setor_destino = destino_map.get(ponto, setor_origem)
+
+    conn.execute("""
+        INSERT INTO labels
+        (model_id, lote, lote_seq, lote_padrao, producao_total, capacidade_magazine, remaining,
+         created_at, created_ms, linked_label_id, root_label_id, setor_atual, fase,
+         top_done, bottom_done)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        model["id"], label["lote"], label["lote_seq"], label["lote_padrao"], transfer, transfer, transfer,
+        agora.isoformat(), epoch_ms(agora), label["id"], root_label_id,
+        setor_destino, fase_nova,
+        top_done_new, bottom_done_new
+    ))
+    new_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    registrar_evento(conn, "label", new_id)
+
+    if top_mark == 1:
+        register_movement(
+            conn,
+            model["id"],
+            label["id"],
+            new_id,
+            ponto,
+            acao,
+            transfer,
+            setor_origem,
+            setor_destino,
+            "TOP",
+            created_by=created_by,
+            root_label_id=root_label_id,
+            client_at=client_at,
+            client_scan_id=client_scan_id
+        )
+
+    if bottom_mark == 1:
+        register_movement(
+            conn,
+            model["id"],
+            label["id"],
+            new_id,
+            ponto,
+            acao,
+            transfer,
+            setor_origem,
+            setor_destino,
+            "BOTTOM",
+            created_by=created_by,
+            root_label_id=root_label_id,
+            client_at=client_at,
+            client_scan_id=client_scan_id
+        )
+
+    setor_map = {
+        "Ponto-01": "PTH",
+        "Ponto-02": "SMT",
+        "Ponto-03": "SMT",
+        "Ponto-04": "IM",
+        "Ponto-05": "IM",
+        "Ponto-06": "IM",
+        "Ponto-07": "ESTOQUE"
+    }
+
+    setor = setor_map.get(ponto)
+    fase_registro = "TOP" if top_mark == 1 else "BOTTOM"
+    disparados = 0
+
+    if acao == "PRODUCAO" and setor:
+        atualizar_producao_op(
+            conn,
+            produto=model["code"],
+            numero_op=model["op"],
+            setor=setor,
+            fase=fase_registro,
+            quantidade=transfer
+        )
+
+        # buscar id_op
+        cur = conn.execute(SQL_OP_POR_PRODUTO, (model["op"], model["code"])).fetchone()
+
+        if cur:
+            id_op = cur["id"]
+
+            produzido_atual = conn.execute(SQL_PRODUZIDO_SETOR, (
+                id_op,
+                setor,
+                fase_registro
+            )).fetchone()[0]
 
-    # Atualiza total produzido da OP (mantém total OP)
-    c.execute("""
-        UPDATE ops 
-        SET produzido = COALESCE(produzido,0) + ?
-        WHERE id = ?
-    """, (quantidade, id_op))
+            disparados = verificar_alertas_op(
+                conn,
+                id_op,
+                setor,
+                fase_registro,
+                produzido_atual
+            )
 
-    return True
+    return {
+        "ok": True,
+        "mensagem": f"{acao} registrada ({transfer} un.)",
+        "label_id": new_id,
+        "quantidade": transfer,
+        "disparados": disparados
+    }
+
+MSG_PRODUCAO_DUPLICADA = "Produção já registrada para esta etiqueta (ou filha) neste ponto."
 
 @app.route("/movimentar", methods=["GET", "POST"])
 def movimentar():
@@ -942,294 +2898,173 @@ def movimentar():
             flash("QR inválido", "danger")
             return redirect(url_for("movimentar", p=ponto_url))
 
-        parts = full_code.split("-")
-        base_code = parts[0].upper()
-        lote_sufixo = "-".join(parts[1:]) if len(parts) > 1 else None
-        lote_formatado = normalize_lote_from_qr(lote_sufixo) if lote_sufixo else None
+    # GET só mostra a etiqueta; o POST a lê de novo dentro da transação de escrita
+    if full_code and request.method == "GET":
+        model, label, erro = localizar_etiqueta(get_db(), full_code)
+        if erro:
+            flash(erro, "danger")
+            return redirect(url_for("movimentar", p=ponto_url))
 
-        conn = get_db()
-        model_row = conn.execute("SELECT * FROM models WHERE UPPER(code)=?", (base_code,)).fetchone()
-        if not model_row:
-            conn.close()
-            flash(f"Código '{full_code}' não encontrado.", "danger")
+    # --- START POST handling ---
+    if request.method == "POST" and full_code:
+        acao = (request.form.get("acao") or "").strip().upper()
+        ponto = request.form.get("ponto") or ponto_url
+        scan = {
+            "qr_code": full_code,
+            "ponto": ponto,
+            "acao": acao,
+            "quantidade": request.form.get("quantidade"),
+            "top_mark": request.form.get("top_mark"),
+            "bottom_mark": request.form.get("bottom_mark"),
+        }
+        try:
+            (resultado,), disparados = registrar_scans([scan], "terminal_movimentacao")
+        except Exception as e:
+            contar_scan(ponto, acao, "erro")
+            flash(f"Erro ao registrar movimentação: {e}", "danger")
             return redirect(url_for("movimentar", p=ponto_url))
-        model = dict(model_row)
 
-        if lote_formatado:
-            label_row = conn.execute(
-                "SELECT * FROM labels WHERE model_id=? AND lote=? ORDER BY id DESC LIMIT 1",
-                (model["id"], lote_formatado)
-            ).fetchone()
-            if label_row:
-                label = dict(label_row)
+        contar_scan(ponto, acao, situacao_scan(resultado))
+        if disparados:
+            acordar_push()
+        flash(resultado["mensagem"], "success" if resultado["ok"] else "danger")
+        return redirect(url_for("movimentar", p=ponto_url))
 
-        if not label:
-            conn.close()
-            flash("Etiqueta não encontrada para o lote informado.", "danger")
-            return redirect(url_for("movimentar", p=ponto_url))
-        conn.close()
+    # GET or fallback render
+    return render_template(
+        "movimentar.html",
+        model=model,
+        label=label,
+        ponto=ponto_url,
+        clean_display_code=clean_display_code
+    )
 
-    def get_fase(ponto, acao):
-        p = (ponto or "").strip()
-        a = (acao or "").strip().upper()
+# ---------------- Movimentação em lote ----------------
+# Terminais que acumulam leituras (Wi-Fi caiu, rajada de reenvio) mandam tudo num
+# POST só. Os scans são aplicados em ordem, numa única transação de escrita
+# (transacao_escrita ou a Escrita agrupada), com as mesmas regras do /movimentar;
+# cada um roda num SAVEPOINT para que um scan recusado não desfaça os outros.
+SCANS_LOTE_MAX = int(os.environ.get("SCANS_LOTE_MAX", 500))
+
+def _aplicar_scan(conn, scan, created_by):
+    full_code = extract_real_code(str(scan.get("qr_code") or ""))
+    if not full_code:
+        return {"ok": False, "mensagem": "QR inválido"}
+
+    model, label, erro = localizar_etiqueta(conn, full_code)
+    if erro:
+        return {"ok": False, "mensagem": erro}
+
+    return aplicar_movimento(
+        conn, model, label,
+        scan.get("ponto"),
+        (scan.get("acao") or "").strip().upper(),
+        scan.get("quantidade"),
+        scan.get("top_mark"),
+        scan.get("bottom_mark"),
+        created_by=created_by,
+        client_at=scan.get("client_ts"),
+        client_scan_id=_id_scan(scan)
+    )
 
-        if p == "Ponto-03":
-            if a == "RECEBIMENTO":
-                return "PENDENTE CQ"
-            if a == "CQ":
-                return "CQ APROVOU"
-            return "DISPONIVEL"
+def _id_scan(scan):
+    id_scan = scan.get("id")
+    return str(id_scan)[:100] if id_scan not in (None, "") else None
 
+def _scan_ja_aplicado(conn, scan):
+    """Resultado original de um scan reenviado (mesmo id do terminal), ou None."""
+    id_scan = _id_scan(scan)
+    if id_scan is None:
+        return None
+    row = conn.execute(SQL_MOVIMENTO_POR_SCAN, (id_scan,)).fetchone()
+    if not row:
+        return None
+    return {
+        "ok": True,
+        "mensagem": f"{row['acao']} registrada ({row['quantidade']} un.)",
+        "label_id": row["new_label_id"],
+        "quantidade": row["quantidade"],
+        "disparados": 0,
+        "repetido": True
+    }
 
-        # Ponto-02 (SMT) segue fluxo SMT normal:
-        # RECEBIMENTO -> AGUARDANDO, caso contrário -> DISPONIVEL
-        if p == "Ponto-02":
-            if a == "RECEBIMENTO":
-                return "AGUARDANDO"
-            return "DISPONIVEL"
+def aplicar_scans(conn, scans, created_by):
+    """
+    Aplica os scans em ordem, cada um no seu SAVEPOINT. Roda dentro de
+    transacao_escrita. Retorna (resultados, alertas disparados).
+    """
+    resultados = []
+    disparados = 0
 
-        # default para outros pontos
-        return "DISPONIVEL"
+    for i, scan in enumerate(scans):
+        if not isinstance(scan, dict):
+            resultados.append({"indice": i, "ok": False, "mensagem": "Scan inválido"})
+            continue
 
-    # --- START POST handling ---
-    if request.method == "POST" and model and label:
-        acao = (request.form.get("acao") or "").strip().upper()
-        ponto = request.form.get("ponto") or ponto_url
-        conn = get_db()
+        conn.execute("SAVEPOINT scan")
         try:
-            setor_origem = label.get("setor_atual")
-            capacidade = int(label.get("capacidade_magazine") or 0)
-            remaining = int(label.get("remaining") or capacidade)
-            quantidade = int(request.form.get("quantidade") or remaining)
-
-            top_mark = int(request.form.get("top_mark") or 0)
-            bottom_mark = int(request.form.get("bottom_mark") or 0)
-
-            # --- validação de fase existente ---
-            if top_mark == 1 and bottom_mark == 1:
-                bottom_mark = 0
-
-            if top_mark == 0 and bottom_mark == 0:
-                flash("Escolha uma fase: TOP ou BOTTOM!", "danger")
-                return redirect(url_for("movimentar", p=ponto_url))
-
-            # --- validação: tipo de fase ---
-            possible_keys = ["tipo_de_fase", "tipo_fase", "phase_type", "fase_tipo", "type_phase", "tipo"]
-            tipo_de_fase = None
-            for k in possible_keys:
-                if k in model and model.get(k) is not None:
-                    tipo_de_fase = str(model.get(k)).strip().upper()
-                    break
-
-            if tipo_de_fase:
-                if "TOP ONLY" in tipo_de_fase or tipo_de_fase == "TOPONLY" or tipo_de_fase == "TOP":
-                    if bottom_mark == 1 and top_mark == 0:
-                        flash("Modelo é TOP ONLY — não é permitido registrar BOTTOM.", "danger")
-                        return redirect(url_for("movimentar", p=ponto_url))
-                if "BOTTOM ONLY" in tipo_de_fase or tipo_de_fase == "BOTTOMONLY" or tipo_de_fase == "BOTTOM":
-                    if top_mark == 1 and bottom_mark == 0:
-                        flash("Modelo é BOTTOM ONLY — não é permitido registrar TOP.", "danger")
-                        return redirect(url_for("movimentar", p=ponto_url))
-
-            old_top = int(label.get("top_done") or 0)
-            old_bottom = int(label.get("bottom_done") or 0)
-
-            top_done_new = old_top + quantidade if top_mark == 1 else old_top
-            bottom_done_new = old_bottom + quantidade if bottom_mark == 1 else old_bottom
-
-            # --- Lógica do RECEBIMENTO (SMT) ---
-            # Se for RECEBIMENTO em SMT (Ponto-02 ou Ponto-03) -> zera contadores para a nova etiqueta
-            if acao == "RECEBIMENTO" and ponto in ("Ponto-02", "Ponto-03"):
-                top_done_new = 0
-                bottom_done_new = 0
-
-            fase_nova = get_fase(ponto, acao)
-
-            # --- BLOQUEIO DUPLICADO por fase (igual já existente) ---
-            label_id = label["id"]
-            if top_mark == 1:
-                already_top = conn.execute("""
-                    SELECT 1
-                    FROM movements
-                    WHERE (
-                        label_id = ? OR
-                        new_label_id = ? OR
-                        label_id IN (SELECT id FROM labels WHERE linked_label_id = ?) OR
-                        new_label_id IN (SELECT id FROM labels WHERE linked_label_id = ?)
-                    )
-                    AND ponto = ?
-                    AND acao = ?
-                    AND UPPER(TRIM(fase)) = 'TOP'
-                    LIMIT 1
-                """, (label_id, label_id, label_id, label_id, ponto, acao)).fetchone()
-                if already_top:
-                    conn.close()
-                    flash("TOP já foi registrado para esta etiqueta (ou filha) neste ponto.", "danger")
-                    return redirect(url_for("movimentar", p=ponto_url))
-
-            if bottom_mark == 1:
-                already_bottom = conn.execute("""
-                    SELECT 1
-                    FROM movements
-                    WHERE (
-                        label_id = ? OR
-                        new_label_id = ? OR
-                        label_id IN (SELECT id FROM labels WHERE linked_label_id = ?) OR
-                        new_label_id IN (SELECT id FROM labels WHERE linked_label_id = ?)
-                    )
-                    AND ponto = ?
-                    AND acao = ?
-                    AND UPPER(TRIM(fase)) = 'BOTTOM'
-                    LIMIT 1
-                """, (label_id, label_id, label_id, label_id, ponto, acao)).fetchone()
-                if already_bottom:
-                    conn.close()
-                    flash("BOTTOM já foi registrado para esta etiqueta (ou filha) neste ponto.", "danger")
-                    return redirect(url_for("movimentar", p=ponto_url))
-
-            # --- FLUXO NORMAL (DISPONIVEL) ---
-            transfer = quantidade if quantidade > 0 else remaining
-            if transfer <= 0 or transfer > remaining:
-                conn.close()
-                flash("Quantidade inválida.", "danger")
-                return redirect(url_for("movimentar", p=ponto_url))
-
-            # Atualiza remaining da etiqueta original
-            novo_remaining = remaining - transfer
-            conn.execute("UPDATE labels SET remaining=?, updated_at=? WHERE id=?",
-                         (novo_remaining, now_utc().isoformat(), label["id"]))
-
-            destino_map = {
-                "Ponto-01": "PTH",
-                "Ponto-02": "SMT",
-                "Ponto-03": "SMT",
-                "Ponto-04": "IM",
-                "Ponto-05": "PA",
-                "Ponto-06": "IM",
-                "Ponto-07": "ESTOQUE"
-            }
-            setor_destino = destino_map.get(ponto, setor_origem)
+            resultado = _scan_ja_aplicado(conn, scan) or _aplicar_scan(conn, scan, created_by)
+        except EtiquetaAlterada:
+            raise   # refaz a transação inteira
+        except sqlite3.IntegrityError:
+            # outro terminal registrou a mesma produção entre a checagem e o INSERT
+            resultado = {"ok": False, "mensagem": MSG_PRODUCAO_DUPLICADA}
+        except Exception as e:
+            resultado = {"ok": False, "mensagem": f"Erro ao registrar movimentação: {e}"}
 
-            conn.execute("""
-                INSERT INTO labels
-                (model_id, lote, producao_total, capacidade_magazine, remaining,
-                 created_at, linked_label_id, setor_atual, fase,
-                 top_done, bottom_done)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                model["id"], label["lote"], transfer, transfer, transfer,
-                now_utc().isoformat(), label["id"],
-                setor_destino, fase_nova,
-                top_done_new, bottom_done_new
-            ))
-            new_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-            if top_mark == 1:
-                register_movement(
-                    conn,
-                    model["id"],
-                    label["id"],
-                    new_id,
-                    ponto,
-                    acao,
-                    transfer,
-                    setor_origem,
-                    setor_destino,
-                    "TOP"
-                )
+        if resultado["ok"]:
+            disparados += resultado.pop("disparados")
+        else:
+            conn.execute("ROLLBACK TO scan")
+        conn.execute("RELEASE scan")
 
-            if bottom_mark == 1:
-                register_movement(
-                    conn,
-                    model["id"],
-                    label["id"],
-                    new_id,
-                    ponto,
-                    acao,
-                    transfer,
-                    setor_origem,
-                    setor_destino,
-                    "BOTTOM"
-                )
+        resultados.append({"indice": i, "id": scan.get("id"), **resultado})
 
-            setor_map = {
-                "Ponto-01": "PTH",
-                "Ponto-02": "SMT",
-                "Ponto-03": "SMT",
-                "Ponto-04": "IM",
-                "Ponto-05": "IM",
-                "Ponto-06": "IM",
-                "Ponto-07": "ESTOQUE"
-            }
+    return resultados, disparados
 
-            setor = setor_map.get(ponto)
-            fase_registro = "TOP" if top_mark == 1 else "BOTTOM"
+def situacao_scan(resultado):
+    """Resultado de um scan -> rótulo de venttos_scans_total."""
+    if resultado.get("repetido"):
+        return "repetido"
+    if resultado["ok"]:
+        return "aplicado"
+    if resultado["mensagem"].startswith("Erro ao registrar"):
+        return "erro"
+    return "recusado"
 
-            if acao == "PRODUCAO" and setor:
-                atualizar_producao_op(
-                    conn,
-                    produto=model["code"],
-                    numero_op=model["op"],
-                    setor=setor,
-                    fase=fase_registro,
-                    quantidade=transfer
-                )
+@app.post("/api/movimentar/lote")
+def api_movimentar_lote():
+    data = request.get_json(silent=True) or {}
+    scans = data.get("scans")
 
-                # buscar id_op
-                cur = conn.execute("""
-                    SELECT id FROM ops
-                    WHERE numero_op = ? AND produto = ?
-                """, (model["op"], model["code"])).fetchone()
-
-                if cur:
-                    id_op = cur["id"]
-
-                    produzido_atual = conn.execute("""
-                        SELECT COALESCE(SUM(quantidade),0)
-                        FROM movements
-                        WHERE acao = 'PRODUCAO'
-                        AND to_setor = ?
-                        AND UPPER(TRIM(fase)) = ?
-                        AND model_id = ?
-                    """, (
-                        setor,
-                        fase_registro,
-                        model["id"]
-                    )).fetchone()[0]
-
-                    verificar_alertas_op(
-                        conn,
-                        id_op,
-                        setor,
-                        fase_registro,
-                        produzido_atual
-                    )
+    if not isinstance(scans, list) or not scans:
+        return jsonify({"error": "Envie uma lista em 'scans'"}), 400
+    if len(scans) > SCANS_LOTE_MAX:
+        return jsonify({"error": f"Máximo de {SCANS_LOTE_MAX} scans por lote"}), 413
 
-            conn.commit()
-            flash(f"{acao} registrada ({transfer} un.)", "success")
-            return redirect(url_for("movimentar", p=ponto_url))
+    try:
+        resultados, disparados = registrar_scans(scans, "terminal_lote")
+    except Exception:
+        app.logger.exception("Erro no lote de movimentações")
+        for scan in scans:
+            if isinstance(scan, dict):
+                contar_scan(scan.get("ponto"), (scan.get("acao") or "").strip().upper(), "erro")
+        # detalhe do SQLite fica no log; o terminal só precisa saber que deve reenviar
+        return jsonify({"error": "Lote não aplicado, tente novamente."}), 503
 
-        except Exception as e:
-            try:
-                conn.rollback()
-            except:
-                pass
-            flash(f"Erro ao registrar movimentação: {e}", "danger")
-            return redirect(url_for("movimentar", p=ponto_url))
-        finally:
-            try:
-                conn.close()
-            except:
-                pass
+    for scan, r in zip(scans, resultados):
+        if isinstance(scan, dict):
+            contar_scan(scan.get("ponto"), (scan.get("acao") or "").strip().upper(), situacao_scan(r))
 
-    # GET or fallback render
-    return render_template(
-        "movimentar.html",
-        model=model,
-        label=label,
-        ponto=ponto_url,
-        clean_display_code=clean_display_code
-    )
+    if disparados:
+        acordar_push()
+
+    aplicados = sum(1 for r in resultados if r["ok"])
+    return jsonify({
+        "aplicados": aplicados,
+        "recusados": len(resultados) - aplicados,
+        "resultados": resultados
+    })
 
 def extract_real_code(raw):
     if not raw:
@@ -1275,75 +3110,58 @@ def escapejs_filter(s):
 app.jinja_env.filters['escapejs'] = escapejs_filter
 
 
-def build_dashboard_data():
-    conn = get_db()
+# Snapshot do dashboard por processo: N TVs consultando um chão de fábrica
+# parado custam só a consulta de versão (SQL_DASHBOARD_VERSAO).
+_dashboard_cache = {"versao": None, "dados": None}
+_dashboard_cache_lock = threading.Lock()
 
-    models = conn.execute(
-        "SELECT * FROM models ORDER BY model_name"
-    ).fetchall()
-    models = [dict(m) for m in models]
+def dashboard_versao(conn):
+    return tuple(conn.execute(SQL_DASHBOARD_VERSAO).fetchone())
 
+def _montar_dashboard(conn):
     dashboard_data = []
+    atual = None
+
+    for row in conn.execute(SQL_DASHBOARD):
+        row = dict(row)
+        if atual is None or atual["model"]["id"] != row["id"]:
+            atual = {
+                "model": {k: v for k, v in row.items() if not k.startswith("l_")},
+                "saldo_setores": []
+            }
+            dashboard_data.append(atual)
+
+        if row["l_id"] is None:
+            continue
+
+        atual["saldo_setores"].append({
+            "setor": row["l_setor"],
+            "fase": row["l_fase"],
+            "saldo": row["l_saldo"],
+            "status": row["l_status"],
+            "status_top": row["l_status_top"],
+            "status_bottom": row["l_status_bottom"],
+            "saldo_blank": row["l_total"]
+        })
 
-    for m in models:
+    return dashboard_data
 
-        labels = conn.execute("""
-            SELECT *
-            FROM labels
-            WHERE model_id=? AND remaining > 0
-        """, (m["id"],)).fetchall()
-        labels = [dict(l) for l in labels]
-
-        saldo_setores = []
-
-        for lab in labels:
-
-            setor = lab["setor_atual"] or "SEM SETOR"
-            fase = (lab["fase"] or "").strip().upper()
-            saldo = int(lab["remaining"] or 0)
-            total = int(lab["producao_total"] or 0)
-            top_done = int(lab["top_done"] or 0)
-            bottom_done = int(lab["bottom_done"] or 0)
-
-            if fase == "DISPONIVEL":
-                status = "DISPONIVEL"
-            elif fase.startswith("AGUARDANDO"):
-                status = "AGUARDANDO"
-            elif fase == "PENDENTE CQ":
-                status = "PENDENTE CQ"
-            elif fase == "CQ APROVOU":
-                status = "CQ APROVOU"
-            elif fase in ("EXPEDIDO", "EXPEDICAO"):
-                status = "QUALIDADE"
-            else:
-                status = "AGUARDANDO"
+def build_dashboard_data(versao=None):
+    """Dados do dashboard; o resultado é compartilhado entre requests (somente leitura)."""
+    conn = get_db()
+    if versao is None:
+        versao = dashboard_versao(conn)
 
-            fase_type = (m.get("phase_type") or "").strip().upper()
+    with _dashboard_cache_lock:
+        if _dashboard_cache["versao"] == versao:
+            return _dashboard_cache["dados"]
 
-            if fase_type == "TOP ONLY":
-                status_top = f"⬜ ({top_done}/{total})"
-                status_bottom = "N/A"
-            else:
-                status_top = f" ({top_done}/{total})"
-                status_bottom = f" ({bottom_done}/{total})"
-
-            saldo_setores.append({
-                "setor": setor,
-                "fase": fase,
-                "saldo": saldo,
-                "status": status,
-                "status_top": status_top,
-                "status_bottom": status_bottom,
-                "saldo_blank": total
-            })
-
-        dashboard_data.append({
-            "model": m,
-            "saldo_setores": saldo_setores
-        })
+    dados = _montar_dashboard(conn)
 
-    conn.close()
-    return dashboard_data
+    with _dashboard_cache_lock:
+        _dashboard_cache["versao"] = versao
+        _dashboard_cache["dados"] = dados
+    return dados
 
 @app.route("/dashboard")
 def dashboard():
@@ -1368,53 +3186,421 @@ def push_subscribe():
     if not endpoint or not p256dh or not auth:
         return jsonify({"error": "Dados inválidos"}), 400
 
+    # o navegador reenvia a mesma inscrição a cada visita: um registro por endpoint
     with get_db() as conn:
         conn.execute("""
             INSERT INTO push_subscriptions (endpoint, p256dh, auth)
             VALUES (?, ?, ?)
+            ON CONFLICT(endpoint) DO UPDATE SET
+                p256dh = excluded.p256dh,
+                auth = excluded.auth
         """, (endpoint, p256dh, auth))
 
     return jsonify({"success": True})
 
 
-def enviar_alerta(subscription):
-    payload = json.dumps({
+# ---------------- Escrita agrupada ----------------
+# Opcional (ESCRITA_AGRUPADA=1). Em vez de cada requisição abrir a sua transação,
+# os scans de todos os workers vão para um único escritor, que junta o que chegar
+# em ESCRITA_JANELA_MS (ou até ESCRITA_GRUPO_MAX scans) e aplica tudo num só
+# BEGIN IMMEDIATE/COMMIT. Cada scan continua no seu SAVEPOINT, com a validação e
+# o resultado próprios, devolvidos a quem o enviou.
+# Com o gunicorn, o escritor é um processo à parte (`flask scan-writer`, iniciado
+# pelo master em gunicorn.conf.py) e os workers falam com ele pelo socket Unix
+# ESCRITOR_SOCKET; sem o socket (python app.py), é uma thread do próprio processo.
+# Se o processo escritor não estiver de pé, o worker grava direto.
+ESCRITA_AGRUPADA = os.environ.get("ESCRITA_AGRUPADA") == "1"
+ESCRITA_JANELA_MS = float(os.environ.get("ESCRITA_JANELA_MS", 10))
+ESCRITA_GRUPO_MAX = int(os.environ.get("ESCRITA_GRUPO_MAX", 50))
+ESCRITOR_SOCKET = os.environ.get("ESCRITOR_SOCKET")
+ESCRITOR_TIMEOUT = float(os.environ.get("ESCRITOR_TIMEOUT", 30))
+
+_escritor_fila = queue.Queue()
+_escritor_lock = threading.Lock()
+_escritor_estado = {"thread": None}
+
+def registrar_scans(scans, created_by):
+    """
+    Ponto único de gravação de scans (formulário e lote). Retorna
+    (resultados, alertas disparados); erro na transação vira exceção.
+    """
+    if ESCRITA_AGRUPADA:
+        resposta = _pedir_ao_escritor(scans, created_by) if ESCRITOR_SOCKET else _pedir_escrita(scans, created_by)
+        if resposta is not None:
+            if "erro" in resposta:
+                raise RuntimeError(resposta["erro"])
+            return resposta["resultados"], resposta["disparados"]
+
+    return transacao_escrita(get_db(), lambda conn: aplicar_scans(conn, scans, created_by))
+
+def _pedir_escrita(scans, created_by):
+    """Entrega o pedido ao escritor deste processo e espera a resposta."""
+    iniciar_escritor()
+    pedido = {"scans": scans, "created_by": created_by, "pronto": threading.Event(), "resposta": None}
+    _escritor_fila.put(pedido)
+    if not pedido["pronto"].wait(ESCRITOR_TIMEOUT):
+        return {"erro": "escritor não respondeu a tempo"}
+    return pedido["resposta"]
+
+def _pedir_ao_escritor(scans, created_by):
+    """Pedido ao processo escritor; None se ele não estiver aceitando conexões."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(ESCRITOR_TIMEOUT)
+    try:
+        try:
+            s.connect(ESCRITOR_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # nada foi enviado: gravar direto não duplica o scan
+            contar_metrica("venttos_escrita_direta_total", len(scans), endpoint=_endpoint_atual())
+            return None
+        s.sendall(json.dumps({"scans": scans, "created_by": created_by}).encode() + b"\n")
+        with s.makefile("rb") as f:
+            linha = f.readline()
+    except OSError as e:
+        # o pedido pode ter sido aplicado; o terminal reenvia e o bloqueio de duplicados segura
+        return {"erro": f"escritor indisponível: {e}"}
+    finally:
+        s.close()
+    if not linha:
+        return {"erro": "escritor encerrou a conexão"}
+    return json.loads(linha)
+
+def iniciar_escritor():
+    if _escritor_estado["thread"] is not None:
+        return
+    with _escritor_lock:
+        if _escritor_estado["thread"] is None:
+            t = threading.Thread(target=_escritor_loop, name="escritor-scans", daemon=True)
+            _escritor_estado["thread"] = t
+            t.start()
+
+def _proximo_grupo():
+    """Bloqueia até o primeiro pedido e junta os que chegarem dentro da janela."""
+    grupo = [_escritor_fila.get()]
+    n = len(grupo[0]["scans"])
+    limite = perf_counter() + ESCRITA_JANELA_MS / 1000
+    while n < ESCRITA_GRUPO_MAX:
+        resta = limite - perf_counter()
+        try:
+            # janela vencida: ainda leva o que já está na fila, sem esperar
+            pedido = _escritor_fila.get(timeout=resta) if resta > 0 else _escritor_fila.get_nowait()
+        except queue.Empty:
+            break
+        grupo.append(pedido)
+        n += len(pedido["scans"])
+    return grupo, n
+
+def _escritor_loop():
+    conn = connect_db()
+    try:
+        while True:
+            grupo, n = _proximo_grupo()
+            observar_metrica("venttos_escrita_grupo_scans", n)
+            try:
+                respostas = transacao_escrita(
+                    conn,
+                    lambda conn: [aplicar_scans(conn, p["scans"], p["created_by"]) for p in grupo]
+                )
+                for pedido, (resultados, disparados) in zip(grupo, respostas):
+                    pedido["resposta"] = {"resultados": resultados, "disparados": disparados}
+            except Exception as e:
+                app.logger.exception("Erro na escrita agrupada (%s pedidos, %s scans)", len(grupo), n)
+                for pedido in grupo:
+                    pedido["resposta"] = {"erro": f"Grupo não aplicado: {e}"}
+            for pedido in grupo:
+                pedido["pronto"].set()
+    finally:
+        conn.close()
+
+class _EscritorHandler(socketserver.StreamRequestHandler):
+    # uma conexão por pedido; cada uma numa thread, todas na mesma fila
+    def handle(self):
+        linha = self.rfile.readline()
+        if not linha:
+            return
+        try:
+            pedido = json.loads(linha)
+            resposta = _pedir_escrita(pedido["scans"], pedido.get("created_by") or "terminal_movimentacao")
+        except (ValueError, KeyError, TypeError) as e:
+            resposta = {"erro": f"pedido inválido: {e}"}
+        self.wfile.write(json.dumps(resposta).encode() + b"\n")
+
+class _EscritorServidor(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+@app.cli.command("scan-writer")
+def scan_writer_command():
+    """Processo escritor da escrita agrupada (ver gunicorn.conf.py)."""
+    if not ESCRITOR_SOCKET:
+        raise click.ClickException("defina ESCRITOR_SOCKET")
+    if os.path.exists(ESCRITOR_SOCKET):
+        os.unlink(ESCRITOR_SOCKET)
+    iniciar_metricas()
+    iniciar_escritor()
+    with _EscritorServidor(ESCRITOR_SOCKET, _EscritorHandler) as servidor:
+        print(f"Escritor de scans em {ESCRITOR_SOCKET} "
+              f"(janela {ESCRITA_JANELA_MS:g} ms, até {ESCRITA_GRUPO_MAX} scans)")
+        servidor.serve_forever()
+
+# ---------------- Fila de push ----------------
+# verificar_alertas_op só grava uma linha por dispositivo em push_fila, dentro da
+# transação do movimentar. O envio roda fora dela: uma thread de despacho por
+# worker reserva os envios vencidos e os entrega a um pool com timeout; falhas
+# voltam para a fila com backoff exponencial e endpoints 404/410 são removidos.
+PUSH_WORKERS = int(os.environ.get("PUSH_WORKERS", 4))
+PUSH_TIMEOUT = float(os.environ.get("PUSH_TIMEOUT", 10))
+PUSH_MAX_TENTATIVAS = int(os.environ.get("PUSH_MAX_TENTATIVAS", 5))
+PUSH_BACKOFF = float(os.environ.get("PUSH_BACKOFF", 30))    # segundos; dobra a cada tentativa
+PUSH_INTERVALO = float(os.environ.get("PUSH_INTERVALO", 5))
+PUSH_LOTE = 50
+PUSH_RESERVA = 120                                           # envio "ENVIANDO" abandonado volta para a fila
+PUSH_RETENCAO_DIAS = 7
+PUSH_STUB = os.environ.get("PUSH_STUB") == "1"
+PUSH_VAPID_CLAIMS = {"sub": "mailto:seuemail@empresa.com"}
+
+_push_executor = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="push")
+_push_acordar = threading.Event()
+_push_lock = threading.Lock()
+_push_estado = {"thread": None, "podado_em": None}
+push_stats = {"enviados": 0, "falhas": 0, "removidos": 0}
+
+def payload_alerta():
+    return json.dumps({
         "title": "🚨 Alerta de Produção",
         "body": "A OP atingiu a meta definida."
     })
 
+def enfileirar_push(conn, payload, alerta_id=None):
+    """Agenda o payload para todos os dispositivos inscritos. Não faz rede."""
+    agora = now_utc().isoformat()
+    cur = conn.execute("""
+        INSERT INTO push_fila (
+            alerta_id, subscription_id, payload, status,
+            tentativas, proxima_tentativa, created_at, updated_at
+        )
+        SELECT ?, id, ?, 'PENDENTE', 0, ?, ?, ?
+        FROM push_subscriptions
+    """, (alerta_id, payload, agora, agora, agora))
+    return cur.rowcount
+
+def acordar_push():
+    """Chamar depois do commit que enfileirou envios."""
+    iniciar_push()
+    _push_acordar.set()
+
+def iniciar_push():
+    if _push_estado["thread"] is not None:
+        return
+    with _push_lock:
+        if _push_estado["thread"] is None:
+            t = threading.Thread(target=_push_loop, name="push-despacho", daemon=True)
+            _push_estado["thread"] = t
+            t.start()
+
+def enviar_alerta(subscription, payload):
+    """Um envio, executado no pool. Retorna (resultado, erro)."""
     try:
         webpush(
             subscription_info=subscription,
             data=payload,
             vapid_private_key=VAPID_PRIVATE_KEY,
-            vapid_claims={
-                "sub": "mailto:seuemail@empresa.com"
-            }
+            # webpush grava "aud"/"exp" no dicionário recebido
+            vapid_claims=dict(PUSH_VAPID_CLAIMS),
+            timeout=PUSH_TIMEOUT
         )
+        return "ENVIADO", None
     except WebPushException as ex:
-        print("Erro no push:", ex)
+        status = ex.response.status_code if ex.response is not None else None
+        if status in (404, 410):
+            return "EXPIRADO", str(ex)
+        return "ERRO", str(ex)
+    except Exception as ex:
+        # timeout, conexão recusada, chave inválida...
+        return "ERRO", str(ex)
+
+def _reservar_push(conn):
+    agora = now_utc()
+    if not conn.execute(SQL_PUSH_VENCIDO, (agora.isoformat(),)).fetchone():
+        return []
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        envios = conn.execute("""
+            SELECT f.id, f.payload, f.tentativas, f.subscription_id,
+                   s.endpoint, s.p256dh, s.auth
+            FROM push_fila f
+            LEFT JOIN push_subscriptions s ON s.id = f.subscription_id
+            WHERE f.status IN ('PENDENTE', 'ENVIANDO')
+              AND f.proxima_tentativa <= ?
+            ORDER BY f.proxima_tentativa
+            LIMIT ?
+        """, (agora.isoformat(), PUSH_LOTE)).fetchall()
+
+        # reserva: outro worker só pega de novo se este não concluir a tempo
+        reserva = (agora + timedelta(seconds=PUSH_RESERVA)).isoformat()
+        conn.executemany(
+            "UPDATE push_fila SET status = 'ENVIANDO', proxima_tentativa = ?, updated_at = ? WHERE id = ?",
+            [(reserva, agora.isoformat(), e["id"]) for e in envios]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return envios
+
+def _gravar_resultados_push(conn, resultados):
+    agora = now_utc()
+    for envio, (resultado, erro) in resultados:
+        contar_metrica("venttos_push_envios_total", resultado=resultado.lower())
+        if resultado == "ENVIADO":
+            conn.execute(
+                "UPDATE push_fila SET status = 'ENVIADO', erro = NULL, updated_at = ? WHERE id = ?",
+                (agora.isoformat(), envio["id"])
+            )
+            push_stats["enviados"] += 1
 
+        elif resultado == "EXPIRADO":
+            # aparelho desinstalou / revogou: não adianta tentar de novo
+            conn.execute("DELETE FROM push_subscriptions WHERE id = ?", (envio["subscription_id"],))
+            conn.execute("""
+                UPDATE push_fila SET status = 'DESCARTADO', erro = ?, updated_at = ?
+                WHERE subscription_id = ? AND status IN ('PENDENTE', 'ENVIANDO')
+            """, (erro, agora.isoformat(), envio["subscription_id"]))
+            push_stats["removidos"] += 1
 
-def format_datetime_br(value):
-    if not value:
-        return ""
+        else:
+            tentativas = envio["tentativas"] + 1
+            push_stats["falhas"] += 1
+            if tentativas >= PUSH_MAX_TENTATIVAS:
+                status, proxima = "FALHOU", agora
+            else:
+                status = "PENDENTE"
+                proxima = agora + timedelta(seconds=PUSH_BACKOFF * 2 ** (tentativas - 1))
+            conn.execute("""
+                UPDATE push_fila
+                SET status = ?, tentativas = ?, proxima_tentativa = ?, erro = ?, updated_at = ?
+                WHERE id = ?
+            """, (status, tentativas, proxima.isoformat(), erro, agora.isoformat(), envio["id"]))
+    conn.commit()
 
+def _podar_push(conn):
+    agora = now_utc()
+    if _push_estado["podado_em"] and agora - _push_estado["podado_em"] < timedelta(hours=1):
+        return
+    _push_estado["podado_em"] = agora
+    conn.execute(
+        "DELETE FROM push_fila WHERE status IN ('ENVIADO', 'DESCARTADO', 'FALHOU') AND updated_at < ?",
+        ((agora - timedelta(days=PUSH_RETENCAO_DIAS)).isoformat(),)
+    )
+    conn.commit()
+
+def _push_loop():
+    conn = connect_db()
     try:
-        s = str(value).replace("T", " ").split(".")[0]
+        while True:
+            try:
+                while True:
+                    envios = _reservar_push(conn)
+                    if not envios:
+                        break
+
+                    futuros = []
+                    resultados = []
+                    for e in envios:
+                        if e["endpoint"] is None:
+                            # inscrição removida depois do enfileiramento
+                            resultados.append((e, ("EXPIRADO", "inscrição removida")))
+                            continue
+                        sub = {"endpoint": e["endpoint"], "keys": {"p256dh": e["p256dh"], "auth": e["auth"]}}
+                        futuros.append((e, _push_executor.submit(enviar_alerta, sub, e["payload"])))
+
+                    for e, f in futuros:
+                        resultados.append((e, f.result()))
+                    _gravar_resultados_push(conn, resultados)
+
+                _podar_push(conn)
+            except Exception:
+                app.logger.exception("Erro no despacho de push")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+
+            _push_acordar.wait(PUSH_INTERVALO)
+            _push_acordar.clear()
+    finally:
+        conn.close()
 
-        dt_utc = parse_utc(value)
-        dt_local = dt_utc.astimezone(ZoneInfo("America/Manaus"))
-        return dt_local.strftime("%d/%m/%Y %H:%M:%S")
+@app.before_request
+def _garantir_despacho_push():
+    # envios pendentes de um processo anterior (ou de outro worker) também saem
+    iniciar_push()
 
+@app.get("/api/push/status")
+def api_push_status():
+    conn = get_db()
+    fila = {
+        r["status"]: r["n"]
+        for r in conn.execute("SELECT status, COUNT(*) AS n FROM push_fila GROUP BY status")
+    }
+    inscritos = conn.execute("SELECT COUNT(*) FROM push_subscriptions").fetchone()[0]
+    return jsonify({"fila": fila, "inscritos": inscritos, **push_stats})
+
+# Endpoint de push falso para testes locais (PUSH_STUB=1): inscreva um aparelho
+# com endpoint http://<host>/api/push/stub/<status> e a resposta será esse status
+# (201 = entregue, 410 = expirado, 500 = falha temporária...).
+push_stub_recebidos = []
+
+@app.post("/api/push/stub/<int:status>")
+def push_stub(status):
+    if not PUSH_STUB:
+        abort(404)
+    push_stub_recebidos.append({"status": status, "bytes": len(request.get_data())})
+    return "", status
 
-    except Exception:
-        return str(value)
+
+# ---------------- Datas ----------------
+# No banco: texto ISO em UTC (created_at...) + epoch-ms (created_ms...) para
+# filtros e ordenação. Nas telas: sempre horário de Manaus, via formatar_data.
+FUSO_LOCAL = ZoneInfo("America/Manaus")
+FORMATO_DATA = "%d/%m/%Y às %H:%M:%S"
+FORMATO_DATA_CURTO = "%d/%m/%Y %H:%M:%S"
 
 def now_utc():
     """Sempre retorna datetime em UTC"""
     return datetime.now(ZoneInfo("UTC"))
 
+def epoch_ms(dt):
+    return round(dt.timestamp() * 1000)
+
+@lru_cache(maxsize=8192)
+def data_local(valor):
+    """epoch-ms ou texto ISO (UTC) -> datetime no fuso local; None se vazio/inválido."""
+    if valor is None or valor == "":
+        return None
+    try:
+        if isinstance(valor, (int, float)):
+            return datetime.fromtimestamp(valor / 1000, FUSO_LOCAL)
+        dt = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+    except (ValueError, OverflowError, OSError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
+    return dt.astimezone(FUSO_LOCAL)
+
+@lru_cache(maxsize=8192)
+def formatar_data(valor, formato=FORMATO_DATA, vazio=""):
+    dt = data_local(valor)
+    if dt is None:
+        return vazio if valor is None or valor == "" else str(valor)
+    return dt.strftime(formato)
+
+def intervalo_ms(data_ini, data_fim):
+    """Datas "AAAA-MM-DD" (dias UTC, como nos filtros das telas) -> (início, fim) em epoch-ms, fim inclusivo."""
+    ini = datetime.fromisoformat(data_ini).replace(tzinfo=ZoneInfo("UTC"))
+    fim = datetime.fromisoformat(data_fim).replace(tzinfo=ZoneInfo("UTC")) + timedelta(days=1)
+    return epoch_ms(ini), epoch_ms(fim) - 1
+
 def get_turno(dt):
     hora = dt.time()
 
@@ -1438,26 +3624,11 @@ def live():
 
 
     conn = get_db()
-    ops = conn.execute("""
-        SELECT
-            m.code             AS modelo,
-            m.cliente          AS cliente,
-            m.op               AS op,
-            SUM(mv.quantidade) AS produzido,
-            mv.from_setor      AS setor,
-            MAX(mv.created_at) AS last_update
-        FROM movements mv
-        JOIN models m ON m.id = mv.model_id
-        WHERE mv.created_at BETWEEN ? AND ?
-          AND UPPER(mv.acao) = 'PRODUCAO'
-        GROUP BY m.code, m.cliente, m.op, mv.from_setor
-        ORDER BY last_update DESC
-    """, (data_ini_utc, data_fim_utc)).fetchall()
-    conn.close()
+    ops = conn.execute(SQL_LIVE, (data_ini_utc, data_fim_utc)).fetchall()
 
     ops = [dict(op) for op in ops]
     for op in ops:
-        op["last_update_br"] = format_datetime_br(op["last_update"])
+        op["last_update_br"] = formatar_data(op["last_update"], FORMATO_DATA_CURTO)
 
     return render_template(
         "live.html",
@@ -1469,27 +3640,10 @@ def live():
 @app.route("/test-push")
 def test_push():
     with get_db() as conn:
-        subs = conn.execute("SELECT * FROM push_subscriptions").fetchall()
-
-    for s in subs:
-        enviar_alerta({
-            "endpoint": s["endpoint"],
-            "keys": {
-                "p256dh": s["p256dh"],
-                "auth": s["auth"]
-            }
-        })
-
-    return "Push enviado"
+        n = enfileirar_push(conn, payload_alerta())
+    acordar_push()
 
-def parse_utc(dt_str):
-    if not dt_str:
-        return None
-
-    s = dt_str.replace("Z", "").split(".")[0]
-
-    dt = datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
-    return dt.replace(tzinfo=ZoneInfo("UTC"))
+    return f"Push enfileirado para {n} dispositivo(s)"
 
 @app.route("/live/consultar/<op>")
 def live_consultar(op):
@@ -1507,32 +3661,33 @@ def live_consultar(op):
 
     conn = get_db()
 
-    rows = conn.execute("""
-        SELECT
-            mv.created_at,
-            mv.quantidade,
-            mv.from_setor,
-            mv.fase,
-            mv.created_by
-        FROM movements mv
-        JOIN models m ON m.id = mv.model_id
-        WHERE m.op = ?
-          AND mv.created_at BETWEEN ? AND ?
-          AND UPPER(mv.acao) = 'PRODUCAO'
-        ORDER BY mv.created_at
-    """, (op, data_ini_utc, data_fim_utc)).fetchall()
-
-    conn.close()
-
-    registros = []
+    # hora a hora (e totais por turno/fase) direto do rollup
     producao_por_hora = {}
+    for h in conn.execute(SQL_LIVE_CONSULTAR, (op, data_ini_utc, data_fim_utc)):
+        chave = (h["hora"], h["turno"])
+        if chave not in producao_por_hora:
+            producao_por_hora[chave] = {
+                "hora": datetime.strptime(h["hora"], "%Y-%m-%d %H:%M").strftime("%d/%m/%Y %H:00"),
+                "turno": h["turno"],
+                "quantidade": 0,
+                "fases": {}
+            }
+        item = producao_por_hora[chave]
+        item["quantidade"] += h["quantidade"]
+        item["fases"][h["fase"]] = item["fases"].get(h["fase"], 0) + h["quantidade"]
+
+    producao_hora = list(producao_por_hora.values())
+
+    ini_ms, fim_ms = intervalo_ms(data_ini, data_fim)
+    rows = conn.execute(
+        SQL_LIVE_REGISTROS,
+        (op, ini_ms, fim_ms, LIVE_REGISTROS_LIMITE)
+    ).fetchall()
 
-    for r in rows:
-        dt_utc = parse_utc(r["created_at"])
-        dt = dt_utc.astimezone(ZoneInfo("America/Manaus"))
+    registros = []
 
-        hora_key = dt.strftime("%Y-%m-%d %H:00")
-        turno = get_turno(dt)
+    for r in reversed(rows):
+        dt = data_local(r["created_ms"])
 
         registros.append({
             "data_hora": dt.strftime("%d/%m/%Y %H:%M:%S"),
@@ -1540,25 +3695,15 @@ def live_consultar(op):
             "quantidade": r["quantidade"],
             "setor": r["from_setor"],
             "fase": r["fase"],
-            "turno": turno,
+            "turno": get_turno(dt),
             "operador": r["created_by"]
         })
 
-        if hora_key not in producao_por_hora:
-            producao_por_hora[hora_key] = {
-                "hora": dt.strftime("%d/%m/%Y %H:00"),
-                "turno": turno,
-                "quantidade": 0
-            }
-
-        producao_por_hora[hora_key]["quantidade"] += r["quantidade"]
-
-    producao_hora = list(producao_por_hora.values())
-
     return render_template(
         "live_consultar.html",
         op=op,
         registros=registros,
+        registros_limitados=len(registros) >= LIVE_REGISTROS_LIMITE,
         producao_hora=producao_hora,
         data_ini=data_ini,
         data_fim=data_fim
@@ -1592,7 +3737,6 @@ def salvar_alerta():
     """, (saldo_id,)).fetchone()
 
     if not saldo:
-        conn.close()
         return jsonify({"error": "Saldo não encontrado"}), 404
 
     id_op = saldo["id_op"]
@@ -1609,7 +3753,6 @@ def salvar_alerta():
     """, (id_op, setor, fase)).fetchone()
 
     if existe:
-        conn.close()
         return jsonify({"error": "Já existe um alerta ativo para este setor/fase"}), 409
 
     # Salva o alerta
@@ -1632,21 +3775,17 @@ def salvar_alerta():
     ))
 
     conn.commit()
-    conn.close()
 
     return jsonify({"success": True})
 
 
 def verificar_alertas_op(conn, id_op, setor, fase, produzido_atual):
-    alertas = conn.execute("""
-        SELECT * FROM op_alerts
-        WHERE id_op = ?
-          AND setor = ?
-          AND fase = ?
-          AND ativo = 1
-          AND disparado = 0
-          AND meta <= ?
-    """, (id_op, setor, fase, produzido_atual)).fetchall()
+    """
+    Marca os alertas atingidos e enfileira o push (ver Fila de push). Roda dentro
+    da transação do movimentar, então não faz rede. Retorna quantos dispararam;
+    o chamador acorda o despacho depois do commit.
+    """
+    alertas = conn.execute(SQL_ALERTAS_PENDENTES, (id_op, setor, fase, produzido_atual)).fetchall()
 
     for alerta in alertas:
         # Marca alerta como disparado
@@ -1655,80 +3794,44 @@ def verificar_alertas_op(conn, id_op, setor, fase, produzido_atual):
             (alerta["id"],)
         )
 
-        # Busca dispositivos cadastrados
-        subs = conn.execute(
-            "SELECT * FROM push_subscriptions"
-        ).fetchall()
-
-        # Envia notificação para cada dispositivo
-        for s in subs:
-            enviar_alerta({
-                "endpoint": s["endpoint"],
-                "keys": {
-                    "p256dh": s["p256dh"],
-                    "auth": s["auth"]
-                }
-            })
+        # Um envio por dispositivo cadastrado
+        enfileirar_push(conn, payload_alerta(), alerta["id"])
 
         # 🔔 FUTURO:
         # aqui entra push / whatsapp / email
 
+    return len(alertas)
+
 
 @app.route("/history/<int:id>")
 def history(id):
     conn = get_db()
 
-    try:
-        model = conn.execute(
-            "SELECT * FROM models WHERE id=?",
-            (id,)
-        ).fetchone()
-
-        if not model:
-            abort(404)
-
-        hist = conn.execute(
-            "SELECT * FROM history WHERE model_id=? ORDER BY changed_at DESC LIMIT 10",
-            (id,)
-        ).fetchall()
+    model = conn.execute(
+        "SELECT * FROM models WHERE id=?",
+        (id,)
+    ).fetchone()
 
-        etiquetas = conn.execute(
-            "SELECT * FROM labels WHERE model_id=? ORDER BY created_at DESC",
-            (id,)
-        ).fetchall()
+    if not model:
+        abort(404)
 
-        movements = conn.execute(
-            "SELECT * FROM movements WHERE model_id=? ORDER BY created_at DESC LIMIT 50",
-            (id,)
-        ).fetchall()
+    hist = conn.execute(SQL_HISTORICO_DO_MODEL, (id,)).fetchall()
 
-    finally:
-        conn.close()
+    etiquetas = conn.execute(SQL_LABELS_DO_MODEL, (id,)).fetchall()
 
-    # 🔹 Função para formatar data no padrão brasileiro
-    def format_datetime(value):
-        if not value:
-            return ""
-        try:
-            dt_utc = parse_utc(value)
-            dt_local = dt_utc.astimezone(
-                ZoneInfo("America/Manaus")
-            )
-            return dt_local.strftime("%d/%m/%Y às %H:%M:%S")
-        except Exception:
-            return str(value)
+    movements = conn.execute(SQL_MOVEMENTS_DO_MODEL, (id,)).fetchall()
 
     hist = [dict(h) for h in hist]
     for h in hist:
-        h["changed_at_formatted"] = format_datetime(h["changed_at"])
+        h["changed_at_formatted"] = formatar_data(h["changed_ms"] or h["changed_at"])
 
     etiquetas = [dict(e) for e in etiquetas]
     for e in etiquetas:
-        e["created_at_formatted"] = format_datetime(e["created_at"])
+        e["created_at_formatted"] = formatar_data(e["created_ms"] or e["created_at"])
 
     movements = [dict(mv) for mv in movements]
     for mv in movements:
-        mv["created_at_formatted"] = format_datetime(mv["created_at"])
+        mv["created_at_formatted"] = formatar_data(mv["created_ms"] or mv["created_at"])
 
     return render_template(
         "history.html",
@@ -1751,7 +3854,6 @@ def etiqueta(code):
         lote_sufixo = None
 
     model_row = conn.execute("SELECT * FROM models WHERE code=?", (base_code,)).fetchone()
-    conn.close()
 
     if not model_row:
         return f"<h3>❌ Etiqueta não encontrada para código '{base_code}'.</h3>", 404
@@ -1761,23 +3863,7 @@ def etiqueta(code):
     if lote_sufixo:
         model["lote"] = lote_sufixo
 
-    def format_updated_at(value):
-        if not value:
-            return ""
-        try:
-            s = str(value).replace("T", " ")
-            s_short = s.split(".")[0].split("+")[0].split("Z")[0].strip()
-            dt_local = parse_utc(value).astimezone(ZoneInfo("America/Manaus"))
-            return dt_local.strftime("%d/%m/%Y às %H:%M:%S")
-
-        except Exception:
-            try:
-                dt2 = datetime.fromisoformat(str(value))
-                return dt2.strftime("%d/%m/%Y às %H:%M:%S")
-            except Exception:
-                return str(value)
-
-    model["updated_at_formatted"] = format_updated_at(model.get("updated_at"))
+    model["updated_at_formatted"] = formatar_data(model.get("updated_ms") or model.get("updated_at"))
 
     return render_template("etiqueta_view.html", m=model)
 
@@ -1786,9 +3872,8 @@ def label_history(model_id):
     conn = get_db()
     model = conn.execute("SELECT * FROM models WHERE id=?", (model_id,)).fetchone()
     etiquetas = conn.execute(
-        "SELECT * FROM labels WHERE model_id=? ORDER BY created_at DESC", (model_id,)
+        "SELECT * FROM labels WHERE model_id=? ORDER BY created_ms DESC", (model_id,)
     ).fetchall()
-    conn.close()
     if not model:
         abort(404)
     return render_template("labels_history.html", model=model, etiquetas=etiquetas)
@@ -1797,15 +3882,15 @@ def label_history(model_id):
 def delete_label(id):
     conn = get_db()
     conn.execute("DELETE FROM labels WHERE id=?", (id,))
+    registrar_evento(conn, "label", id)
+    registrar_evento(conn, "label_removida", id)
     conn.commit()
-    conn.close()
     return "", 204
 
 @app.route("/print_label/<int:model_id>/<lote>")
 def print_label(model_id, lote):
     conn = get_db()
     model = conn.execute("SELECT * FROM models WHERE id=?", (model_id,)).fetchone()
-    conn.close()
     if not model:
         abort(404)
 
@@ -1818,7 +3903,6 @@ def print_label(model_id, lote):
 def etiqueta_visualizar(code, lote):
     conn = get_db()
     model_row = conn.execute("SELECT * FROM models WHERE code=?", (code,)).fetchone()
-    conn.close()
 
     if not model_row:
         return "<h3>Etiqueta não encontrada.</h3>", 404
@@ -1828,89 +3912,329 @@ def etiqueta_visualizar(code, lote):
 
     return render_template("label.html", m=model, lotes=[lote_formatado])
 
+# ---------------- Estáticos versionados e service worker ----------------
+# url_for('static', ...) ganha ?v=<hash do conteúdo>; com a versão na URL o
+# arquivo pode ficar em cache para sempre e qualquer alteração troca a URL.
+STATIC_MAX_AGE = 31536000
+
+_hashes_arquivos = {}
+
+def _hash_arquivo(caminho):
+    try:
+        st = os.stat(caminho)
+    except OSError:
+        return ""
+    chave = (st.st_mtime_ns, st.st_size)
+    atual = _hashes_arquivos.get(caminho)
+    if atual and atual[0] == chave:
+        return atual[1]
+    with open(caminho, "rb") as f:
+        h = hashlib.sha1(f.read()).hexdigest()[:10]
+    _hashes_arquivos[caminho] = (chave, h)
+    return h
+
+@app.url_defaults
+def _versionar_static(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        v = _hash_arquivo(os.path.join(app.static_folder, values["filename"]))
+        if v:
+            values["v"] = v
+
+# Pré-cache do terminal de movimentação (shell = /movimentar sem parâmetros)
+SW_PRECACHE_STATIC = [
+    "style.css",
+    "js/fila_scans.js",
+    "js/push.js",
+    "js/stream.js",
+    "logos/logo-name.jpeg",
+    "users/eduardo.jpeg",
+    "icons/home.jpeg",
+    "icons/ordens.jpeg",
+    "icons/dashboard.jpeg",
+    "icons/live.jpeg",
+    "icons/menu-mais.png",
+]
+SW_PRECACHE_CDN = [
+    "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css",
+    "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.1/font/bootstrap-icons.css",
+    "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js",
+]
+SW_TEMPLATES_SHELL = ["base.html", "movimentar.html"]
+
+@app.get("/sw.js")
+def service_worker():
+    # servido na raiz para que o escopo do worker cubra /movimentar
+    precache = [url_for("static", filename=f) for f in SW_PRECACHE_STATIC]
+    fonte = os.path.join(app.static_folder, "js", "sw.js")
+    versao = [_hash_arquivo(fonte)] + precache + SW_PRECACHE_CDN + [
+        _hash_arquivo(os.path.join(app.template_folder, t)) for t in SW_TEMPLATES_SHELL
+    ]
+
+    def montar():
+        with open(fonte, encoding="utf-8") as f:
+            corpo = f.read()
+        substituicoes = {
+            "__VERSAO__": hashlib.sha1(repr(versao).encode()).hexdigest()[:12],
+            "__PRECACHE__": json.dumps(precache),
+            "__PRECACHE_CDN__": json.dumps(SW_PRECACHE_CDN),
+            "__SHELL__": url_for("movimentar"),
+            "__FILA_JS__": url_for("static", filename="js/fila_scans.js"),
+        }
+        for marcador, valor in substituicoes.items():
+            corpo = corpo.replace(marcador, valor)
+        return app.response_class(corpo, mimetype="text/javascript")
+
+    return resposta_condicional(versao, montar)
+
 @app.after_request
 def add_no_cache_headers(response):
+    if request.endpoint == "static" and request.args.get("v"):
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.public = True
+        response.cache_control.no_cache = None
+        response.cache_control.immutable = True
+        return response
+
+    # APIs de polling com ETag podem ficar no cache do navegador, desde que
+    # revalidem a cada uso (If-None-Match → 304)
+    if response.get_etag()[0]:
+        if "Cache-Control" not in response.headers:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
+# ---------------- GET condicional (ETag / 304) ----------------
+# Só ETag, sem Last-Modified: a versão inclui componentes que não são datas
+# (MAX(id), contagens) e uma data com resolução de segundos não distingue duas
+# mudanças no mesmo segundo — If-Modified-Since sozinho daria 304 errado.
+def resposta_condicional(versao, montar):
+    """
+    Responde 304 se o cliente já tem a `versao` (If-None-Match), sem chamar
+    `montar`; senão devolve montar() com o ETag da versão.
+    """
+    etag = hashlib.sha1(repr(versao).encode()).hexdigest()[:20]
+
+    if not is_resource_modified(request.environ, etag=etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.make_response(montar())
+
+    resp.set_etag(etag)
+    return resp
+
 @app.get("/api/dashboard")
 def api_dashboard():
-    return jsonify(build_dashboard_data())
+    conn = get_db()
+    versao = dashboard_versao(conn)
+    return resposta_condicional(
+        versao,
+        lambda: jsonify(build_dashboard_data(versao))
+    )
 
 @app.get("/api/atualizado")
 def api_atualizado():
     conn = get_db()
-    cur = conn.cursor()
 
     # MODELS → criação/edição de OP
-    cur.execute("SELECT MAX(id) FROM models")
-    model_id = cur.fetchone()[0] or 0
-
     # MOVEMENTS → produção / movimentações
-    cur.execute("SELECT MAX(id) FROM movements")
-    mov_id = cur.fetchone()[0] or 0
-
     # HISTORY → logs (se ainda existir uso)
-    cur.execute("SELECT MAX(id) FROM history")
-    his_id = cur.fetchone()[0] or 0
-
-    conn.close()
-
-    return jsonify({
-        "ultimo": max(model_id, mov_id, his_id)
-    })
+    ids = conn.execute("""
+        SELECT
+            COALESCE((SELECT MAX(id) FROM models), 0),
+            COALESCE((SELECT MAX(id) FROM movements), 0),
+            COALESCE((SELECT MAX(id) FROM history), 0)
+    """).fetchone()
+
+    return resposta_condicional(
+        tuple(ids),
+        lambda: jsonify({"ultimo": max(ids)})
+    )
 
 @app.route("/api/ops_atualizado")
 def ops_atualizado():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT MAX(id) FROM movements")
     ultimo = c.fetchone()[0] or 0
 
-    conn.close()
-    return jsonify({"ultimo": ultimo})
+    return resposta_condicional(ultimo, lambda: jsonify({"ultimo": ultimo}))
+
 @app.get("/api/tabela_models")
 def tabela_models():
+    """Página de models: ?antes=<id>&limite=<n>&search=<termo>; devolve {models, proximo}."""
     conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT id, linha, setor, code, model_name, cliente, updated_at
-        FROM models
-        ORDER BY id DESC
-    """)
-    rows = cur.fetchall()
+    antes, limite, search = parametros_pagina()
+    versao = tuple(conn.execute(SQL_MODELS_VERSAO).fetchone()) + (antes, limite, search)
+    return resposta_condicional(
+        versao,
+        lambda: _tabela_models_json(conn, antes, limite, search)
+    )
 
-    result = []
+def _tabela_models_json(conn, antes, limite, search):
+    models, proximo = buscar_models_pagina(conn, antes, limite, search)
 
-    for r in rows:
-        if r["updated_at"]:
-            dt_utc = parse_utc(r["updated_at"])
-            
-            dt_local = dt_utc.astimezone(
-                ZoneInfo("America/Manaus")
-            )
-            updated_at_formatted = dt_local.strftime(
-                "%d/%m/%Y %H:%M:%S"
-            )
-        else:
-            updated_at_formatted = "-"
+    return jsonify({"models": [_model_json(m) for m in models], "proximo": proximo})
 
-        result.append({
+def _model_json(m):
+    dados = {
+        "id": m["id"],
+        "linha": m["linha"],
+        "setor": m["setor"],
+        "code": m["code"],
+        "model_name": m["model_name"],
+        "cliente": m["cliente"],
+        "updated_at_formatted": formatar_data(
+            m["updated_ms"] or m["updated_at"], FORMATO_DATA_CURTO, vazio="-"
+        )
+    }
+    if "destaque" in m:
+        dados["destaque"] = {col: html and str(html) for col, html in m["destaque"].items()}
+    return dados
+
+MODELS_SUGESTOES_MAX = 20
+MODELS_SUGESTOES_CANDIDATOS = 200
+
+@app.get("/api/models/sugestoes")
+def models_sugestoes():
+    """Type-ahead da busca: ?q=<texto>&limite=<n>, mais relevantes primeiro."""
+    consulta = consulta_fts(request.args.get("q", ""))
+    if not consulta:
+        return jsonify({"sugestoes": []})
+
+    limite = max(1, min(request.args.get("limite", 8, type=int), MODELS_SUGESTOES_MAX))
+    rows = get_db().execute(SQL_MODELS_SUGESTOES, {
+        "consulta": consulta,
+        "candidatos": MODELS_SUGESTOES_CANDIDATOS,
+        "limite": limite
+    }).fetchall()
+
+    return jsonify({"sugestoes": [
+        {
             "id": r["id"],
-            "linha": r["linha"],
-            "setor": r["setor"],
             "code": r["code"],
             "model_name": r["model_name"],
             "cliente": r["cliente"],
-            "updated_at_formatted": updated_at_formatted
-        })
+            "op": r["op"],
+            "destaque": {
+                col: str(destacar(r[f"{col}_destaque"]) or "")
+                for col in ("code", "model_name", "cliente", "op")
+            }
+        }
+        for r in rows
+    ]})
+
+# ---------------- Delta (since) ----------------
+# A versão de uma tela é o id do último evento que ela já aplicou. O delta lê
+# os eventos depois dela e devolve só as linhas afetadas (estado atual) e as
+# lápides das removidas. Se a tela ficou para trás da poda de `eventos`, a
+# resposta traz "recarregar" e a tela busca a lista inteira de novo.
+DELTA_MAX_EVENTOS = 2000
+
+def versao_eventos(conn):
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM eventos").fetchone()[0]
+
+def _ler_delta(conn, since, tipos):
+    """
+    Eventos de `tipos` depois de `since`, agrupados por tipo em conjuntos de ref_id.
+    Retorna (por_tipo, versao, mais, recarregar).
+    """
+    minimo = conn.execute("SELECT MIN(id) FROM eventos").fetchone()[0]
+    if minimo is not None and since < minimo - 1:
+        return {}, versao_eventos(conn), False, True
+
+    eventos = _eventos_desde(conn, since, DELTA_MAX_EVENTOS)
+    por_tipo = {t: set() for t in tipos}
+    for ev in eventos:
+        if ev["tipo"] in por_tipo:
+            por_tipo[ev["tipo"]].add(ev["ref_id"])
+
+    mais = len(eventos) == DELTA_MAX_EVENTOS
+    versao = eventos[-1]["id"] if eventos else since
+    return por_tipo, versao, mais, False
+
+def _delta_since():
+    return max(request.args.get("since", 0, type=int), 0)
+
+@app.get("/api/tabela_models/delta")
+def tabela_models_delta():
+    """Models criados/editados depois de ?since=<versão>, e etiquetas removidas."""
+    conn = get_db()
+    since = _delta_since()
+    return resposta_condicional(
+        ("models", since, versao_eventos(conn)),
+        lambda: _tabela_models_delta_json(conn, since)
+    )
+
+def _tabela_models_delta_json(conn, since):
+    por_tipo, versao, mais, recarregar = _ler_delta(conn, since, ("model", "label_removida"))
+    if recarregar:
+        return jsonify({"versao": versao, "recarregar": True})
+
+    ids = sorted(por_tipo["model"])
+    rows = conn.execute(
+        "SELECT * FROM models WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id DESC",
+        (json.dumps(ids),)
+    ).fetchall() if ids else []
+    encontrados = {r["id"] for r in rows}
+
+    return jsonify({
+        "versao": versao,
+        "mais": mais,
+        "models": [_model_json(r) for r in rows],
+        "removidos": [i for i in ids if i not in encontrados],
+        "labels_removidas": sorted(por_tipo["label_removida"])
+    })
+
+@app.get("/api/ops/delta")
+def ops_delta():
+    """Linhas de /ops (OP × setor × fase) alteradas depois de ?since=<versão>."""
+    conn = get_db()
+    since = _delta_since()
+    return resposta_condicional(
+        ("ops", since, versao_eventos(conn)),
+        lambda: _ops_delta_json(conn, since)
+    )
+
+def _ops_delta_json(conn, since):
+    por_tipo, versao, mais, recarregar = _ler_delta(
+        conn, since, ("op", "movement", "saldo_removido")
+    )
+    if recarregar:
+        return jsonify({"versao": versao, "recarregar": True})
+
+    ops_ids = set(por_tipo["op"])
+    if por_tipo["movement"]:
+        ops_ids.update(r[0] for r in conn.execute(
+            SQL_OPS_DOS_MOVIMENTOS, (json.dumps(sorted(por_tipo["movement"])),)
+        ))
+
+    linhas = [dict(r) for r in conn.execute(
+        SQL_OPS_LINHAS_DE, (json.dumps(sorted(ops_ids)),)
+    )] if ops_ids else []
+
+    # a OP inteira some quando o último setor/fase é removido: a tela apaga
+    # as linhas das OPs listadas em "ops" que não voltaram em "linhas"
+    return jsonify({
+        "versao": versao,
+        "mais": mais,
+        "ops": sorted(ops_ids),
+        "linhas": linhas,
+        "removidos": sorted(por_tipo["saldo_removido"])
+    })
 
-    conn.close()
-    return jsonify({"models": result})
+@app.get("/api/db_pool")
+def api_db_pool():
+    with _db_pool_stats_lock:
+        stats = dict(db_pool_stats)
+    stats["ociosas"] = _db_pool.qsize()
+    stats["tamanho_max"] = DB_POOL_SIZE
+    return jsonify(stats)
 
 if __name__ == "__main__":
+    migrar_db()
     app.run(host="0.0.0.0", port=8080, debug=True)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark das consultas quentes do Venttos Trace.
+
+Mede cada consulta isolada (sem HTTP nem template) em bancos sintéticos de
+10k/100k/1M/10M movimentos, criados uma vez com o mesmo gerador do
+loadtest.py e reaproveitados nas rodadas seguintes. O resultado é comparado
+com um baseline em JSON: uma consulta que ficar mais lenta que o limite
+(mediana atual / mediana do baseline) faz o comando sair com código 1.
+
+    python benchmark.py --tamanhos 10k,100k,1M                # mede e compara
+    python benchmark.py --tamanhos 10k,100k,1M --salvar       # grava o baseline
+    python benchmark.py --tamanhos 10M --repeticoes 10        # 10M: seed demora
+
+Cada tamanho roda num processo próprio com DB_PATH apontando para o banco
+daquele tamanho, usando as funções e o SQL do próprio app.py.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+
+TAMANHOS = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+
+AQUECIMENTO = 3
+AMOSTRA = 200
+
+
+# ---------------- Casos ----------------
+# Cada caso recebe (A, conn, amostra, rnd) e executa uma vez o que a rota faz
+# no banco. `amostra` traz ids/códigos reais sorteados do banco medido.
+def _hoje():
+    hoje = date.today().isoformat()
+    return f"{hoje}T00:00:00", f"{hoje}T23:59:59"
+
+
+def caso_buscar_ops(A, conn, amostra, rnd):
+    A.buscar_ops()
+
+
+def caso_dashboard(A, conn, amostra, rnd):
+    # build_dashboard_data sem o cache por versão: o custo de quando algo mudou
+    A._montar_dashboard(conn)
+
+
+def caso_dashboard_versao(A, conn, amostra, rnd):
+    A.dashboard_versao(conn)
+
+
+def caso_live(A, conn, amostra, rnd):
+    conn.execute(A.SQL_LIVE, _hoje()).fetchall()
+
+
+def caso_live_consultar(A, conn, amostra, rnd):
+    op = rnd.choice(amostra["ops"])
+    ini, fim = _hoje()
+    conn.execute(A.SQL_LIVE_CONSULTAR, (op, ini, fim)).fetchall()
+    ini_ms, fim_ms = A.intervalo_ms(date.today().isoformat(), date.today().isoformat())
+    conn.execute(A.SQL_LIVE_REGISTROS, (op, ini_ms, fim_ms, A.LIVE_REGISTROS_LIMITE)).fetchall()
+
+
+def caso_bloqueio_duplicado(A, conn, amostra, rnd):
+    raiz = rnd.choice(amostra["raizes"])
+    for ponto, acao, fase in (("Ponto-02", "PRODUCAO", "TOP"), ("Ponto-03", "CQ", "TOP")):
+        conn.execute(A.SQL_MOVIMENTO_DUPLICADO, (raiz, ponto, acao, fase)).fetchone()
+
+
+def caso_localizar_etiqueta(A, conn, amostra, rnd):
+    A.localizar_etiqueta(conn, rnd.choice(amostra["qrs"]))
+
+
+def caso_history(A, conn, amostra, rnd):
+    model_id = rnd.choice(amostra["models"])
+    conn.execute("SELECT * FROM models WHERE id=?", (model_id,)).fetchone()
+    conn.execute(A.SQL_HISTORICO_DO_MODEL, (model_id,)).fetchall()
+    conn.execute(A.SQL_LABELS_DO_MODEL, (model_id,)).fetchall()
+    conn.execute(A.SQL_MOVEMENTS_DO_MODEL, (model_id,)).fetchall()
+
+
+def caso_tabela_models(A, conn, amostra, rnd):
+    conn.execute(A.SQL_MODELS_VERSAO).fetchone()
+    A.buscar_models_pagina(conn, A.SEM_CURSOR, A.MODELS_PAGINA)
+
+
+def caso_tabela_models_busca(A, conn, amostra, rnd):
+    A.buscar_models_pagina(conn, A.SEM_CURSOR, A.MODELS_PAGINA, rnd.choice(amostra["buscas"]))
+
+
+CASOS = [
+    ("buscar_ops", caso_buscar_ops),
+    ("build_dashboard_data", caso_dashboard),
+    ("dashboard_versao", caso_dashboard_versao),
+    ("live", caso_live),
+    ("live_consultar", caso_live_consultar),
+    ("movimentar: bloqueio duplicado", caso_bloqueio_duplicado),
+    ("movimentar: localizar_etiqueta", caso_localizar_etiqueta),
+    ("history", caso_history),
+    ("tabela_models", caso_tabela_models),
+    ("tabela_models: busca", caso_tabela_models_busca),
+]
+
+
+def sortear_amostra(conn, rnd):
+    def ids(sql):
+        return [r[0] for r in conn.execute(sql)]
+
+    models = ids("SELECT id FROM models")
+    max_label = conn.execute("SELECT MAX(id) FROM labels").fetchone()[0] or 1
+    # raízes espalhadas pela tabela inteira (lotes antigos e recentes)
+    raizes = ids(f"""
+        SELECT DISTINCT root_label_id FROM labels
+        WHERE id IN ({",".join(str(rnd.randint(1, max_label)) for _ in range(AMOSTRA))})
+    """)
+    qrs = [
+        f"{code}-{seq:02d}-{padrao}"
+        for code, seq, padrao in conn.execute(f"""
+            SELECT m.code, l.lote_seq, l.lote_padrao
+            FROM labels l JOIN models m ON m.id = l.model_id
+            WHERE l.id IN ({",".join(map(str, raizes))})
+        """)
+    ]
+    codes = ids("SELECT code FROM models")
+    return {
+        "models": models,
+        "ops": ids("SELECT DISTINCT numero_op FROM ops"),
+        "raizes": raizes,
+        "qrs": qrs,
+        "buscas": [c[:4] for c in rnd.sample(codes, min(20, len(codes)))] + ["Cliente A", "Placa"],
+    }
+
+
+def medir(args):
+    """Roda num processo com DB_PATH já definido; grava os tempos em args.saida."""
+    sys.path.insert(0, RAIZ)
+    import app as A
+
+    rnd = random.Random(args.semente)
+    resultados = {}
+    with A.app.app_context():
+        conn = A.get_db()
+        amostra = sortear_amostra(conn, rnd)
+        for nome, caso in CASOS:
+            if args.casos and nome not in args.casos:
+                continue
+            for _ in range(AQUECIMENTO):
+                caso(A, conn, amostra, rnd)
+
+            tempos = []
+            limite = time.perf_counter() + args.tempo_max
+            while len(tempos) < args.repeticoes and (len(tempos) < 5 or time.perf_counter() < limite):
+                t0 = time.perf_counter()
+                caso(A, conn, amostra, rnd)
+                tempos.append((time.perf_counter() - t0) * 1000)
+
+            tempos.sort()
+            resultados[nome] = {
+                "mediana_ms": round(tempos[len(tempos) // 2], 3),
+                "p95_ms": round(tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))], 3),
+                "min_ms": round(tempos[0], 3),
+                "n": len(tempos),
+            }
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(resultados, f)
+
+
+# ---------------- Orquestração ----------------
+def garantir_banco(diretorio, rotulo):
+    db = os.path.join(diretorio, f"models-{rotulo}.db")
+    if not os.path.exists(db):
+        sys.path.insert(0, RAIZ)
+        from loadtest import semear
+
+        movimentos = TAMANHOS[rotulo]
+        print(f"criando {db} ({movimentos} movimentos)...", flush=True)
+        parcial = db + ".parcial"
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(parcial + sufixo):
+                os.remove(parcial + sufixo)
+        semear(parcial, max(20, movimentos // 4000), movimentos, reserva=1000)
+        os.replace(parcial, db)
+    return db
+
+
+def medir_tamanho(args, rotulo):
+    db = garantir_banco(args.dir, rotulo)
+    cmd = [sys.executable, os.path.abspath(__file__), "--medir",
+           "--repeticoes", str(args.repeticoes), "--tempo-max", str(args.tempo_max),
+           "--semente", str(args.semente)]
+    for caso in args.casos or ():
+        cmd += ["--caso", caso]
+    env = dict(os.environ, DB_PATH=os.path.abspath(db))
+    with tempfile.TemporaryDirectory() as tmp:
+        saida = os.path.join(tmp, "tempos.json")
+        subprocess.run(cmd + ["--saida", saida], env=env, cwd=RAIZ, check=True)
+        with open(saida, encoding="utf-8") as f:
+            return json.load(f)
+
+
+def comparar(atual, baseline, limite, piso_ms):
+    """[(tamanho, caso, antes, agora, razão)] das consultas que pioraram além do limite."""
+    regressoes = []
+    for rotulo, casos in atual.items():
+        for nome, r in casos.items():
+            antes = baseline.get(rotulo, {}).get(nome)
+            if not antes:
+                continue
+            razao = r["mediana_ms"] / max(antes["mediana_ms"], 1e-6)
+            if razao > limite and r["mediana_ms"] - antes["mediana_ms"] > piso_ms:
+                regressoes.append((rotulo, nome, antes["mediana_ms"], r["mediana_ms"], razao))
+    return regressoes
+
+
+def imprimir(atual, baseline):
+    rotulos = list(atual)
+    nomes = [n for n, _ in CASOS if any(n in atual[r] for r in rotulos)]
+    cab = f"{'consulta (mediana ms)':32}" + "".join(f"{r:>14}" for r in rotulos)
+    print()
+    print(cab)
+    print("-" * len(cab))
+    for nome in nomes:
+        linha = f"{nome:32}"
+        for rotulo in rotulos:
+            r = atual[rotulo].get(nome)
+            antes = baseline.get(rotulo, {}).get(nome)
+            if r is None:
+                linha += f"{'-':>14}"
+            elif antes:
+                linha += f"{r['mediana_ms']:>8.2f} {r['mediana_ms'] / max(antes['mediana_ms'], 1e-6):>4.1f}x"
+            else:
+                linha += f"{r['mediana_ms']:>14.2f}"
+        print(linha)
+    if baseline:
+        print("\n(Nx = mediana atual / mediana do baseline)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark das consultas quentes.")
+    parser.add_argument("--tamanhos", default="10k,100k,1M",
+                        help=f"lista separada por vírgula entre {', '.join(TAMANHOS)}")
+    parser.add_argument("--dir", default="bench", help="onde ficam os bancos gerados")
+    parser.add_argument("--baseline", default=None, help="JSON do baseline (padrão: <dir>/baseline.json)")
+    parser.add_argument("--salvar", action="store_true", help="grava os tempos desta rodada como baseline")
+    parser.add_argument("--saida", help="grava os tempos desta rodada neste JSON")
+    parser.add_argument("--limite", type=float, default=1.25,
+                        help="razão máxima aceita entre a mediana atual e a do baseline")
+    parser.add_argument("--piso-ms", type=float, default=0.5,
+                        help="diferenças menores que isto nunca contam como regressão")
+    parser.add_argument("--repeticoes", type=int, default=50)
+    parser.add_argument("--tempo-max", type=float, default=10, help="segundos por consulta e tamanho")
+    parser.add_argument("--caso", dest="casos", action="append", help="mede só este caso (repetível)")
+    parser.add_argument("--semente", type=int, default=7)
+    parser.add_argument("--medir", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        return medir(args)
+
+    rotulos = [t.strip() for t in args.tamanhos.split(",") if t.strip()]
+    desconhecidos = [t for t in rotulos if t not in TAMANHOS]
+    if desconhecidos:
+        sys.exit(f"tamanho desconhecido: {', '.join(desconhecidos)}")
+
+    caminho_baseline = args.baseline or os.path.join(args.dir, "baseline.json")
+    baseline = {}
+    if os.path.exists(caminho_baseline):
+        with open(caminho_baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["resultados"]
+
+    atual = {}
+    for rotulo in rotulos:
+        print(f"medindo {rotulo}...", flush=True)
+        atual[rotulo] = medir_tamanho(args, rotulo)
+
+    imprimir(atual, baseline)
+
+    documento = {
+        "gerado_em": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "maquina": platform.node(),
+        "resultados": atual,
+    }
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(documento, f, ensure_ascii=False, indent=2)
+
+    regressoes = comparar(atual, baseline, args.limite, args.piso_ms)
+    if args.salvar:
+        # tamanhos não medidos nesta rodada continuam com o valor anterior
+        documento["resultados"] = {**baseline, **atual}
+        os.makedirs(os.path.dirname(os.path.abspath(caminho_baseline)), exist_ok=True)
+        with open(caminho_baseline, "w", encoding="utf-8") as f:
+            json.dump(documento, f, ensure_ascii=False, indent=2)
+        print(f"baseline gravado em {caminho_baseline}")
+    elif regressoes:
+        print(f"\n❌ {len(regressoes)} consulta(s) acima de {args.limite:.2f}x o baseline:")
+        for rotulo, nome, antes, agora, razao in regressoes:
+            print(f"   {rotulo:>5}  {nome}: {antes:.2f} ms -> {agora:.2f} ms ({razao:.2f}x)")
+        sys.exit(1)
+    elif baseline:
+        print(f"\n✅ nenhuma consulta acima de {args.limite:.2f}x o baseline.")
+
+
+if __name__ == "__main__":
+    main()
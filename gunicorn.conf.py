@@ -0,0 +1,52 @@
+# Configuração do gunicorn (lida automaticamente a partir do diretório do app).
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# gevent: cada tela com /api/stream (SSE) aberto é só uma greenlet ociosa,
+# não um worker/thread preso.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# /metrics soma os retratos que cada worker grava nesta pasta; uma pasta por
+# master, para que os workers de uma mesma instância se enxerguem
+os.environ.setdefault(
+    "METRICAS_DIR", os.path.join(tempfile.gettempdir(), f"venttos-metricas-{os.getpid()}")
+)
+
+# Escrita agrupada: um processo escritor por master, com o socket herdado pelos workers
+if os.environ.get("ESCRITA_AGRUPADA") == "1":
+    os.environ.setdefault(
+        "ESCRITOR_SOCKET", os.path.join(tempfile.gettempdir(), f"venttos-escritor-{os.getpid()}.sock")
+    )
+_escritor = {"processo": None}
+
+
+def on_starting(server):
+    # Roda no processo master, uma única vez, antes do fork dos workers:
+    # os workers importam o app já com o esquema em dia. A migração roda num
+    # processo separado para o master não importar o app antes do monkey-patch
+    # do gevent nos workers.
+    subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "migrate-db"],
+        check=True
+    )
+    if os.environ.get("ESCRITA_AGRUPADA") == "1":
+        _escritor["processo"] = subprocess.Popen(
+            [sys.executable, "-m", "flask", "--app", "app", "scan-writer"]
+        )
+
+
+def on_exit(server):
+    processo = _escritor["processo"]
+    if processo is not None:
+        processo.terminate()
+        processo.wait(timeout=10)
+        try:
+            os.unlink(os.environ["ESCRITOR_SOCKET"])
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(os.environ["METRICAS_DIR"], ignore_errors=True)
@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+"""
+Teste de carga do Venttos Trace.
+
+Monta um models.db com volume de produção (models, OPs, etiquetas divididas ao
+longo do roteiro e milhões de movimentos) e simula os terminais Ponto-01…07
+lendo etiquetas ao mesmo tempo em que telas de dashboard, /live, /ops e da
+lista de models fazem polling. No fim mostra, por rota: requisições/s, p50/p95/p99,
+recusas de regra de negócio e erros de "database is locked".
+
+    # 1. banco semeado (o esquema vem das migrações do próprio app.py)
+    python loadtest.py seed --db /tmp/carga/models.db --movimentos 2000000
+
+    # 2. carga contra um gunicorn local iniciado pelo próprio script
+    python loadtest.py run --db /tmp/carga/models.db --gunicorn --workers 2 --duracao 120
+
+    # mesma carga com a escrita agrupada (um escritor para todos os workers)
+    python loadtest.py run --db /tmp/carga/models.db --gunicorn --workers 2 --duracao 120 --escrita-agrupada
+
+    # ou contra um servidor já no ar (DB_PATH=/tmp/carga/models.db gunicorn ...)
+    python loadtest.py run --url http://127.0.0.1:8000 --db /tmp/carga/models.db
+
+Usa só a biblioteca padrão; `seed` importa o app.py para criar o esquema e
+reconstruir os agregados com as mesmas funções do servidor.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+
+PONTOS = ["Ponto-01", "Ponto-02", "Ponto-03", "Ponto-04", "Ponto-05", "Ponto-06", "Ponto-07"]
+
+# setor para onde a etiqueta vai em cada ponto (mesmo mapa de aplicar_movimento)
+DESTINO_PONTO = {
+    "Ponto-01": "PTH",
+    "Ponto-02": "SMT",
+    "Ponto-03": "SMT",
+    "Ponto-04": "IM",
+    "Ponto-05": "PA",
+    "Ponto-06": "IM",
+    "Ponto-07": "ESTOQUE",
+}
+
+# o que o operador de cada ponto faz com uma etiqueta: (acao, fase)
+ROTEIRO_TERMINAL = {
+    "Ponto-01": [("RECEBIMENTO", "TOP"), ("PRODUCAO", "TOP")],
+    "Ponto-02": [("RECEBIMENTO", "TOP"), ("PRODUCAO", "TOP"), ("PRODUCAO", "BOTTOM")],
+    "Ponto-03": [("RECEBIMENTO", "TOP"), ("CQ", "TOP")],
+    "Ponto-04": [("RECEBIMENTO", "TOP"), ("PRODUCAO", "TOP"), ("PRODUCAO", "BOTTOM")],
+    "Ponto-05": [("CQ", "TOP")],
+    "Ponto-06": [("CQ", "TOP"), ("CQ", "BOTTOM")],
+    "Ponto-07": [("RECEBIMENTO", "TOP")],
+}
+
+TIPOS_TELA = ("dashboard", "live", "ops", "models")
+
+
+# ---------------- Seed ----------------
+def _roteiro_historico(setor, phase_type):
+    """Caminho completo de um lote pela fábrica: [(ponto, acao, fase)]."""
+    passos = []
+    if setor == "PTH":
+        passos += [("Ponto-01", "RECEBIMENTO", "TOP"), ("Ponto-01", "PRODUCAO", "TOP")]
+    passos += [("Ponto-02", "RECEBIMENTO", "TOP"), ("Ponto-02", "PRODUCAO", "TOP")]
+    if phase_type == "TOP_BOTTOM":
+        passos.append(("Ponto-02", "PRODUCAO", "BOTTOM"))
+    passos += [
+        ("Ponto-03", "RECEBIMENTO", "TOP"),
+        ("Ponto-03", "CQ", "TOP"),
+        ("Ponto-04", "RECEBIMENTO", "TOP"),
+        ("Ponto-04", "PRODUCAO", "TOP"),
+        (random.choice(("Ponto-05", "Ponto-06")), "CQ", "TOP"),
+        ("Ponto-07", "RECEBIMENTO", "TOP"),
+    ]
+    return passos
+
+
+def _iso_ms(dt):
+    return dt.isoformat(), int(dt.timestamp() * 1000)
+
+
+def _gravar(conn, sql, linhas):
+    if linhas:
+        conn.executemany(sql, linhas)
+        linhas.clear()
+
+
+SQL_SEED_MODEL = """
+    INSERT INTO models
+        (id, code, model_name, cliente, linha, turno, data, lote, quantidade, po, op,
+         setor, fase, phase_type, lote_padrao, created_at, created_ms, updated_at, updated_ms)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SEED_LABEL = """
+    INSERT INTO labels
+        (id, model_id, lote, lote_seq, lote_padrao, producao_total, capacidade_magazine, remaining,
+         created_at, created_ms, updated_at, updated_ms, linked_label_id, root_label_id,
+         setor_atual, fase, top_done, bottom_done)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SEED_MOVEMENT = """
+    INSERT INTO movements
+        (model_id, label_id, new_label_id, root_label_id, ponto, acao, quantidade,
+         from_setor, to_setor, fase, created_at, created_ms, created_by)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SEED_BLOCO = 50000
+
+
+def seed(args):
+    if os.path.exists(args.db):
+        if not args.substituir:
+            sys.exit(f"{args.db} já existe (use --substituir para recriar).")
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + sufixo):
+                os.remove(args.db + sufixo)
+    semear(args.db, args.models, args.movimentos, args.reserva, args.dias, args.semente)
+
+
+def semear(db, n_models, n_movimentos, reserva, dias=60, semente=42):
+    """Cria `db` (não pode existir) com o esquema do app e o volume pedido."""
+    sys.path.insert(0, RAIZ)
+    import app as A
+
+    os.makedirs(os.path.dirname(os.path.abspath(db)), exist_ok=True)
+    random.seed(semente)
+    inicio = time.monotonic()
+    A.migrar_db(db)
+
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("BEGIN")
+
+    agora = datetime.now(timezone.utc)
+    origem = agora - timedelta(days=dias)
+
+    # --- models e OPs ---
+    models = []
+    linhas = []
+    for i in range(1, n_models + 1):
+        setor = random.choice(("SMT", "SMT", "SMT", "PTH"))
+        phase_type = random.choice(("TOP_ONLY", "TOP_BOTTOM"))
+        padrao = str(random.randint(100, 999))
+        criado_at, criado_ms = _iso_ms(origem + timedelta(seconds=random.uniform(0, 3600)))
+        m = {
+            "id": i, "code": f"LT{i:05d}", "op": f"OP{i:05d}", "setor": setor,
+            "phase_type": phase_type, "padrao": padrao,
+            "capacidade": random.choice((25, 50, 50, 100)), "lotes": 0,
+        }
+        models.append(m)
+        linhas.append((
+            i, m["code"], f"Placa {i:05d}", random.choice(("Cliente A", "Cliente B", "Cliente C")),
+            f"L{random.randint(1, 6)}", random.choice(("1", "2", "3")), criado_at[:10],
+            f"01 / {padrao}", "0", f"PO{random.randint(1000, 9999)}", m["op"],
+            setor, "", phase_type, padrao, criado_at, criado_ms, criado_at, criado_ms
+        ))
+    conn.executemany(SQL_SEED_MODEL, linhas)
+    conn.executemany(
+        "INSERT INTO history (model_id, changed_at, changed_ms, changed_by, change_text) VALUES (?, ?, ?, 'seed', 'Cadastro')",
+        [(m[0], m[15], m[16]) for m in linhas]
+    )
+
+    for m in models:
+        cur = conn.execute("""
+            INSERT INTO ops (filial, numero_op, produto, descricao, armazem, quantidade, produzido, setores, created_at, model_id)
+            VALUES ('01', ?, ?, 'carga', '01', ?, 0, 'SMT,IM', ?, ?)
+        """, (m["op"], m["code"], 10 ** 7, origem.isoformat(), m["id"]))
+        fases = ("TOP", "BOTTOM") if m["phase_type"] == "TOP_BOTTOM" else ("TOP",)
+        conn.executemany(
+            "INSERT INTO ops_saldos (id_op, setor, fase, quantidade) VALUES (?, ?, ?, 0)",
+            [(cur.lastrowid, setor, fase) for setor in ("SMT", "IM") for fase in fases]
+        )
+
+    # --- lotes históricos: cada passo do roteiro divide a etiqueta ---
+    def nova_raiz(m):
+        m["lotes"] += 1
+        seq = m["lotes"]
+        return seq, f"{seq:02d} / {m['padrao']}"
+
+    prox_label = 1
+    labels, movimentos = [], []
+    total_mov = 0
+    setor_inicial = {"PTH": "PTH", "SMT": "SMT"}
+    while total_mov < n_movimentos:
+        m = random.choice(models)
+        passos = _roteiro_historico(m["setor"], m["phase_type"])
+        if random.random() > 0.7:
+            passos = passos[:random.randint(1, len(passos) - 1)]
+
+        quando = origem + timedelta(seconds=random.uniform(0, dias * 86400))
+        seq, lote = nova_raiz(m)
+        cap = m["capacidade"]
+        raiz = prox_label
+        prox_label += 1
+        quando_at, quando_ms = _iso_ms(quando)
+        pai = [raiz, m["id"], lote, seq, m["padrao"], cap, cap, cap, quando_at, quando_ms,
+               quando_at, quando_ms, None, raiz, setor_inicial[m["setor"]], None, 0, 0]
+        setor_atual = pai[14]
+
+        for ponto, acao, fase in passos:
+            quando += timedelta(seconds=random.uniform(60, 4 * 3600))
+            if quando > agora:
+                break
+            quando_at, quando_ms = _iso_ms(quando)
+            pai[7] = 0
+            pai[10], pai[11] = quando_at, quando_ms
+            labels.append(tuple(pai))
+
+            filho = prox_label
+            prox_label += 1
+            destino = DESTINO_PONTO[ponto]
+            movimentos.append((
+                m["id"], pai[0], filho, raiz, ponto, acao, cap,
+                setor_atual, destino, fase, quando_at, quando_ms, "seed"
+            ))
+            pai = [filho, m["id"], lote, seq, m["padrao"], cap, cap, cap, quando_at, quando_ms,
+                   None, None, pai[0], raiz, destino, A.get_fase(ponto, acao),
+                   cap if fase == "TOP" else 0, cap if fase == "BOTTOM" else 0]
+            setor_atual = destino
+            total_mov += 1
+
+        labels.append(tuple(pai))
+        if len(movimentos) >= SEED_BLOCO:
+            _gravar(conn, SQL_SEED_LABEL, labels)
+            _gravar(conn, SQL_SEED_MOVEMENT, movimentos)
+            print(f"  {total_mov} movimentos ({time.monotonic() - inicio:.0f}s)", flush=True)
+
+    # --- lotes novos, ainda sem movimento, para os terminais lerem ---
+    quando_at, quando_ms = _iso_ms(agora)
+    for _ in range(reserva):
+        m = random.choice(models)
+        seq, lote = nova_raiz(m)
+        cap = m["capacidade"]
+        labels.append((prox_label, m["id"], lote, seq, m["padrao"], cap, cap, cap,
+                       quando_at, quando_ms, None, None, None, prox_label,
+                       setor_inicial[m["setor"]], None, 0, 0))
+        prox_label += 1
+    _gravar(conn, SQL_SEED_LABEL, labels)
+    _gravar(conn, SQL_SEED_MOVEMENT, movimentos)
+
+    print("  reconstruindo agregados...", flush=True)
+    A.reconstruir_producao_agregada(conn)
+    A.reconstruir_producao_hora(conn)
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    conn.close()
+
+    print(
+        f"{db}: {n_models} models, {prox_label - 1} etiquetas, {total_mov} movimentos, "
+        f"{reserva} lotes livres para a carga ({time.monotonic() - inicio:.0f}s)"
+    )
+
+
+# ---------------- Cliente HTTP ----------------
+# Uma conexão keep-alive por sessão (terminal ou tela), como um navegador.
+def nova_sessao(url, timeout):
+    partes = urlsplit(url)
+    return {
+        "host": partes.hostname,
+        "porta": partes.port or 80,
+        "timeout": timeout,
+        "conn": None,
+        "cookie": None,
+        "etags": {},
+    }
+
+
+def pedir(sessao, metodo, caminho, corpo=None, headers=None):
+    """-> (status, headers, corpo, segundos); status 0 = falha de rede."""
+    headers = dict(headers or {})
+    if sessao["cookie"]:
+        headers["Cookie"] = sessao["cookie"]
+
+    t0 = time.perf_counter()
+    for tentativa in (1, 2):
+        if sessao["conn"] is None:
+            sessao["conn"] = http.client.HTTPConnection(sessao["host"], sessao["porta"], timeout=sessao["timeout"])
+        try:
+            sessao["conn"].request(metodo, caminho, body=corpo, headers=headers)
+            resp = sessao["conn"].getresponse()
+            dados = resp.read()
+            break
+        except (OSError, http.client.HTTPException):
+            sessao["conn"].close()
+            sessao["conn"] = None
+            # o servidor pode fechar uma conexão keep-alive ociosa: tenta uma vez de novo
+            if tentativa == 2:
+                return 0, {}, b"", time.perf_counter() - t0
+    segundos = time.perf_counter() - t0
+
+    resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+    m = re.search(r"session=([^;]*)", resp_headers.get("set-cookie", ""))
+    if m:
+        sessao["cookie"] = f"session={m.group(1)}"
+    return resp.status, resp_headers, dados, segundos
+
+
+def pedir_condicional(sessao, caminho, chave=None):
+    """GET com If-None-Match, guardando o ETag por rota como o navegador faz."""
+    chave = chave or caminho
+    headers = {}
+    if sessao["etags"].get(chave):
+        headers["If-None-Match"] = sessao["etags"][chave]
+    status, resp_headers, dados, segundos = pedir(sessao, "GET", caminho, headers=headers)
+    if status == 200 and "etag" in resp_headers:
+        sessao["etags"][chave] = resp_headers["etag"]
+    return status, resp_headers, dados, segundos
+
+
+# ---------------- Medição ----------------
+# Cada thread anota no próprio registro; o relatório junta tudo no fim.
+def novo_registro():
+    return defaultdict(lambda: {"lat": [], "status": Counter(), "ok": 0, "recusado": 0, "lock": 0, "erro": 0})
+
+
+def _e_lock(texto):
+    texto = texto.lower() if isinstance(texto, str) else texto.decode("utf-8", "replace").lower()
+    return "database is locked" in texto or "database is busy" in texto
+
+
+def anotar(registro, rota, status, segundos, resultado=None):
+    r = registro[rota]
+    r["lat"].append(segundos)
+    r["status"][status] += 1
+    if resultado is None:
+        resultado = "ok" if status in (200, 302, 304) else "erro"
+    r[resultado] += 1
+
+
+def _resultado_http(status, dados):
+    if status in (200, 302, 304):
+        return "ok"
+    return "lock" if _e_lock(dados) else "erro"
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def juntar(registros):
+    total = novo_registro()
+    for registro in registros:
+        for rota, r in list(registro.items()):
+            t = total[rota]
+            t["lat"].extend(r["lat"])
+            t["status"].update(r["status"])
+            for k in ("ok", "recusado", "lock", "erro"):
+                t[k] += r[k]
+    return total
+
+
+def montar_relatorio(total, duracao, extras):
+    rotas = {}
+    for rota in sorted(total):
+        r = total[rota]
+        lat = sorted(r["lat"])
+        rotas[rota] = {
+            "requisicoes": len(lat),
+            "por_segundo": round(len(lat) / duracao, 2),
+            "p50_ms": round(percentil(lat, 50) * 1000, 1),
+            "p95_ms": round(percentil(lat, 95) * 1000, 1),
+            "p99_ms": round(percentil(lat, 99) * 1000, 1),
+            "max_ms": round((lat[-1] if lat else 0) * 1000, 1),
+            "ok": r["ok"],
+            "recusados": r["recusado"],
+            "lock": r["lock"],
+            "erros": r["erro"],
+            "status": {str(k): v for k, v in sorted(r["status"].items())},
+        }
+    return {"duracao_s": round(duracao, 1), "rotas": rotas, **extras}
+
+
+def imprimir_relatorio(rel):
+    print()
+    cab = f"{'rota':32} {'req':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'recus.':>7} {'lock':>6} {'erros':>6}"
+    print(cab)
+    print("-" * len(cab))
+    for rota, r in rel["rotas"].items():
+        print(f"{rota:32} {r['requisicoes']:>7} {r['por_segundo']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['max_ms']:>8} {r['recusados']:>7} {r['lock']:>6} {r['erros']:>6}")
+    print()
+    print(f"duração: {rel['duracao_s']}s   scans aplicados: {rel['scans_aplicados']} "
+          f"({rel['scans_por_segundo']}/s)   lotes esgotados: {rel['pontos_sem_lote']}")
+    if "consistencia" in rel:
+        c = rel["consistencia"]
+        print(f"consistência: {c['linhagens']} linhagens lidas, {c['saldo_divergente']} com saldo divergente, "
+              f"{c['movimentos_repetidos']} movimentos repetidos (raiz/ponto/ação/fase)")
+
+
+# ---------------- Sessões ----------------
+def carregar_lotes_livres(db):
+    """Etiquetas raiz que ainda têm saldo: (raiz, qr, phase_type, setor do model)."""
+    conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+    try:
+        return conn.execute("""
+            SELECT l.id, m.code || '-' || printf('%02d', l.lote_seq) || '-' || l.lote_padrao,
+                   m.phase_type, m.setor
+            FROM labels l
+            JOIN models m ON m.id = l.model_id
+            WHERE l.remaining > 0 AND l.id = l.root_label_id AND l.lote_seq IS NOT NULL
+        """).fetchall()
+    finally:
+        conn.close()
+
+
+def carregar_ops(db):
+    conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+    try:
+        return [r[0] for r in conn.execute("SELECT numero_op FROM ops LIMIT 500")]
+    finally:
+        conn.close()
+
+
+def _scan_lote(sessao, registro, scan):
+    corpo = json.dumps({"scans": [scan]})
+    status, _, dados, segundos = pedir(
+        sessao, "POST", "/api/movimentar/lote", corpo, {"Content-Type": "application/json"}
+    )
+    if status == 200:
+        r = json.loads(dados)["resultados"][0]
+        if r["ok"]:
+            resultado = "ok"
+        elif _e_lock(r["mensagem"]):
+            resultado = "lock"
+        elif r["mensagem"].startswith("Erro ao registrar"):
+            resultado = "erro"
+        else:
+            resultado = "recusado"
+    else:
+        resultado = _resultado_http(status, dados)
+    anotar(registro, "POST /api/movimentar/lote", status, segundos, resultado)
+    return resultado
+
+
+RE_FLASH = re.compile(r'class="alert alert-(\w+)[^"]*"[^>]*>\s*(.*?)\s*<', re.S)
+
+
+def _scan_formulario(sessao, registro, scan, ponto):
+    # formulário antigo: POST -> 302 -> GET com a mensagem (flash) na página
+    form = {"qr_code": scan["qr_code"], "ponto_url": ponto, "ponto": ponto, "acao": scan["acao"]}
+    if scan.get("top_mark"):
+        form["top_mark"] = "1"
+    if scan.get("bottom_mark"):
+        form["bottom_mark"] = "1"
+    status, headers, dados, segundos = pedir(
+        sessao, "POST", "/movimentar", urlencode(form),
+        {"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    if status != 302:
+        resultado = _resultado_http(status, dados)
+        anotar(registro, "POST /movimentar", status, segundos, resultado)
+        return resultado
+
+    destino = urlsplit(headers.get("location", "/movimentar"))
+    st2, _, pagina, seg2 = pedir(sessao, "GET", destino.path + (f"?{destino.query}" if destino.query else ""))
+    anotar(registro, "GET /movimentar", st2, seg2)
+    flash = RE_FLASH.search(pagina.decode("utf-8", "replace"))
+    if not flash or flash.group(1) == "success":
+        resultado = "ok"
+    elif _e_lock(flash.group(2)):
+        resultado = "lock"
+    elif flash.group(2).startswith("Erro ao registrar"):
+        resultado = "erro"
+    else:
+        resultado = "recusado"
+    anotar(registro, "POST /movimentar", status, segundos, resultado)
+    return resultado
+
+
+def terminal(args, ponto, fila, trava, registro, contadores, fim):
+    """Um operador num ponto: pega o próximo lote, lê o QR e registra o roteiro do ponto."""
+    sessao = nova_sessao(args.url, args.timeout)
+    while time.monotonic() < fim:
+        with trava:
+            lote = fila.pop() if fila else None
+        if lote is None:
+            contadores["sem_lote"].add(ponto)
+            return
+        raiz, qr, phase_type, _ = lote
+
+        for acao, fase in ROTEIRO_TERMINAL[ponto]:
+            if fase == "BOTTOM" and phase_type != "TOP_BOTTOM":
+                continue
+            if time.monotonic() >= fim:
+                return
+
+            # o terminal abre a etiqueta lida pela câmera antes de confirmar a ação
+            status, _, dados, segundos = pedir(sessao, "GET", "/movimentar?" + urlencode({"p": ponto, "qr_code": qr}))
+            anotar(registro, "GET /movimentar?qr_code", status, segundos, _resultado_http(status, dados))
+
+            scan = {
+                "qr_code": qr, "ponto": ponto, "acao": acao, "quantidade": None,
+                "top_mark": 1 if fase == "TOP" else 0, "bottom_mark": 1 if fase == "BOTTOM" else 0,
+                "client_ts": datetime.now(timezone.utc).isoformat(),
+            }
+            repeticoes = 2 if random.random() < args.repetidos else 1
+            for _ in range(repeticoes):
+                if random.random() < args.formulario:
+                    resultado = _scan_formulario(sessao, registro, scan, ponto)
+                else:
+                    resultado = _scan_lote(sessao, registro, scan)
+                if resultado == "ok":
+                    contadores["aplicados"][threading.get_ident()] += 1
+                    contadores["raizes"].add(raiz)
+
+            if args.pausa:
+                time.sleep(random.expovariate(1 / args.pausa))
+
+
+def tela(args, tipo, ops, registro, fim):
+    """Uma tela aberta no chão de fábrica atualizando sozinha."""
+    sessao = nova_sessao(args.url, args.timeout)
+    since = 0
+    time.sleep(random.uniform(0, args.intervalo_telas))
+    while time.monotonic() < fim:
+        if tipo == "dashboard":
+            status, _, dados, seg = pedir_condicional(sessao, "/api/dashboard")
+            anotar(registro, "GET /api/dashboard", status, seg, _resultado_http(status, dados))
+        elif tipo == "live":
+            status, _, dados, seg = pedir(sessao, "GET", "/live")
+            anotar(registro, "GET /live", status, seg, _resultado_http(status, dados))
+            if ops:
+                status, _, dados, seg = pedir(sessao, "GET", f"/live/consultar/{random.choice(ops)}")
+                anotar(registro, "GET /live/consultar/<op>", status, seg, _resultado_http(status, dados))
+        else:
+            rota = "/api/ops/delta" if tipo == "ops" else "/api/tabela_models/delta"
+            status, _, dados, seg = pedir_condicional(sessao, f"{rota}?since={since}", rota)
+            anotar(registro, f"GET {rota}", status, seg, _resultado_http(status, dados))
+            if status == 200:
+                since = json.loads(dados).get("versao", since)
+        time.sleep(args.intervalo_telas)
+
+
+def verificar_consistencia(db, raizes):
+    """
+    Depois da carga: cada linhagem tocada precisa somar o saldo da raiz (as
+    transferências só dividem a etiqueta) e não pode ter o mesmo passo
+    registrado duas vezes. Divergência aqui é atualização perdida entre terminais.
+    """
+    conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+    try:
+        ids = json.dumps(sorted(raizes))
+        divergentes = conn.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT r.id
+                FROM labels r
+                JOIN labels l ON l.root_label_id = r.id
+                WHERE r.id IN (SELECT value FROM json_each(?))
+                GROUP BY r.id
+                HAVING SUM(l.remaining) <> MAX(r.capacidade_magazine)
+            )
+        """, (ids,)).fetchone()[0]
+        repetidos = conn.execute("""
+            SELECT COALESCE(SUM(n - 1), 0) FROM (
+                SELECT COUNT(*) AS n
+                FROM movements
+                WHERE root_label_id IN (SELECT value FROM json_each(?))
+                GROUP BY root_label_id, ponto, acao, UPPER(TRIM(fase))
+                HAVING COUNT(*) > 1
+            )
+        """, (ids,)).fetchone()[0]
+    finally:
+        conn.close()
+    return {"linhagens": len(raizes), "saldo_divergente": divergentes, "movimentos_repetidos": repetidos}
+
+
+# ---------------- gunicorn local ----------------
+def iniciar_gunicorn(args):
+    porta = urlsplit(args.url).port or 80
+    env = dict(os.environ, DB_PATH=os.path.abspath(args.db), WEB_CONCURRENCY=str(args.workers), PUSH_STUB="1")
+    if args.escrita_agrupada:
+        env["ESCRITA_AGRUPADA"] = "1"
+    log = open(os.path.abspath(args.db) + ".gunicorn.log", "ab")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{porta}", "app:app"],
+        cwd=RAIZ, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    sessao = nova_sessao(args.url, 2)
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proc.poll() is not None:
+            sys.exit(f"gunicorn saiu com código {proc.returncode} (ver {log.name})")
+        if pedir(sessao, "GET", "/menu")[0] == 200:
+            return proc
+        time.sleep(0.5)
+    proc.terminate()
+    sys.exit("gunicorn não respondeu em 60s")
+
+
+def run(args):
+    if (args.gunicorn or args.verificar) and not args.db:
+        sys.exit("--gunicorn e --verificar precisam de --db")
+
+    servidor = iniciar_gunicorn(args) if args.gunicorn else None
+    try:
+        lotes = carregar_lotes_livres(args.db) if args.db else []
+        ops = carregar_ops(args.db) if args.db else []
+        if not lotes:
+            sys.exit("nenhum lote livre: rode `loadtest.py seed` (ou informe --db)")
+
+        # cada ponto percorre todos os lotes livres numa ordem própria, então o
+        # mesmo lote às vezes passa por dois pontos ao mesmo tempo, como na fábrica
+        filas, travas = {}, {}
+        for ponto in PONTOS:
+            fila = [l for l in lotes if ponto != "Ponto-01" or l[3] == "PTH"]
+            random.Random(f"{args.semente}-{ponto}").shuffle(fila)
+            filas[ponto], travas[ponto] = fila, threading.Lock()
+
+        contadores = {"aplicados": Counter(), "raizes": set(), "sem_lote": set()}
+        registros, threads = [], []
+        inicio = time.monotonic()
+        fim = inicio + args.duracao
+
+        for ponto in PONTOS:
+            for _ in range(args.terminais):
+                registro = novo_registro()
+                registros.append(registro)
+                threads.append(threading.Thread(
+                    target=terminal, args=(args, ponto, filas[ponto], travas[ponto], registro, contadores, fim),
+                    daemon=True
+                ))
+        for i in range(args.telas):
+            registro = novo_registro()
+            registros.append(registro)
+            threads.append(threading.Thread(
+                target=tela, args=(args, TIPOS_TELA[i % len(TIPOS_TELA)], ops, registro, fim), daemon=True
+            ))
+
+        print(f"{len(PONTOS) * args.terminais} terminais e {args.telas} telas por {args.duracao}s "
+              f"contra {args.url} ({len(lotes)} lotes livres)", flush=True)
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(timeout=args.progresso)
+                if t.is_alive():
+                    break
+            decorrido = time.monotonic() - inicio
+            aplicados = sum(contadores["aplicados"].values())
+            print(f"  {decorrido:5.0f}s  {aplicados} scans aplicados ({aplicados / max(decorrido, 1e-9):.1f}/s)", flush=True)
+        duracao = time.monotonic() - inicio
+    finally:
+        if servidor:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+
+    aplicados = sum(contadores["aplicados"].values())
+    extras = {
+        "url": args.url,
+        "terminais": len(PONTOS) * args.terminais,
+        "telas": args.telas,
+        "workers": args.workers if args.gunicorn else None,
+        "scans_aplicados": aplicados,
+        "scans_por_segundo": round(aplicados / duracao, 2),
+        "pontos_sem_lote": sorted(contadores["sem_lote"]),
+    }
+    if args.verificar and contadores["raizes"]:
+        extras["consistencia"] = verificar_consistencia(args.db, contadores["raizes"])
+
+    relatorio = montar_relatorio(juntar(registros), duracao, extras)
+    imprimir_relatorio(relatorio)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        print(f"relatório em {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga dos terminais de movimentação.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("seed", help="cria um models.db com volume de produção")
+    p.add_argument("--db", default="carga/models.db")
+    p.add_argument("--models", type=int, default=500)
+    p.add_argument("--movimentos", type=int, default=2_000_000)
+    p.add_argument("--reserva", type=int, default=20_000, help="lotes sem movimento para a carga")
+    p.add_argument("--dias", type=int, default=60, help="período coberto pelo histórico")
+    p.add_argument("--semente", type=int, default=42)
+    p.add_argument("--substituir", action="store_true")
+    p.set_defaults(func=seed)
+
+    p = sub.add_parser("run", help="simula terminais e telas contra o servidor")
+    p.add_argument("--url", default="http://127.0.0.1:8000")
+    p.add_argument("--db", help="banco semeado (lotes livres, OPs e verificação no fim)")
+    p.add_argument("--gunicorn", action="store_true", help="sobe um gunicorn local com DB_PATH=--db")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--escrita-agrupada", action="store_true", help="sobe o gunicorn com ESCRITA_AGRUPADA=1")
+    p.add_argument("--duracao", type=float, default=60)
+    p.add_argument("--terminais", type=int, default=3, help="terminais por ponto")
+    p.add_argument("--pausa", type=float, default=1.0, help="pausa média entre scans de um terminal (s); 0 = sem pausa")
+    p.add_argument("--formulario", type=float, default=0.2, help="fração de scans pelo formulário antigo")
+    p.add_argument("--repetidos", type=float, default=0.02, help="fração de scans lidos duas vezes")
+    p.add_argument("--telas", type=int, default=8, help="telas em polling (dashboard, live, ops, models)")
+    p.add_argument("--intervalo-telas", type=float, default=2.0)
+    p.add_argument("--timeout", type=float, default=30)
+    p.add_argument("--progresso", type=float, default=10)
+    p.add_argument("--verificar", action="store_true", help="confere saldos das linhagens tocadas no fim")
+    p.add_argument("--json", help="grava o relatório em JSON")
+    p.add_argument("--semente", type=int, default=42)
+    p.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
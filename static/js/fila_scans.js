@@ -0,0 +1,142 @@
+// Fila local de scans (IndexedDB), usada pela página do terminal e pelo sw.js.
+// Cada scan fica "pendente" até o servidor responder por ele em
+// /api/movimentar/lote: aceito sai da fila, recusado vira "falha" (com a
+// mensagem do servidor) e erro de rede mantém tudo pendente para a próxima vez.
+// Cada scan leva um id gerado aqui; o servidor guarda esse id no movimento e,
+// num reenvio, devolve o resultado original em vez de recusar como duplicado.
+
+const FILA_DB = "venttos-scans";
+const FILA_STORE = "scans";
+const FILA_LOTE = 200;
+const FILA_ENDPOINT = "/api/movimentar/lote";
+
+function abrirFila() {
+    return new Promise((resolve, reject) => {
+        const req = indexedDB.open(FILA_DB, 1);
+        req.onupgradeneeded = () => {
+            const store = req.result.createObjectStore(FILA_STORE, { keyPath: "seq", autoIncrement: true });
+            store.createIndex("status", "status");
+        };
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+    });
+}
+
+function _filaTx(modo, fn) {
+    return abrirFila().then(db => new Promise((resolve, reject) => {
+        const tx = db.transaction(FILA_STORE, modo);
+        const store = tx.objectStore(FILA_STORE);
+        let resultado;
+        Promise.resolve(fn(store)).then(r => { resultado = r; });
+        tx.oncomplete = () => { db.close(); resolve(resultado); };
+        tx.onerror = () => { db.close(); reject(tx.error); };
+    }));
+}
+
+function _filaPedido(req) {
+    return new Promise((resolve, reject) => {
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+    });
+}
+
+function novoIdScan() {
+    if (self.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2, 10);
+}
+
+function enfileirarScan(scan) {
+    const item = Object.assign({ id: novoIdScan() }, scan, {
+        status: "pendente",
+        criado_em: new Date().toISOString()
+    });
+    return _filaTx("readwrite", store => _filaPedido(store.add(item)));
+}
+
+function contarFila() {
+    return _filaTx("readonly", store => {
+        const idx = store.index("status");
+        return Promise.all([
+            _filaPedido(idx.count("pendente")),
+            _filaPedido(idx.count("falha"))
+        ]).then(([pendentes, falhas]) => ({ pendentes, falhas }));
+    });
+}
+
+function listarFalhas() {
+    return _filaTx("readonly", store => _filaPedido(store.index("status").getAll("falha")));
+}
+
+function limparFalhas() {
+    return _filaTx("readwrite", store =>
+        _filaPedido(store.index("status").getAllKeys("falha"))
+            .then(chaves => chaves.forEach(k => store.delete(k)))
+    );
+}
+
+function _pendentes(limite) {
+    // a chave autoincremento preserva a ordem em que os scans foram feitos
+    return _filaTx("readonly", store => _filaPedido(store.index("status").getAll("pendente")))
+        .then(itens => itens.sort((a, b) => a.seq - b.seq).slice(0, limite));
+}
+
+function _gravarResultados(itens, resultados) {
+    return _filaTx("readwrite", store => {
+        resultados.forEach(r => {
+            const item = itens[r.indice];
+            if (!item) return;
+            if (r.ok) {
+                store.delete(item.seq);
+            } else {
+                item.status = "falha";
+                item.mensagem = r.mensagem;
+                store.put(item);
+            }
+        });
+    });
+}
+
+async function _enviarPendentes() {
+    let enviados = 0;
+    let falhas = 0;
+
+    while (true) {
+        const itens = await _pendentes(FILA_LOTE);
+        if (!itens.length) break;
+
+        const scans = itens.map(i => ({
+            id: i.id,
+            qr_code: i.qr_code,
+            ponto: i.ponto,
+            acao: i.acao,
+            quantidade: i.quantidade,
+            top_mark: i.top_mark,
+            bottom_mark: i.bottom_mark,
+            client_ts: i.client_ts
+        }));
+
+        // erro de rede ou 5xx: exceção, os itens continuam pendentes
+        const resp = await fetch(FILA_ENDPOINT, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ scans })
+        });
+        if (!resp.ok) throw new Error("Lote recusado: HTTP " + resp.status);
+
+        const dados = await resp.json();
+        await _gravarResultados(itens, dados.resultados);
+        enviados += dados.aplicados;
+        falhas += dados.recusados;
+    }
+
+    return { enviados, falhas };
+}
+
+// Página e service worker podem tentar ao mesmo tempo; a trava evita mandar o
+// mesmo scan duas vezes.
+function sincronizarFila() {
+    if (self.navigator && navigator.locks) {
+        return navigator.locks.request("venttos-fila-scans", _enviarPendentes);
+    }
+    return _enviarPendentes();
+}
@@ -10,7 +10,7 @@ async function registrarPush() {
         return;
     }
 
-    const register = await navigator.serviceWorker.register("/static/sw.js");
+    const register = await navigator.serviceWorker.register("/sw.js");
 
     const subscription = await register.pushManager.subscribe({
         userVisibleOnly: true,
@@ -0,0 +1,32 @@
+// Feed de mudanças do servidor (/api/stream, Server-Sent Events).
+// Chama `aoMudar` quando chega algum dos `tipos` de evento (agrupando rajadas)
+// e, se o navegador ou o servidor não suportarem SSE, volta para o polling.
+function assinarMudancas(tipos, aoMudar, polling) {
+    let timer = null;
+    let pollingAtivo = false;
+
+    function disparar(ev) {
+        clearTimeout(timer);
+        timer = setTimeout(() => aoMudar(ev), 300);
+    }
+
+    function iniciarPolling() {
+        if (pollingAtivo || !polling) return;
+        pollingAtivo = true;
+        polling.verificar();
+        setInterval(polling.verificar, polling.intervalo);
+    }
+
+    if (!("EventSource" in window)) {
+        iniciarPolling();
+        return;
+    }
+
+    const es = new EventSource("/api/stream");
+    tipos.forEach(tipo => es.addEventListener(tipo, disparar));
+
+    // o EventSource reconecta sozinho; só desiste (CLOSED) se o endpoint falhar
+    es.onerror = () => {
+        if (es.readyState === EventSource.CLOSED) iniciarPolling();
+    };
+}
@@ -1,3 +1,118 @@
+// Service worker do Venttos Trace. Servido pelo Flask em /sw.js (escopo "/"),
+// que troca os marcadores abaixo pela versão e pela lista de pré-cache atuais.
+// Qualquer arquivo da lista que mudar muda a VERSAO, e o navegador instala este
+// worker de novo, descartando os caches antigos.
+const VERSAO = "__VERSAO__";
+const PRECACHE = __PRECACHE__;
+const PRECACHE_CDN = __PRECACHE_CDN__;
+const SHELL = "__SHELL__";
+const CACHE = "venttos-shell-" + VERSAO;
+const REDE_TIMEOUT = 3000;
+
+importScripts("__FILA_JS__");
+
+self.addEventListener("install", event => {
+    event.waitUntil((async () => {
+        const cache = await caches.open(CACHE);
+        await cache.addAll(PRECACHE.concat([SHELL]));
+        // CDN é melhor esforço: sem ele o terminal ainda funciona, só sem estilo
+        await Promise.all(PRECACHE_CDN.map(url => cache.add(url).catch(() => null)));
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener("activate", event => {
+    event.waitUntil((async () => {
+        const nomes = await caches.keys();
+        await Promise.all(
+            nomes.filter(n => n.startsWith("venttos-shell-") && n !== CACHE).map(n => caches.delete(n))
+        );
+        await self.clients.claim();
+    })());
+});
+
+function comTimeout(promessa, ms) {
+    return new Promise((resolve, reject) => {
+        const t = setTimeout(() => reject(new Error("timeout")), ms);
+        promessa.then(r => { clearTimeout(t); resolve(r); }, e => { clearTimeout(t); reject(e); });
+    });
+}
+
+async function shellDoTerminal(event, url) {
+    const cache = await caches.open(CACHE);
+    const emCache = await cache.match(SHELL);
+
+    // QR lido pela câmera (?qr_code=...): a página traz dados da etiqueta, então
+    // tenta a rede primeiro e só cai no shell se ela não responder a tempo
+    if (url.searchParams.has("qr_code")) {
+        try {
+            return await comTimeout(fetch(event.request), REDE_TIMEOUT);
+        } catch (e) {
+            if (emCache) return emCache;
+            throw e;
+        }
+    }
+
+    // tela vazia do terminal: abre do cache na hora e atualiza em segundo plano
+    const atualizar = fetch(SHELL, { credentials: "same-origin" }).then(resp => {
+        if (resp.ok) cache.put(SHELL, resp.clone());
+        return resp;
+    });
+    if (emCache) {
+        event.waitUntil(atualizar.catch(() => null));
+        return emCache;
+    }
+    return atualizar;
+}
+
+async function cachePrimeiro(request) {
+    const cache = await caches.open(CACHE);
+    const emCache = await cache.match(request);
+    if (emCache) return emCache;
+
+    const resp = await fetch(request);
+    if (resp.ok || resp.type === "opaque") cache.put(request, resp.clone());
+    return resp;
+}
+
+self.addEventListener("fetch", event => {
+    const request = event.request;
+    if (request.method !== "GET") return;
+
+    const url = new URL(request.url);
+
+    if (request.mode === "navigate" && url.origin === location.origin && url.pathname === SHELL) {
+        event.respondWith(shellDoTerminal(event, url));
+        return;
+    }
+
+    // estáticos versionados (?v=hash) e bibliotecas do CDN (fontes, ícones) nunca mudam
+    const estatico = url.origin === location.origin && url.pathname.startsWith("/static/") && url.searchParams.has("v");
+    const cdn = url.origin !== location.origin && /(jsdelivr\.net|unpkg\.com|fonts\.(googleapis|gstatic)\.com)$/.test(url.hostname);
+    if (estatico || cdn) {
+        event.respondWith(cachePrimeiro(request));
+    }
+});
+
+// ---------------- Fila de scans offline ----------------
+async function avisarPaginas() {
+    const paginas = await self.clients.matchAll({ includeUncontrolled: true });
+    paginas.forEach(p => p.postMessage({ tipo: "fila-scans" }));
+}
+
+self.addEventListener("sync", event => {
+    if (event.tag !== "fila-scans") return;
+    // se falhar (rede), o navegador agenda nova tentativa sozinho
+    event.waitUntil(sincronizarFila().finally(avisarPaginas));
+});
+
+self.addEventListener("message", event => {
+    if (event.data && event.data.tipo === "sincronizar") {
+        event.waitUntil(sincronizarFila().catch(() => null).finally(avisarPaginas));
+    }
+});
+
+// ---------------- Push ----------------
 self.addEventListener('push', function (event) {
     const data = event.data ? event.data.json() : {};
 